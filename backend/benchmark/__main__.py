@@ -0,0 +1,160 @@
+"""
+HTTP load generator for a running server. Run it against two builds to compare them, e.g.
+python -m benchmark --url http://localhost:8112 --scenario image --concurrency 128
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import httpx
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    elapsed: float
+    latencies: list[float]
+
+    def report(self) -> str:
+        quantiles = statistics.quantiles(self.latencies, n=100)
+        return (
+            f"{self.scenario}: {self.requests} requests, concurrency {self.concurrency}, "
+            f"{self.errors} errors\n"
+            f"  throughput  {self.requests / self.elapsed:10.1f} req/s\n"
+            f"  latency p50 {quantiles[49] * 1000:10.2f} ms\n"
+            f"  latency p95 {quantiles[94] * 1000:10.2f} ms\n"
+            f"  latency p99 {quantiles[98] * 1000:10.2f} ms"
+        )
+
+
+def build_scenarios(
+    films: list[dict[str, str]], sizes: dict[str, int]
+) -> dict[str, Callable[[], tuple[str, dict[str, str]]]]:
+    """
+    Each scenario returns the path and headers of the next request to issue.
+    :param films: the film list of the server under test
+    :param sizes: size of the video of each film, by uuid; only needed by the seek scenario.
+    :return:
+    """
+
+    def films_list() -> tuple[str, dict[str, str]]:
+        return "/api/get/films", {}
+
+    def image() -> tuple[str, dict[str, str]]:
+        film = random.choice(films)
+        image_type = random.choice(("THUMBNAIL", "POSTER"))
+        return f"/api/get/image?uuid={film['uuid']}&image_type={image_type}", {}
+
+    def video() -> tuple[str, dict[str, str]]:
+        film = random.choice(films)
+        start = random.randrange(0, 64 * 1024)
+        return f"/api/get/video?uuid={film['uuid']}", {
+            "Range": f"bytes={start}-{start + 16 * 1024}"
+        }
+
+    def seek() -> tuple[str, dict[str, str]]:
+        # a player seeking through a film: random 512 KiB windows, and the odd multi-range probe.
+        uuid, size = random.choice(list(sizes.items()))
+        starts = sorted(
+            random.randrange(0, size) for _ in range(random.choice((1, 1, 1, 3)))
+        )
+        ranges = ", ".join(f"{i}-{min(i + 512 * 1024, size) - 1}" for i in starts)
+        return f"/api/get/video?uuid={uuid}", {"Range": f"bytes={ranges}"}
+
+    def mixed() -> tuple[str, dict[str, str]]:
+        return random.choice((films_list, image, image, video))()
+
+    return {
+        "films": films_list,
+        "image": image,
+        "video": video,
+        "seek": seek,
+        "mixed": mixed,
+    }
+
+
+async def video_sizes(
+    client: httpx.AsyncClient, films: list[dict[str, str]]
+) -> dict[str, int]:
+    """
+    Looks up the size of the video of up to 100 films, with a one byte range request each.
+    :return: size of each video found, by film uuid
+    """
+    sizes = dict()
+    for film in films[:100]:
+        response = await client.get(
+            f"/api/get/video?uuid={film['uuid']}", headers={"Range": "bytes=0-0"}
+        )
+        if response.status_code == 206:
+            sizes[film["uuid"]] = int(response.headers["Content-Range"].split("/")[1])
+    return sizes
+
+
+async def run(
+    url: str, scenario: str, concurrency: int, requests: int, timeout: float
+) -> Result:
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=url, limits=limits, timeout=timeout
+    ) as client:
+        films = (await client.get("/api/get/films")).json()
+        if not films and scenario != "films":
+            raise SystemExit("the server has no films to request")
+        sizes = await video_sizes(client, films) if scenario == "seek" else dict()
+        if scenario == "seek" and not sizes:
+            raise SystemExit("the server has no videos to request")
+        next_request = build_scenarios(films, sizes)[scenario]
+
+        latencies: list[float] = list()
+        errors = 0
+        remaining = iter(range(requests))
+
+        async def worker() -> None:
+            nonlocal errors
+            for _ in remaining:
+                path, headers = next_request()
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, headers=headers)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return Result(scenario, concurrency, requests, errors, elapsed, latencies)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:8112")
+    parser.add_argument(
+        "--scenario",
+        choices=("films", "image", "video", "seek", "mixed"),
+        default="mixed",
+    )
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    result = asyncio.run(
+        run(args.url, args.scenario, args.concurrency, args.requests, args.timeout)
+    )
+    print(result.report())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of the cost of building a film from a database record, without the database. Compares the
+dict rows the films used to be built from with the positional row factory, e.g.
+python -m benchmark.rows --rows 100000
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import uuid
+from datetime import date
+from typing import Any, Callable, Sequence
+
+from util.database.database import make_film
+from util.models.film import FilmNoBytes
+from util.models.rating import Rating
+
+# column names of the records, as the film queries named them before they were positional.
+DICT_FIELDS = [
+    "uuid", "title", "date_added", "filename", "watched", "state", "actresses",
+    "r_uuid", "average", "story", "positions", "pussy", "shots", "boobs", "face", "rearview",
+]  # fmt: skip
+
+
+def make_film_from_dict(values: Sequence[Any]) -> FilmNoBytes:
+    """
+    The films as they were built before: a dict for each row, the rating popped out of it.
+    :param values: record of FILM_COLUMNS
+    :return:
+    """
+    film_data = dict(zip(DICT_FIELDS, values))
+    rating = Rating(
+        uuid=film_data.pop("r_uuid"),
+        average=film_data.pop("average"),
+        story=film_data.pop("story"),
+        positions=film_data.pop("positions"),
+        pussy=film_data.pop("pussy"),
+        shots=film_data.pop("shots"),
+        boobs=film_data.pop("boobs"),
+        face=film_data.pop("face"),
+        rearview=film_data.pop("rearview"),
+    )
+    return FilmNoBytes(rating=rating, **film_data)
+
+
+def records(count: int) -> list[tuple[Any, ...]]:
+    return [
+        (
+            uuid.uuid4(), f"film {i}", date(2024, 1, 1), f"film-{i}.mp4", False,
+            "COMPLETE", ["actress one", "actress two"],
+            uuid.uuid4(), 7.5, 8, 7, 6, 5, 4, 3, 2,
+        )
+        for i in range(count)
+    ]  # fmt: skip
+
+
+def per_row(
+    maker: Callable[[Sequence[Any]], FilmNoBytes],
+    rows: list[tuple[Any, ...]],
+    repeat: int,
+) -> float:
+    """
+    :param maker: row maker
+    :param rows:
+    :param repeat: runs over the rows; the fastest one counts.
+    :return: seconds per row
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for row in rows:
+            maker(row)
+        best = min(best, time.perf_counter() - started)
+    return best / len(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = records(args.rows)
+    assert make_film(rows[0]) == make_film_from_dict(rows[0])
+    before = per_row(make_film_from_dict, rows, args.repeat)
+    after = per_row(make_film, rows, args.repeat)
+    print(f"{args.rows} rows, best of {args.repeat}")
+    print(f"  dict rows        {before * 1e9:10.0f} ns/row")
+    print(f"  positional rows  {after * 1e9:10.0f} ns/row  ({before / after:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,26 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import date
 from pathlib import Path
-from typing import Annotated, Any, Literal, MutableMapping, Optional
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Literal,
+    MutableMapping,
+    Optional,
+)
 from uuid import UUID
 
+import anyio
 import fastapi
 import uvicorn
 from fastapi import (
@@ -14,6 +29,7 @@ from fastapi import (
     FastAPI,
     File,
     Form,
+    Header,
     HTTPException,
     Query,
     UploadFile,
@@ -22,10 +38,57 @@ from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingRes
 from fastapi.staticfiles import StaticFiles
 from fastapi.testclient import TestClient
 
-from util.database.database import Database
+from util.cache import (
+    ActressIndex,
+    CacheStats,
+    EncodedBody,
+    LRUByteCache,
+    PrefixIndex,
+    apply_film_changes,
+)
+from util.database.async_database import AsyncDatabase
+from util.database.listener import HistoryListener
+from util.database.retention import DEFAULT_RETENTION_DAYS, HistoryRetention
+from util.image_variants import (
+    MEDIA_TYPES,
+    WIDTHS,
+    VariantCache,
+    VariantFormat,
+    available_formats,
+    negotiate_format,
+    render_variant,
+    snap_width,
+)
+from util.json_response import FastJSONResponse, dumps
 from util.models.actress_detail import ActressDetail
-from util.models.film import FilmNoBytes
+from util.models.film import FilmNoBytes, FilmState
+from util.models.film_changes import FilmChanges
+from util.models.film_page import FilmPage, FilmPageQuery, FilmSortKey
+from util.models.history import HistoryEvent
+from util.models.pool import PoolStats
 from util.models.rating import Rating
+from util.models.search import SearchCompletion
+from util.models.transcode import TranscodeQueue, TranscodeStatus
+from util.streaming import STREAM_MEDIA_TYPES, stream_directory
+from util.video import VideoFile, VideoResponse, parse_range
+
+MAX_IMAGE_BATCH = 1000  # uuids accepted by a single /get/images request
+
+IMAGE_BUNDLE_MEDIA_TYPE = "application/x-image-bundle"
+
+
+def bundle_images(images: list[tuple[UUID, bytes]]) -> bytes:
+    """
+    Packs images into a length-prefixed bundle. Each entry is the 16 bytes of the film uuid,
+    the length of the image as a big-endian unsigned 32-bit integer, then the image itself.
+    :param images: film uuid, image
+    :return:
+    """
+    parts = list()
+    for uuid, image in images:
+        parts.append(uuid.bytes + struct.pack(">I", len(image)))
+        parts.append(image)
+    return b"".join(parts)
 
 
 class StaticFileHandler(StaticFiles):
@@ -50,20 +113,102 @@ class StaticFileHandler(StaticFiles):
 
 
 class DatabaseReadCache:
-    def __init__(self) -> None:
+    def __init__(self, thumbnail_budget: int, poster_budget: int) -> None:
+        """
+        :param thumbnail_budget: memory budget of the thumbnail cache in bytes
+        :param poster_budget: memory budget of the poster cache in bytes
+        """
         self.films: list[FilmNoBytes] = list()
-        self.filmsStamp: UUID | None = None
-        self.images: dict[UUID, bytes] = dict()
+        self.filmsSeq = 0  # history entry the films list is up to date with
+        self.latestSeq: int | None = None  # latest history entry the cache is aware of
+        self.filmsBody: EncodedBody | None = None  # films, serialized and compressed
+        self.actresses = ActressIndex()  # of the films list, rebuilt with it
+        self.completions = PrefixIndex()  # of the films list, updated with it
+        self.filmsLock = asyncio.Lock()  # serializes reloads of the films list
+        self.thumbnails = LRUByteCache(max_bytes=thumbnail_budget)
+        self.posters = LRUByteCache(max_bytes=poster_budget)
+        # image store keys (thumbnail, poster) of each film; a few bytes per film, bounded by the library size.
+        self.imageKeys: dict[UUID, tuple[str | None, str | None]] = dict()
+        # video file of each film, so range requests don't look the film up.
+        self.videos: dict[UUID, VideoFile] = dict()
+
+    def invalidate_film(self, uuid: UUID) -> None:
+        """
+        Drops every cached image and the video file of a film.
+        :param uuid: uuid of the film record
+        """
+        self.thumbnails.invalidate(uuid)
+        self.posters.invalidate(uuid)
+        self.imageKeys.pop(uuid, None)
+        self.videos.pop(uuid, None)
+
+    def clear_images(self) -> None:
+        """
+        Drops every cached image and video file.
+        """
+        self.thumbnails.clear()
+        self.posters.clear()
+        self.imageKeys.clear()
+        self.videos.clear()
+
+    @classmethod
+    def from_env(cls) -> DatabaseReadCache:
+        """
+        Builds a DatabaseReadCache using the budgets in the local environment, or the defaults.
+        :return:
+        """
+        return DatabaseReadCache(
+            thumbnail_budget=int(
+                os.environ.get("APP_THUMBNAIL_CACHE_BYTES", 64 * 1024 * 1024)
+            ),
+            poster_budget=int(
+                os.environ.get("APP_POSTER_CACHE_BYTES", 128 * 1024 * 1024)
+            ),
+        )
 
 
 class Server:
-    def __init__(self, host: str, port: int, db: Database | None = None):
-        self.app = FastAPI()
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        db: AsyncDatabase | None = None,
+        listen: bool = True,
+    ):
+        """
+        :param host:
+        :param port:
+        :param db: the pool is opened on startup and closed on shutdown.
+        :param listen: push cache invalidations from the database on startup.
+        If False, or while the listener is disconnected, the latest history entry is polled on every request.
+        """
+        self.app = FastAPI(lifespan=self.lifespan)
         self.router = APIRouter(prefix="/api")
         self.host = host
         self.port = port
-        self.db = Database.from_env(load_dot_env=True) if not db else db
-        self.cache = DatabaseReadCache()
+        self.db = AsyncDatabase.from_env(load_dot_env=True) if not db else db
+        self.cache = DatabaseReadCache.from_env()
+        self.variants = VariantCache.from_env()
+        self.variantPool: ProcessPoolExecutor | None = None
+        self.rendering: dict[tuple[str, int, str], asyncio.Future[Path]] = dict()
+        self.listener = (
+            HistoryListener(
+                self.db.conninfo,
+                on_event=self.on_history_event,
+                on_connect=self.synchronize_cache,
+            )
+            if listen
+            else None
+        )
+        # history entries are kept for APP_HISTORY_RETENTION_DAYS; 0 keeps them forever.
+        retention_days = float(
+            os.environ.get("APP_HISTORY_RETENTION_DAYS", DEFAULT_RETENTION_DAYS)
+        )
+        self.retention = (
+            HistoryRetention(self.db, retention=retention_days * 86400)
+            if retention_days
+            else None
+        )
         self.configure_routes()
         self.media_path = Path(os.environ["APP_FILM_PATH"])
         assert self.media_path.exists()  # provided path doesnt exist
@@ -73,7 +218,32 @@ class Server:
         #     "/", StaticFileHandler(directory="./server/build", html=True), name="static"
         # )
 
+    @asynccontextmanager
+    async def lifespan(self, _: FastAPI) -> AsyncIterator[None]:
+        await self.db.open()
+        if not available_formats():
+            logging.warning("Pillow is not installed, images are served as stored.")
+        self.variantPool = ProcessPoolExecutor(
+            max_workers=int(os.environ.get("APP_IMAGE_VARIANT_WORKERS", 0))
+            or os.cpu_count()
+        )
+        if self.listener is not None:
+            await self.listener.start()
+        if self.retention is not None:
+            await self.retention.start()
+        yield
+        if self.retention is not None:
+            await self.retention.stop()
+        if self.listener is not None:
+            await self.listener.stop()
+        self.variantPool.shutdown(cancel_futures=True)
+        await self.db.close()
+
     def test_client(self) -> TestClient:
+        """
+        The client must be used as a context manager for the database pool to be opened.
+        :return:
+        """
         return TestClient(self.app)
 
     def configure_routes(self) -> None:
@@ -81,6 +251,24 @@ class Server:
             "/get/films",
             self.get_all_films,
             methods=["GET"],
+            response_model=list[FilmNoBytes],
+            responses={304: {"description": "film list not modified"}},
+        )
+        self.router.add_api_route(
+            "/get/films/changes",
+            self.get_film_changes,
+            methods=["GET"],
+            response_model=FilmChanges,
+            response_class=FastJSONResponse,
+            responses={410: {"description": "history trimmed since the entry"}},
+        )
+        self.router.add_api_route(
+            "/get/films/page",
+            self.get_films_page,
+            methods=["GET"],
+            response_model=FilmPage,
+            response_class=FastJSONResponse,
+            responses={400: {"description": "invalid cursor"}},
         )
         self.router.add_api_route(
             "/get/film",
@@ -94,6 +282,16 @@ class Server:
             methods=["GET"],
             responses={404: {"description": "film not found"}},
         )
+        self.router.add_api_route(
+            "/get/images",
+            self.get_images,
+            methods=["POST"],
+            response_class=Response,
+            responses={
+                200: {"content": {IMAGE_BUNDLE_MEDIA_TYPE: {}}},
+                400: {"description": "too many images"},
+            },
+        )
         self.router.add_api_route(
             "/set/rating",
             self.set_rating,
@@ -118,10 +316,62 @@ class Server:
             "/get/video",
             self.serve_video,
             methods=["GET"],
-            responses={404: {"description": "film not found"}},
+            response_class=Response,
+            responses={
+                206: {"description": "partial content"},
+                404: {"description": "film not found"},
+                416: {"description": "range not satisfiable"},
+                501: {"description": "file not found"},
+            },
+        )
+        self.router.add_api_route(
+            "/get/stream/{uuid}/{name:path}",
+            self.serve_stream,
+            methods=["GET"],
+            responses={
+                404: {"description": "film not found, or stream not found"},
+            },
+        )
+        self.router.add_api_route(
+            "/get/actress_detail",
+            self.get_actress_detail,
+            methods=["GET"],
+            response_model=ActressDetail,
+            response_class=FastJSONResponse,
+        )
+        self.router.add_api_route(
+            "/get/actress_counts", self.get_actress_counts, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/get/search",
+            self.search_films,
+            methods=["GET"],
+            response_model=list[FilmNoBytes],
+            response_class=FastJSONResponse,
+        )
+        self.router.add_api_route(
+            "/get/search/complete", self.complete_search, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/get/cache_stats", self.get_cache_stats, methods=["GET"]
         )
         self.router.add_api_route(
-            "/get/actress_detail", self.get_actress_detail, methods=["GET"]
+            "/get/pool_stats", self.get_pool_stats, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/get/transcode/queue", self.get_transcode_queue, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/set/transcode/retry",
+            self.retry_transcode,
+            methods=["POST"],
+            responses={404: {"description": "no failed transcode of the film"}},
+        )
+        self.router.add_api_route(
+            "/get/transcode/status",
+            self.get_transcode_status,
+            methods=["GET"],
+            responses={404: {"description": "film not found"}},
         )
 
     def run(self) -> Server:  # pragma: no cover
@@ -129,88 +379,429 @@ class Server:
         uvicorn.run(self.app, host=self.host, port=self.port)
         return self
 
-    def get_all_films(self) -> list[FilmNoBytes]:
-        if (latestStamp := self.db.get_latest_commit_uuid()) != self.cache.filmsStamp:
-            self.cache.filmsStamp, self.cache.films = (
-                latestStamp,
-                self.db.get_all_films(),
+    async def get_all_films(
+        self,
+        if_none_match: Optional[str] = Header(None),
+        accept_encoding: Optional[str] = Header(None),
+    ) -> Response:
+        if self.listener is None or not self.listener.connected:
+            await self.synchronize_cache()  # no push invalidation; fall back to polling.
+        body = await self.refresh_films()
+        headers = {
+            "ETag": body.etag,
+            "Cache-Control": "no-cache",  # always revalidate, the ETag makes it cheap.
+            "Vary": "Accept-Encoding",
+            "History-Seq": str(self.cache.filmsSeq),  # see get_film_changes
+        }
+        if body.matches(if_none_match):
+            return Response(status_code=304, headers=headers)
+        content, encoding = body.negotiate(accept_encoding)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(content, media_type="application/json", headers=headers)
+
+    async def refresh_films(self) -> EncodedBody:
+        """
+        Brings the films list up to date if the cache is behind the latest history entry, then serializes and
+        compresses it and indexes its actresses and completions once for every following request.
+        Once loaded, the list is only updated with the films changed since, unless the history was trimmed.
+        :return: the encoded films list
+        """
+        async with self.cache.filmsLock:
+            latestSeq = self.cache.latestSeq or 0
+            if self.cache.filmsBody is None or latestSeq > self.cache.filmsSeq:
+                changes = None
+                if self.cache.filmsBody is not None:
+                    try:
+                        changes = await self.db.get_film_changes(self.cache.filmsSeq)
+                    except ValueError:
+                        logging.info("History trimmed, reloading the films list.")
+                if changes is None:
+                    filmsSeq = await self.db.get_history_seq()
+                    films = await self.db.get_all_films()
+                else:
+                    filmsSeq = changes.seq
+                    films = apply_film_changes(self.cache.films, changes)
+
+                def prepare() -> tuple[EncodedBody, ActressIndex]:
+                    self.cache.completions.update(films)
+                    return (
+                        EncodedBody.encode(
+                            dumps(films),
+                            etag=f'W/"{filmsSeq}"',
+                        ),
+                        ActressIndex(films),
+                    )
+
+                body, actresses = await asyncio.to_thread(prepare)
+                self.cache.filmsBody, self.cache.actresses = body, actresses
+                self.cache.filmsSeq, self.cache.films = filmsSeq, films
+            return self.cache.filmsBody
+
+    async def get_film_changes(self, since: int = Query(..., ge=0)) -> Response:
+        """
+        Films inserted, updated or deleted since a history entry, to update a films list with rather than
+        download it again. Start from the History-Seq header of /get/films, then from the seq of the previous
+        changes.
+        """
+        try:
+            return FastJSONResponse(await self.db.get_film_changes(since))
+        except ValueError:
+            raise HTTPException(
+                status_code=410, detail="history trimmed, load the films list again"
+            )
+
+    async def get_films_page(
+        self,
+        limit: int = Query(50, ge=1, le=500),
+        cursor: Optional[str] = Query(None),
+        sort: FilmSortKey = Query("date_added"),
+        descending: bool = Query(True),
+        state: Optional[FilmState] = Query(None),
+        watched: Optional[bool] = Query(None),
+        actress: Optional[str] = Query(None),
+        date_from: Optional[date] = Query(None),
+        date_to: Optional[date] = Query(None),
+        min_average: Optional[float] = Query(None, ge=0, le=10),
+    ) -> Response:
+        try:
+            page = await self.db.get_films_page(
+                FilmPageQuery(
+                    limit=limit,
+                    cursor=cursor,
+                    sort=sort,
+                    descending=descending,
+                    state=state,
+                    watched=watched,
+                    actress=actress,
+                    date_from=date_from,
+                    date_to=date_to,
+                    min_average=min_average,
+                )
             )
-        return self.cache.films
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        return FastJSONResponse(page)
 
-    def get_single_film(self, uuid: UUID = Query(...)) -> FilmNoBytes:
-        if retrievedEntry := self.db.get_single_film(uuid):
+    async def synchronize_cache(self) -> None:
+        """
+        Polls the latest history entry and drops the cached images of every film updated or deleted since the
+        entry the cache was last synchronized with. Without a previous entry, or if the history since was
+        trimmed, all images are dropped.
+        """
+        latestSeq = await self.db.get_history_seq()
+        if latestSeq == self.cache.latestSeq:
+            return
+        if self.cache.latestSeq is None:
+            self.cache.clear_images()
+        else:
+            try:
+                changed = await self.db.get_changed_films_since(self.cache.latestSeq)
+            except ValueError:
+                self.cache.clear_images()
+            else:
+                for uuid in changed:
+                    self.cache.invalidate_film(uuid)
+        self.cache.latestSeq = latestSeq
+
+    def on_history_event(self, event: HistoryEvent) -> None:
+        """
+        Called by the history listener for every committed change.
+        :param event:
+        """
+        if (
+            event.table_name == "film"
+            and event.action in ("update", "delete")
+            and event.record_uuid is not None
+        ):
+            self.cache.invalidate_film(event.record_uuid)
+        # a poll may have read a later entry than the notification, which was queued before it.
+        self.cache.latestSeq = max(self.cache.latestSeq or 0, event.seq)
+
+    async def get_single_film(self, uuid: UUID = Query(...)) -> FilmNoBytes:
+        if retrievedEntry := await self.db.get_single_film(uuid):
             return retrievedEntry
         raise HTTPException(status_code=404, detail="film not found")
 
-    def get_image(
+    async def get_image(
         self,
         uuid: UUID = Query(...),
         image_type: Literal["THUMBNAIL", "POSTER"] = Query(...),
+        width: Optional[int] = Query(None, gt=0),
+        format: Optional[VariantFormat] = Query(None),
+        accept: Optional[str] = Header(None),
     ) -> Response:
-        image: bytes | None = None
-        if (
-            image_type == "THUMBNAIL"
-        ):  # thumbnail is retrieved from cache, poster is not.
-            image = self.cache.images.get(uuid, None)
-            if image is None:
-                pulled_image: bytes | None = self.db.get_thumbnail(uuid)
-                if pulled_image is None:
+        """
+        Returns the image as stored, or a resized and re-encoded variant of it if a width or format is given.
+        Without a format, the variant is encoded in the most compact format of the Accept header.
+        """
+        source = await self.load_image(uuid, image_type)
+        if (width is None and format is None) or not available_formats():
+            if isinstance(source, Path):
+                # served from the file; the image is never copied through python.
+                return FileResponse(source, media_type="image/png")
+            return Response(source, media_type="image/png")
+
+        headers = {"Vary": "Accept"} if format is None else {}
+        format = format or negotiate_format(accept)
+        width = snap_width(width or WIDTHS[-1])
+        # images in the store are keyed by their sha256 digest already.
+        digest = (
+            source.name if isinstance(source, Path) else VariantCache.digest(source)
+        )
+        if (path := self.variants.get(digest, width, format)) is None:
+            key = (digest, width, format)
+            if (task := self.rendering.get(key)) is None:
+                # concurrent requests for the same variant share one render.
+                task = asyncio.ensure_future(
+                    self.render_variant(source, digest, width, format)
+                )
+                self.rendering[key] = task
+                task.add_done_callback(lambda _: self.rendering.pop(key, None))
+            try:
+                path = await asyncio.shield(task)
+            except OSError:
+                logging.warning(f"Image of film {uuid} cannot be resized.")
+                return Response(
+                    source.read_bytes() if isinstance(source, Path) else source,
+                    media_type="image/png",
+                )
+        return FileResponse(path, media_type=MEDIA_TYPES[format], headers=headers)
+
+    async def load_image(
+        self, uuid: UUID, image_type: Literal["THUMBNAIL", "POSTER"]
+    ) -> bytes | Path:
+        """
+        Finds an image in the memory cache, the image store, or the film record.
+        :param uuid: uuid of the film record
+        :param image_type:
+        :return: the image, or its path if it is in the image store.
+        :raises HTTPException: 404 if the film is not found
+        """
+        pull: Callable[[UUID], Awaitable[bytes | None]]
+        if image_type == "THUMBNAIL":
+            cache, pull = self.cache.thumbnails, self.db.get_thumbnail
+        else:
+            cache, pull = self.cache.posters, self.db.get_poster
+
+        if (image := cache.get(uuid)) is not None:
+            return image
+
+        fresh = False
+        while True:
+            if fresh or (keys := self.cache.imageKeys.get(uuid)) is None:
+                if (keys := await self.db.get_image_keys(uuid)) is None:
                     raise HTTPException(404, "film not found")
-                image = pulled_image
-                self.cache.images[uuid] = image
+                self.cache.imageKeys[uuid] = keys
+                fresh = True
+            key = keys[0] if image_type == "THUMBNAIL" else keys[1]
+            if key is not None and (path := self.db.image_store.path(key)) is not None:
+                return path
 
-        if image_type == "POSTER":
-            pulled_image = self.db.get_poster(uuid)
-            if pulled_image is None:
+            # legacy: the image is kept in the film record.
+            if (image := await pull(uuid)) is not None:
+                cache.put(uuid, image)
+                return image
+            if fresh:
                 raise HTTPException(404, "film not found")
-            image = pulled_image
+            fresh = True  # the cached keys may predate a migration of the film
 
-        return Response(image, media_type="image/png")
+    async def render_variant(
+        self, source: bytes | Path, digest: str, width: int, format: VariantFormat
+    ) -> Path:
+        """
+        Renders a variant in the process pool and stores it in the variant cache.
+        :return: path of the variant
+        """
+        assert self.variantPool is not None  # created on startup
+        variant = await asyncio.get_running_loop().run_in_executor(
+            self.variantPool, render_variant, source, width, format
+        )
+        return await asyncio.to_thread(
+            self.variants.put, digest, width, format, variant
+        )
 
-    def set_rating(self, rating: Annotated[Rating, Body(embed=True)]) -> Response:
+    async def get_images(
+        self,
+        uuids: Annotated[list[UUID], Body(embed=True)],
+        image_type: Literal["THUMBNAIL", "POSTER"] = Query(...),
+    ) -> Response:
+        """
+        Returns the images of many films in one bundle (see bundle_images), in the order requested.
+        Films that are not found are left out of the bundle.
+        """
+        if len(uuids) > MAX_IMAGE_BATCH:
+            raise HTTPException(400, "too many images")
+        pull: Callable[[list[UUID]], Awaitable[dict[UUID, bytes]]]
+        if image_type == "THUMBNAIL":
+            cache, pull = self.cache.thumbnails, self.db.get_thumbnails
+        else:
+            cache, pull = self.cache.posters, self.db.get_posters
+
+        images = {
+            uuid: image for uuid in uuids if (image := cache.get(uuid)) is not None
+        }
+        if misses := [uuid for uuid in uuids if uuid not in images]:
+            pulled = await pull(misses)
+            for uuid, image in pulled.items():
+                cache.put(uuid, image)
+            images.update(pulled)
+        bundle = bundle_images(
+            [(uuid, images[uuid]) for uuid in dict.fromkeys(uuids) if uuid in images]
+        )
+        return Response(bundle, media_type=IMAGE_BUNDLE_MEDIA_TYPE)
+
+    async def set_rating(self, rating: Annotated[Rating, Body(embed=True)]) -> Response:
         try:
-            self.db.update_rating(rating)
+            await self.db.update_rating(rating)
             return Response(status_code=200)
         except ValueError:
             raise HTTPException(status_code=404, detail="rating not found")
 
-    def delete_film(self, uuid: UUID = Query(...)) -> Response:
-        self.db.delete_film(uuid=uuid)
+    async def delete_film(self, uuid: UUID = Query(...)) -> Response:
+        await self.db.delete_film(uuid=uuid)
+        self.cache.invalidate_film(uuid)
         return Response(status_code=200)
 
-    def set_watch_status(
+    async def set_watch_status(
         self, watch_status: bool = Query(...), uuid: UUID = Query(...)
     ) -> Response:
-        film = self.db.get_single_film(uuid)
+        film = await self.db.get_single_film(uuid)
         if not film:
             raise HTTPException(status_code=404, detail="film not found")
         film.watched = watch_status
-        self.db.update_film(film)
+        await self.db.update_film(film)
         return Response(status_code=200)
 
-    def get_actress_list(self) -> list[str]:
-        return self.db.get_actress_list()
+    async def refresh_indexes(self) -> None:
+        """
+        Brings the films list up to date with the history, and with it the actress and completion indexes.
+        """
+        if self.listener is None or not self.listener.connected:
+            await self.synchronize_cache()  # no push invalidation; fall back to polling.
+        await self.refresh_films()
+
+    async def get_actress_list(self) -> list[str]:
+        await self.refresh_indexes()
+        return self.cache.actresses.names()
+
+    async def get_actress_counts(self) -> dict[str, int]:
+        await self.refresh_indexes()
+        return self.cache.actresses.counts()
 
-    def get_actress_detail(self, name: str = Query(...)) -> ActressDetail:
-        return self.db.get_actress_detail(name)
+    async def get_actress_detail(self, name: str = Query(...)) -> Response:
+        await self.refresh_indexes()
+        return FastJSONResponse(
+            ActressDetail(name=name, films=self.cache.actresses.films(name))
+        )
+
+    async def search_films(
+        self,
+        q: str = Query(..., min_length=1, max_length=200),
+        limit: int = Query(20, ge=1, le=100),
+    ) -> Response:
+        return FastJSONResponse(await self.db.search_films(q, limit))
+
+    async def complete_search(
+        self,
+        prefix: str = Query(..., max_length=200),
+        limit: int = Query(10, ge=1, le=50),
+    ) -> list[SearchCompletion]:
+        """
+        Completes the titles and actresses as they are typed, from memory.
+        """
+        await self.refresh_indexes()
+        # the index is updated in a worker thread: read it in one too, so the loop never waits on its lock
+        return await asyncio.to_thread(self.cache.completions.complete, prefix, limit)
+
+    async def get_cache_stats(self) -> dict[str, CacheStats]:
+        return {
+            "thumbnails": self.cache.thumbnails.stats(),
+            "posters": self.cache.posters.stats(),
+        }
+
+    async def get_pool_stats(self) -> PoolStats:
+        return await self.db.get_pool_stats()
+
+    async def get_transcode_queue(
+        self, limit: int = Query(100, ge=0, le=1000)
+    ) -> TranscodeQueue:
+        return await self.db.get_transcode_queue(limit)
+
+    async def retry_transcode(self, uuid: UUID = Query(...)) -> Response:
+        """
+        Puts a film whose transcode failed back in the queue.
+        """
+        if not await self.db.retry_transcode(uuid):
+            raise HTTPException(
+                status_code=404, detail="no failed transcode of the film"
+            )
+        return Response(status_code=200)
+
+    async def get_transcode_status(self, uuid: UUID = Query(...)) -> TranscodeStatus:
+        if status := await self.db.get_transcode_status(uuid):
+            return status
+        raise HTTPException(status_code=404, detail="film not found")
+
+    async def serve_video(
+        self,
+        uuid: UUID = Query(...),
+        filename: Optional[str] = Query(None),
+        range: Optional[str] = Header(None),
+        if_range: Optional[str] = Header(None),
+    ) -> Response:
+        # use filename optional arg to skip the lookup of the film.
+        path = self.media_path / filename if filename else await self.film_path(uuid)
+        try:
+            file = await anyio.open_file(path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            self.cache.videos.pop(uuid, None)
+            raise HTTPException(status_code=501, detail="file not found")
+        # the open file is authoritative; it may have been replaced since it was cached.
+        video = VideoFile.from_stat(path, os.fstat(file.wrapped.fileno()))
+        if not filename:
+            self.cache.videos[uuid] = video
 
-    def serve_video(
-        self, uuid: UUID = Query(...), filename: Optional[str] = Query(None)
-    ) -> FileResponse:
         try:
-            # use filename optional arg to optimize and reduce database calls.
-            # if filename is not present, use database calls
-            # get_single_film returns a FilmNoBytes which "can" be None, in which case there will be a AttributeError.
-            # type ignored as the attribute error is handled.
-            file_path = self.media_path / self.db.get_single_film(uuid).filename if not filename else self.media_path / filename  # type: ignore
-            if not file_path.exists():
-                raise HTTPException(status_code=501, detail="file not found")
-            return FileResponse(
-                file_path, media_type="video/mp4", headers={"Accept-Ranges": "bytes"}
+            ranges = (
+                parse_range(range, video.size)
+                if if_range in (None, video.etag, video.last_modified)
+                else None  # the client's copy is outdated; send the whole file.
             )
-        except* (AttributeError, TypeError) as e:
-            # attribute error if film not found, type error if film not found and filename is none
+        except ValueError:
+            await file.aclose()
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{video.size}"}
+            )
+        return VideoResponse(file, video, ranges)
+
+    async def serve_stream(self, uuid: UUID, name: str) -> FileResponse:
+        """
+        Serves the manifests and segments of the adaptive-bitrate renditions of a film.
+        Players start from /get/stream/{uuid}/manifest.mpd (DASH) or /get/stream/{uuid}/master.m3u8 (HLS);
+        every other file is referenced relative to the manifest.
+        """
+        directory = stream_directory(await self.film_path(uuid))
+        path = directory / name
+        if (
+            path.suffix not in STREAM_MEDIA_TYPES
+            or not path.resolve().is_relative_to(directory.resolve())
+            or not path.is_file()
+        ):
+            raise HTTPException(status_code=404, detail="stream not found")
+        return FileResponse(path, media_type=STREAM_MEDIA_TYPES[path.suffix])
+
+    async def film_path(self, uuid: UUID) -> Path:
+        """
+        :param uuid: uuid of the film record
+        :return: path of the film file
+        :raises HTTPException: 404 if the film is not found
+        """
+        if (cached := self.cache.videos.get(uuid)) is not None:
+            return cached.path
+        if (filename := await self.db.get_filename(uuid)) is None:
             raise HTTPException(status_code=404, detail="film not found")
+        return self.media_path / filename
 
     def serve_root(self, *_: tuple[Any]) -> HTMLResponse:
         return NotImplemented
@@ -0,0 +1,193 @@
+import datetime
+import gzip
+from uuid import uuid4
+
+import pytest
+
+from util.cache import (
+    ActressIndex,
+    EncodedBody,
+    LRUByteCache,
+    PrefixIndex,
+    apply_film_changes,
+)
+from util.models.film import FilmNoBytes, FilmState
+from util.models.film_changes import FilmChanges
+from util.models.search import SearchCompletion
+
+
+def test_lru_cache_hit_and_miss() -> None:
+    cache = LRUByteCache(max_bytes=16)
+    assert cache.get("missing") is None
+    cache.put("key", b"value")
+    assert cache.get("key") == b"value"
+    stats = cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    assert stats.entries == 1
+    assert stats.size_bytes == len(b"value")
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    cache = LRUByteCache(max_bytes=10)
+    cache.put("one", b"aaaa")
+    cache.put("two", b"bbbb")
+    cache.get("one")  # "two" is now the least recently used
+    cache.put("three", b"cccc")
+    assert "one" in cache
+    assert "two" not in cache
+    assert "three" in cache
+    assert cache.stats().evictions == 1
+    assert cache.size_bytes <= cache.max_bytes
+
+
+def test_lru_cache_replaces_existing_key() -> None:
+    cache = LRUByteCache(max_bytes=10)
+    cache.put("key", b"aaaa")
+    cache.put("key", b"bbbbbb")
+    assert cache.get("key") == b"bbbbbb"
+    assert cache.size_bytes == 6
+    assert len(cache) == 1
+
+
+def test_lru_cache_rejects_oversized_value() -> None:
+    cache = LRUByteCache(max_bytes=4)
+    cache.put("small", b"aa")
+    cache.put("large", b"aaaaaaaa")
+    assert "large" not in cache
+    assert "small" in cache
+    assert not LRUByteCache(max_bytes=0).get("key")
+    with pytest.raises(ValueError):
+        LRUByteCache(max_bytes=-1)
+
+
+def test_lru_cache_invalidate_and_clear() -> None:
+    cache = LRUByteCache(max_bytes=32)
+    cache.put("one", b"aaaa")
+    cache.put("two", b"bbbb")
+    cache.invalidate("one")
+    cache.invalidate("not cached")
+    assert "one" not in cache
+    assert cache.size_bytes == 4
+    cache.clear()
+    assert not len(cache)
+    assert cache.size_bytes == 0
+    assert cache.stats().invalidations == 2
+
+
+def test_encoded_body_negotiation() -> None:
+    body = EncodedBody.encode(b'{"films": []}' * 100, etag='W/"stamp"')
+    assert body.negotiate(None) == (body.identity, None)
+    assert body.negotiate("gzip, deflate") == (body.gzip, "gzip")
+    assert body.negotiate("gzip;q=0") == (body.identity, None)
+    assert body.negotiate("gzip;q=0.0") == (body.identity, None)
+    assert body.negotiate("GZIP; level=1; q=0.5") == (body.gzip, "gzip")
+    assert body.negotiate("br; q=0.00, gzip;q=0.1") == (body.gzip, "gzip")
+    assert body.negotiate("gzip;q=high") == (body.identity, None)
+    assert gzip.decompress(body.gzip) == body.identity
+    if body.br is not None:
+        assert body.negotiate("gzip, br") == (body.br, "br")
+
+
+def test_encoded_body_matches() -> None:
+    body = EncodedBody.encode(b"[]", etag='W/"stamp"')
+    assert body.matches('W/"stamp"')
+    assert body.matches('"stamp"')
+    assert body.matches('W/"other", W/"stamp"')
+    assert body.matches("*")
+    assert not body.matches('W/"other"')
+    assert not body.matches(None)
+
+
+def make_film(title: str, actresses: list[str]) -> FilmNoBytes:
+    return FilmNoBytes(
+        uuid=uuid4(),
+        title=title,
+        date_added=datetime.datetime.now(),
+        filename=title,
+        watched=False,
+        state=FilmState.COMPLETE,
+        rating=None,  # type: ignore[arg-type]
+        actresses=actresses,
+    )
+
+
+def test_actress_index() -> None:
+    films = [
+        make_film(f"film {i}", actresses)
+        for i, actresses in enumerate([["b", "a"], ["a", "a"], []])
+    ]
+    index = ActressIndex(films)
+    assert len(index) == 2
+    assert index.names() == ["a", "b"]
+    assert index.counts() == {"a": 2, "b": 1}
+    assert index.films("a") == films[:2]
+    assert index.films("c") == []
+    assert ActressIndex().counts() == {}
+
+
+def test_apply_film_changes() -> None:
+    films = [make_film(f"film {i}", []) for i in range(3)]
+    updated = make_film("film 1, renamed", [])
+    updated.uuid = films[1].uuid
+    inserted = make_film("film 3", [])
+    changes = FilmChanges(
+        seq=7, upserted=[inserted, updated], deleted=[films[0].uuid, uuid4()]  # type: ignore[list-item]
+    )
+    assert apply_film_changes(films, changes) == [updated, films[2], inserted]
+    assert [i.title for i in films] == ["film 0", "film 1", "film 2"]
+    assert (
+        apply_film_changes(films, FilmChanges(seq=7, upserted=[], deleted=[])) == films
+    )
+
+
+def test_prefix_index() -> None:
+    films = [
+        make_film("Big Red Car", ["Jane O'Brien"]),
+        make_film("Redwood", ["Jane O'Brien"]),
+        make_film("Blue Boat", []),
+    ]
+    index = PrefixIndex()
+    assert index.update(films) == 3
+    assert index.complete("red", 10) == [
+        SearchCompletion(text="Big Red Car", field="title", films=1),
+        SearchCompletion(text="Redwood", field="title", films=1),
+    ]
+    assert index.complete("  o'BRI", 10) == [
+        SearchCompletion(text="Jane O'Brien", field="actress", films=2)
+    ]
+    assert [i.text for i in index.complete("b", 10)] == [
+        "Big Red Car",
+        "Blue Boat",
+        "Jane O'Brien",
+    ]
+    assert len(index.complete("b", 2)) == 2
+    assert index.complete("", 10) == index.complete("zzz", 10) == []
+
+    # only the films that changed are re-indexed.
+    assert index.update(films) == 0
+    films[1].title = "Blackwood"
+    films[2].actresses = ["Ann"]
+    assert index.update(films[1:]) == 3
+    assert [i.text for i in index.complete("b", 10)] == [
+        "Blackwood",
+        "Blue Boat",
+        "Jane O'Brien",
+    ]
+    assert index.complete("jane", 10)[0].films == 1
+    assert index.complete("ann", 10)[0].field == "actress"
+    assert index.complete("red", 10) == []
+    assert len(index) == 2
+
+
+def test_prefix_index_bulk_update() -> None:
+    films = [make_film(f"film {i:04d}", [f"actress {i % 7}"]) for i in range(1000)]
+    index = PrefixIndex()
+    index.update(films)
+    for film in films[::2]:
+        film.title = film.title.replace("film", "movie")
+    index.update(films[:900])
+    assert len(index.complete("film", 1000)) == 450
+    assert len(index.complete("movie", 1000)) == 450
+    assert len(index.complete("actress", 10)) == 7
+    assert index.complete("0999", 10) == []
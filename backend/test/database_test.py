@@ -1,15 +1,30 @@
+import asyncio
+import base64
 import copy
+import dataclasses
+import inspect
+import json
 from datetime import date, datetime, timedelta
 from pathlib import Path
 from typing import Generator
 from uuid import uuid4
 
 import docker
+import psycopg
 import pytest
 
+from util.database.async_database import AsyncDatabase
 from util.database.database import Database
+from util.database.import_films import read_manifest
+from util.database.listener import HistoryListener
+from util.database.retention import HistoryRetention
+from util.image_store import LocalImageStore, PostgresImageStore
 from util.models.actress_detail import ActressDetail
 from util.models.film import Film, FilmNoBytes, FilmState
+from util.models.film_changes import FilmChanges
+from util.models.film_page import FilmPageQuery
+from util.models.history import HistoryEvent
+from util.models.rating import Rating
 
 
 @pytest.fixture(scope="module")
@@ -305,3 +320,441 @@ def test_get_not_transcoded_and_set_transcoding(mock_db: Database) -> None:
         assert result_exists
         assert result_exists.state == FilmState.TRANSCODING
     assert mock_db.get_not_transcoded_and_set_transcoding() is None
+
+
+@pytest.mark.order(120)
+def test_get_changed_films_since(mock_db: Database) -> None:
+    film = mock_db.get_all_films()[0]
+    assert film.uuid
+    seq = mock_db.get_history_seq()
+    assert seq
+    assert film.uuid not in mock_db.get_changed_films_since(seq)
+    film.watched = not film.watched
+    mock_db.update_film(film)
+    assert film.uuid in mock_db.get_changed_films_since(seq)
+
+
+@pytest.mark.order(121)
+def test_history_listener(mock_db: Database) -> None:
+    events: list[HistoryEvent] = list()
+
+    async def on_connect() -> None:
+        pass
+
+    async def listen() -> HistoryListener:
+        listener = HistoryListener(
+            mock_db.conninfo, on_event=events.append, on_connect=on_connect
+        )
+        await listener.start()
+        try:
+            while not listener.connected:
+                await asyncio.sleep(0.05)
+            film = mock_db.get_all_films()[0]
+            assert film.uuid
+            await asyncio.to_thread(mock_db.delete_film, film.uuid)
+            while not events:
+                await asyncio.sleep(0.05)
+        finally:
+            await listener.stop()
+        return listener
+
+    listener = asyncio.run(asyncio.wait_for(listen(), timeout=10))
+    assert not listener.connected
+    assert events[0].table_name == "film"
+    assert events[0].action == "delete"
+    assert events[-1].uuid == mock_db.get_latest_commit_uuid()
+    assert events[-1].seq == mock_db.get_history_seq()
+
+
+@pytest.mark.order(122)
+def test_get_films_page_keyset(mock_db: Database) -> None:
+    films = mock_db.get_all_films()
+    assert len(films) > 3
+    for sort in ("date_added", "title", "average"):
+        for descending in (True, False):
+            seen = list()
+            cursor = None
+            while True:
+                page = mock_db.get_films_page(
+                    FilmPageQuery(
+                        limit=3, cursor=cursor, sort=sort, descending=descending  # type: ignore[arg-type]
+                    )
+                )
+                assert len(page.films) <= 3
+                seen.extend(film.uuid for film in page.films)
+                if (cursor := page.next_cursor) is None:
+                    break
+            assert len(seen) == len(set(seen))
+            assert set(seen) == {film.uuid for film in films}
+
+
+@pytest.mark.order(122)
+def test_get_films_page_filters(mock_db: Database) -> None:
+    films = mock_db.get_all_films()
+    page = mock_db.get_films_page(FilmPageQuery(limit=500, actress="three"))
+    assert len(page.films) == len(mock_db.get_actress_detail("three").films)
+    assert page.next_cursor is None
+    page = mock_db.get_films_page(FilmPageQuery(limit=500, state=FilmState.TRANSCODING))
+    assert len(page.films) == len(
+        [f for f in films if f.state == FilmState.TRANSCODING.value]
+    )
+    page = mock_db.get_films_page(FilmPageQuery(limit=500, watched=False))
+    assert len(page.films) == len([f for f in films if not f.watched])
+    assert not mock_db.get_films_page(FilmPageQuery(min_average=10)).films
+    today = datetime.now().date()
+    assert not mock_db.get_films_page(
+        FilmPageQuery(date_from=today + timedelta(days=1))
+    ).films
+    assert mock_db.get_films_page(FilmPageQuery(date_to=today)).films
+
+
+@pytest.mark.order(122)
+def test_get_films_page_invalid_cursor(mock_db: Database) -> None:
+    page = mock_db.get_films_page(FilmPageQuery(limit=1))
+    assert page.next_cursor
+    with pytest.raises(ValueError):
+        mock_db.get_films_page(FilmPageQuery(cursor="not a cursor"))
+    with pytest.raises(ValueError):
+        mock_db.get_films_page(FilmPageQuery(cursor=page.next_cursor, sort="title"))
+    uuid = str(uuid4())
+    for sort, value in (
+        ("title", 123),
+        ("date_added", 20240101),
+        ("date_added", "yesterday"),
+        ("average", "7.5"),
+        ("average", True),
+    ):
+        cursor = base64.urlsafe_b64encode(
+            json.dumps([sort, True, value, uuid]).encode()
+        ).decode()
+        with pytest.raises(ValueError):
+            mock_db.get_films_page(FilmPageQuery(cursor=cursor, sort=sort))  # type: ignore[arg-type]
+    cursor = base64.urlsafe_b64encode(json.dumps(["title", True, "a", 1]).encode())
+    with pytest.raises(ValueError):
+        mock_db.get_films_page(FilmPageQuery(cursor=cursor.decode(), sort="title"))
+
+
+@pytest.mark.order(122)
+def test_get_films_page_unset_averages(mock_db: Database) -> None:
+    films = mock_db.get_all_films()
+    unset = [film.rating.uuid for film in films[::2]]
+    with mock_db.pool.connection() as conn:
+        conn.execute("UPDATE rating SET average = NULL WHERE uuid = ANY(%s)", (unset,))
+    try:
+        for descending in (True, False):
+            seen = list()
+            cursor = None
+            while True:
+                page = mock_db.get_films_page(
+                    FilmPageQuery(
+                        limit=2, cursor=cursor, sort="average", descending=descending
+                    )
+                )
+                seen.extend(film.uuid for film in page.films)
+                if (cursor := page.next_cursor) is None:
+                    break
+            assert len(seen) == len(set(seen)) == len(films)
+    finally:
+        with mock_db.pool.connection() as conn:
+            # recomputed by the rating trigger
+            conn.execute(
+                "UPDATE rating SET story = story WHERE uuid = ANY(%s)", (unset,)
+            )
+
+
+@pytest.mark.order(122)
+def test_get_images_batch(mock_db: Database) -> None:
+    uuids = [film.uuid for film in mock_db.get_all_films()]
+    assert mock_db.get_thumbnails([]) == dict()
+    thumbnails = mock_db.get_thumbnails([*uuids, uuid4()])  # type: ignore[list-item]
+    assert set(thumbnails) == set(uuids)
+    assert set(thumbnails.values()) == {b"thumbnail"}
+    assert set(mock_db.get_posters(uuids).values()) == {b"poster"}  # type: ignore[arg-type]
+
+
+@pytest.mark.order(123)
+def test_migrate_image_batch(mock_db: Database, tmp_path: Path) -> None:
+    films = mock_db.get_all_films()
+    assert films[0].uuid
+    assert mock_db.get_image_keys(films[0].uuid) == (None, None)
+    assert mock_db.get_image_keys(uuid4()) is None
+    store = LocalImageStore(tmp_path)
+    migrated = 0
+    while count := mock_db.migrate_image_batch(store, batch_size=3):
+        assert count <= 3
+        migrated += count
+    assert migrated == len(films)
+    for film in films:
+        assert film.uuid
+        assert mock_db.get_thumbnail(film.uuid) is None
+        thumbnail_key, poster_key = mock_db.get_image_keys(film.uuid)  # type: ignore[misc]
+        assert thumbnail_key and poster_key
+        assert store.path(thumbnail_key).read_bytes() == b"thumbnail"  # type: ignore[union-attr]
+        assert store.path(poster_key).read_bytes() == b"poster"  # type: ignore[union-attr]
+    assert not mock_db.migrate_image_batch(store, batch_size=3)
+    mock_db.image_store = store
+    try:
+        uuids = [film.uuid for film in films]
+        assert set(mock_db.get_posters(uuids).values()) == {b"poster"}  # type: ignore[arg-type]
+    finally:
+        mock_db.image_store = PostgresImageStore()
+
+
+@pytest.mark.order(124)
+def test_insert_film_into_image_store(mock_db: Database, tmp_path: Path) -> None:
+    mock_db.image_store = LocalImageStore(tmp_path)
+    try:
+        uuid = mock_db.insert_film(
+            Film(
+                uuid=None,
+                title="stored",
+                date_added=datetime.now(),
+                filename="stored.mp4",
+                watched=False,
+                state=FilmState.COMPLETE,
+                rating=None,
+                actresses=[],
+                thumbnail=b"stored thumbnail",
+                poster=b"stored poster",
+            )
+        )
+    finally:
+        mock_db.image_store = PostgresImageStore()
+    assert mock_db.get_poster(uuid) is None
+    keys = mock_db.get_image_keys(uuid)
+    assert keys and keys[1]
+    assert (tmp_path / keys[1][:2] / keys[1]).read_bytes() == b"stored poster"
+
+
+@pytest.mark.order(125)
+def test_search_films(mock_db: Database) -> None:
+    def search(text: str) -> list[str]:
+        return [film.title for film in mock_db.search_films(text)]
+
+    uuids = [
+        mock_db.insert_film(
+            Film(
+                uuid=None,
+                title=title,
+                date_added=datetime.now(),
+                filename=f"{title}.mp4",
+                watched=False,
+                state=FilmState.COMPLETE,
+                rating=None,
+                actresses=actresses,
+                thumbnail=None,
+                poster=None,
+            )
+        )
+        for title, actresses in (
+            ("Big Red Car", ["Jane O'Brien"]),
+            ("Redwood", []),
+            ("Blue Boat", ["Ann Carter"]),
+        )
+    ]
+    try:
+        assert sorted(search("red")) == ["Big Red Car", "Redwood"]
+        assert search("big re") == ["Big Red Car"]
+        assert search("o'bri") == ["Big Red Car"]  # actresses are searched too
+        assert sorted(search("car")) == ["Big Red Car", "Blue Boat"]  # Ann Carter
+        assert search(" ?! ") == []
+        assert len(mock_db.search_films("red", limit=1)) == 1
+        assert mock_db.fuzzy_search is not None
+        if mock_db.fuzzy_search:
+            assert "Blue Boat" in search("blu baot")  # misspelled
+    finally:
+        for uuid in uuids:
+            mock_db.delete_film(uuid)
+
+
+@pytest.mark.order(126)
+def test_insert_films(mock_db: Database, tmp_path: Path) -> None:
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "thumbnail.png").write_bytes(b"imported thumbnail")
+    lines = [
+        json.dumps(
+            {
+                "title": f"imported {i}",
+                "filename": f"imported {i}.mp4",
+                "actresses": ["importer"],
+                "date_added": "2024-01-02",
+                **({"thumbnail": "images/thumbnail.png"} if i % 2 else {}),
+            }
+        )
+        for i in range(7)
+    ]
+    (tmp_path / "manifest.jsonl").write_text("\n".join(lines) + "\n\n")
+    uuids = mock_db.insert_films(read_manifest(tmp_path / "manifest.jsonl"), 3)
+    try:
+        assert len(set(uuids)) == 7
+        films = [mock_db.get_single_film(uuid) for uuid in uuids]
+        assert [film.title for film in films] == [f"imported {i}" for i in range(7)]  # type: ignore[union-attr]
+        assert all(film.rating.uuid for film in films)  # type: ignore[union-attr]
+        assert films[0].date_added == date(2024, 1, 2)  # type: ignore[union-attr]
+        assert mock_db.get_thumbnail(uuids[0]) is None
+        assert mock_db.get_thumbnail(uuids[1]) == b"imported thumbnail"
+        assert mock_db.insert_films([]) == []
+    finally:
+        for uuid in uuids:
+            mock_db.delete_film(uuid)
+
+    (tmp_path / "manifest.jsonl").write_text(lines[0] + "\n{}\n")
+    with pytest.raises(ValueError, match="manifest.jsonl:2"):
+        mock_db.insert_films(read_manifest(tmp_path / "manifest.jsonl"))
+
+
+@pytest.mark.order(127)
+def test_pool_stats(mock_db: Database) -> None:
+    assert (mock_db.pool.min_size, mock_db.pool.max_size) == (5, 15)
+    assert mock_db.pool.reconnect_timeout == 15 * 15
+    before = mock_db.get_pool_stats()
+    for _ in range(3):
+        mock_db.get_latest_commit_uuid()
+    stats = mock_db.get_pool_stats()
+    assert stats.requests == before.requests + 3
+    assert stats.usage_ms >= before.usage_ms
+    assert (stats.min_size, stats.max_size) == (5, 15)
+    assert stats.size >= 5
+    assert stats.connection_errors == 0
+
+
+@pytest.mark.order(127)
+def test_film_row(mock_db: Database) -> None:
+    film = mock_db.get_all_films()[0]
+    assert film.uuid
+    rating = Rating(film.rating.uuid, 0.0, 1, 2, 3, 4, 5, 6, 7)
+    mock_db.update_rating(rating)
+    pulled = mock_db.get_single_film(film.uuid)
+    assert pulled
+    assert not hasattr(pulled, "__dict__") and not hasattr(pulled.rating, "__dict__")
+    assert isinstance(pulled.state, FilmState)
+    assert (pulled.title, pulled.actresses) == (film.title, film.actresses)
+    assert dataclasses.astuple(pulled.rating)[2:] == (1, 2, 3, 4, 5, 6, 7)
+    assert pulled.rating.average == pytest.approx(3.25)
+    for films in (
+        mock_db.get_all_films(),
+        mock_db.get_actress_detail(film.actresses[0]).films,
+        mock_db.get_films_page(FilmPageQuery(limit=100)).films,
+    ):
+        (same,) = [i for i in films if i.uuid == film.uuid]
+        assert same.rating == pulled.rating
+        assert same.state == pulled.state.value
+
+
+@pytest.mark.order(128)
+def test_get_film_changes(mock_db: Database) -> None:
+    def film(title: str) -> Film:
+        return Film(
+            uuid=None,
+            title=title,
+            date_added=datetime.now(),
+            filename=title,
+            watched=False,
+            state=FilmState.COMPLETE,
+            rating=None,
+            actresses=[],
+            thumbnail=None,
+            poster=None,
+        )
+
+    watched, rated, deleted = (
+        mock_db.insert_film(film(f"changes {i}")) for i in range(3)
+    )
+    seq = mock_db.get_history_seq()
+    assert mock_db.get_film_changes(seq) == FilmChanges(seq, [], [])
+    inserted = mock_db.insert_film(film("changes inserted"))
+    watched_film = mock_db.get_single_film(watched)
+    assert watched_film
+    watched_film.watched = True
+    mock_db.update_film(watched_film)
+    rating = mock_db.get_single_film(rated).rating  # type: ignore[union-attr]
+    rating.story = 7
+    mock_db.update_rating(rating)
+    mock_db.delete_film(deleted)
+    removed = mock_db.insert_film(film("changes removed"))  # inserted, then deleted
+    mock_db.delete_film(removed)
+    try:
+        changes = mock_db.get_film_changes(seq)
+        assert changes.seq == mock_db.get_history_seq() > seq
+        assert sorted(str(i.uuid) for i in changes.upserted) == sorted(
+            map(str, [inserted, watched, rated])
+        )
+        assert {str(i.uuid): i for i in changes.upserted}[str(watched)].watched
+        assert sorted(changes.deleted) == sorted([deleted, removed])
+        assert mock_db.get_film_changes(changes.seq) == FilmChanges(changes.seq, [], [])
+        assert len(mock_db.get_film_changes(0).upserted) == len(mock_db.get_all_films())
+    finally:
+        for uuid in (watched, rated, inserted):
+            mock_db.delete_film(uuid)
+
+
+@pytest.mark.order(129)
+def test_trim_history(mock_db: Database) -> None:
+    seq = mock_db.get_history_seq()
+    with mock_db.pool.connection() as conn:
+        count = conn.execute("SELECT count(*) FROM history").fetchone()[0]  # type: ignore[index]
+        conn.execute(
+            "UPDATE history SET timestamp = timestamp - interval '2 days' WHERE seq <= %s",
+            (seq - 2,),
+        )
+    day = timedelta(days=1).total_seconds()
+    assert mock_db.trim_history(day, batch_size=1) == 1
+    with pytest.raises(ValueError):
+        mock_db.get_film_changes(0)
+
+    async def trim() -> int:
+        db = AsyncDatabase(
+            db_name="ar-test-db",
+            db_user="ar-test-user",
+            db_password="ar-test-password",
+            db_host="localhost",
+            db_port="5298",
+            min_connections=1,
+            max_connections=2,
+            max_retries=15,
+            retry_interval=15,
+        )
+        await db.open()
+        try:
+            return await HistoryRetention(db, day, batch_size=2).trim()
+        finally:
+            await db.close()
+
+    assert asyncio.run(trim()) == count - 3  # the two latest entries are kept
+    with pytest.raises(ValueError):
+        mock_db.get_changed_films_since(seq - 3)
+    assert mock_db.get_film_changes(seq - 2).seq == mock_db.get_history_seq() == seq
+    assert mock_db.trim_history(day) == 0
+
+
+@pytest.mark.order(130)
+def test_history_writers_not_serialized(mock_db: Database) -> None:
+    first, second = mock_db.get_all_films()[:2]
+    seq = mock_db.get_history_seq()
+    toggle = "UPDATE film SET watched = NOT watched WHERE uuid = %s"
+    with psycopg.connect(mock_db.conninfo) as slow, psycopg.connect(
+        mock_db.conninfo, autocommit=True
+    ) as fast:
+        slow.execute(toggle, (first.uuid,))  # its transaction stays open
+        fast.execute("SET lock_timeout = '2s'")
+        fast.execute(toggle, (second.uuid,))  # commits without waiting for it
+        assert mock_db.get_history_seq() == seq + 1
+        slow.commit()
+    assert mock_db.get_history_seq() == seq + 2
+    with mock_db.pool.connection() as conn:
+        entries = conn.execute(
+            "SELECT seq, record_uuid FROM history WHERE seq > %s ORDER BY seq", (seq,)
+        ).fetchall()
+        # numbered in commit order
+        assert entries == [(seq + 1, second.uuid), (seq + 2, first.uuid)]
+        conn.execute(toggle.replace("= %s", "= ANY(%s)"), ([first.uuid, second.uuid],))
+
+
+def test_async_database_method_surface() -> None:
+    public = [
+        name
+        for name, member in inspect.getmembers(Database, inspect.isfunction)
+        if not name.startswith("_")
+    ]
+    for name in public:
+        assert inspect.iscoroutinefunction(getattr(AsyncDatabase, name)), name
@@ -0,0 +1,35 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from util.image_store import LocalImageStore, PostgresImageStore
+
+
+def test_postgres_image_store_keeps_images_in_record() -> None:
+    store = PostgresImageStore()
+    assert store.put(b"image") is None
+    assert store.path("0" * 64) is None
+
+
+def test_local_image_store_put_and_path(tmp_path: Path) -> None:
+    store = LocalImageStore(tmp_path / "images")
+    key = store.put(b"image")
+    assert key == hashlib.sha256(b"image").hexdigest()
+    path = store.path(key)
+    assert path is not None
+    assert path.read_bytes() == b"image"
+    assert path.parent.name == key[:2]
+
+
+def test_local_image_store_deduplicates(tmp_path: Path) -> None:
+    store = LocalImageStore(tmp_path)
+    assert store.put(b"image") == store.put(b"image")
+    assert len([i for i in tmp_path.rglob("*") if i.is_file()]) == 1
+
+
+def test_local_image_store_missing_and_invalid_keys(tmp_path: Path) -> None:
+    store = LocalImageStore(tmp_path)
+    assert store.path(hashlib.sha256(b"missing").hexdigest()) is None
+    with pytest.raises(ValueError):
+        store.path("../../etc/passwd")
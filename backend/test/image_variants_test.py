@@ -0,0 +1,58 @@
+import io
+from pathlib import Path
+
+import pytest
+
+from util.image_variants import (
+    VariantCache,
+    available_formats,
+    negotiate_format,
+    render_variant,
+    snap_width,
+)
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png(width: int, height: int) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color=(200, 40, 40)).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_snap_width() -> None:
+    assert snap_width(1) == 160
+    assert snap_width(160) == 160
+    assert snap_width(161) == 320
+    assert snap_width(10000) == 1920
+
+
+def test_negotiate_format() -> None:
+    assert negotiate_format(None) == "png"
+    assert negotiate_format("*/*") == "png"
+    assert negotiate_format("image/webp,*/*;q=0.8") == "webp"
+    expected = "avif" if "avif" in available_formats() else "webp"
+    assert negotiate_format("image/avif, image/webp;q=0.9") == expected
+
+
+@pytest.mark.parametrize("format", available_formats())
+def test_render_variant(format: str, tmp_path: Path) -> None:
+    variant = render_variant(png(800, 400), 320, format)  # type: ignore[arg-type]
+    with Image.open(io.BytesIO(variant)) as image:
+        assert image.format == format.upper()
+        assert image.size == (320, 160)
+    (source := tmp_path / "source").write_bytes(png(100, 50))
+    with Image.open(io.BytesIO(render_variant(source, 320, format))) as image:  # type: ignore[arg-type]
+        assert image.size == (100, 50)  # never upscaled
+
+
+def test_variant_cache(tmp_path: Path) -> None:
+    cache = VariantCache(tmp_path)
+    digest = VariantCache.digest(b"image")
+    assert cache.get(digest, 160, "webp") is None
+    path = cache.put(digest, 160, "webp", b"variant")
+    assert cache.get(digest, 160, "webp") == path
+    assert path.read_bytes() == b"variant"
+    assert cache.get(digest, 320, "webp") is None
+    with pytest.raises(ValueError):
+        cache.get("../variant", 160, "webp")
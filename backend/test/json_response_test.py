@@ -0,0 +1,42 @@
+from datetime import date, datetime
+from uuid import uuid4
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import util.json_response
+from util.json_response import FastJSONResponse, dumps
+from util.models.actress_detail import ActressDetail
+from util.models.film import FilmNoBytes, FilmState
+from util.models.film_page import FilmPage
+from util.models.rating import Rating
+
+
+def film(title: str, state: FilmState | str) -> FilmNoBytes:
+    return FilmNoBytes(
+        uuid=uuid4(),
+        title=title,
+        date_added=date(2024, 1, 2),  # type: ignore[arg-type]
+        filename=f"{title}.mp4",
+        watched=False,
+        state=state,  # type: ignore[arg-type]
+        rating=Rating(uuid4(), 6.85, 1, 2, 3, 4, 5, 6, 7),
+        actresses=["actress one", "actrice née"],
+    )
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_dumps(monkeypatch: pytest.MonkeyPatch, fast: bool) -> None:
+    if not fast:
+        monkeypatch.setattr(util.json_response, "orjson", None)
+    films = [film("first", FilmState.COMPLETE), film("second", "NOT_TRANSCODED")]
+    for content in (
+        films,
+        ActressDetail(name="actrice née", films=films),
+        FilmPage(films=films, next_cursor=None),
+        {"added": datetime(2024, 1, 2, 3, 4, 5, 678901), "count": 2},
+    ):
+        expected = JSONResponse(jsonable_encoder(content)).body
+        assert dumps(content) == expected
+        assert FastJSONResponse(content).body == expected
@@ -1,8 +1,11 @@
 import datetime
+import io
+import shutil
+import struct
 from dataclasses import asdict
 from pathlib import Path
-from typing import Any
-from uuid import uuid4
+from typing import Any, Generator
+from uuid import UUID, uuid4
 
 import dotenv
 import httpx
@@ -10,8 +13,14 @@ import pytest
 from fastapi.testclient import TestClient
 
 from server.__main__ import Server
+from util.database.async_database import AsyncDatabase
 from util.database.database import Database
+from util.image_store import LocalImageStore, PostgresImageStore
+from util.image_variants import VariantCache
 from util.models.film import Film, FilmNoBytes, FilmState
+from util.models.history import HistoryEvent
+from util.models.transcode import TranscodeProgress
+from util.streaming import stream_directory
 
 from .database_test import mock_db
 
@@ -21,14 +30,28 @@ def server(mock_db: Database) -> Server:
     dotenv.load_dotenv()
     mock_db.database_init(Path("./util/database/schema.sql").read_text())
     server = Server(
-        host="0.0.0.0", port=9761, db=mock_db
-    )  # host and port unused in this context.
+        host="0.0.0.0",
+        port=9761,
+        db=AsyncDatabase(
+            db_name="ar-test-db",
+            db_user="ar-test-user",
+            db_password="ar-test-password",
+            db_host="localhost",
+            db_port="5298",
+            min_connections=5,
+            max_connections=15,
+            max_retries=15,
+            retry_interval=15,
+        ),
+        listen=False,
+    )  # host and port unused in this context. cache is synchronized by polling.
     return server
 
 
 @pytest.fixture(scope="module")
-def client(server: Server) -> TestClient:
-    return server.test_client()
+def client(server: Server) -> Generator[TestClient, None, None]:
+    with server.test_client() as client:  # runs the lifespan, opening the pool
+        yield client
 
 
 @pytest.mark.order(201)
@@ -177,9 +200,100 @@ def test_api_get_serve_video_film_exists_file_found(
     assert response_filename_fetch.status_code == 200
 
 
+@pytest.mark.order(210)
+def test_api_video_ranges(
+    client: TestClient, mock_db: Database, server: Server
+) -> None:
+    film = next(
+        i for i in mock_db.get_all_films() if i.filename == "test_video_file.mp4"
+    )
+    assert film.uuid
+    video = Path("test/assets/test_video_file.mp4").read_bytes()
+    url = f"/api/get/video?uuid={film.uuid}"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers.get("Accept-Ranges") == "bytes"
+    assert response.content == video
+    assert film.uuid in server.cache.videos
+    etag = response.headers.get("ETag")
+
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers.get("Content-Range") == f"bytes 100-199/{len(video)}"
+    assert response.content == video[100:200]
+
+    response = client.get(url, headers={"Range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.content == video[-10:]
+
+    response = client.get(url, headers={"Range": "bytes=0-9, 1000-1019"})
+    assert response.status_code == 206
+    content_type = response.headers.get("Content-Type")
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1].encode()
+    parts = response.content.split(b"--" + boundary)
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + video[0:10] + b"\r\n")
+    assert f"bytes 1000-1019/{len(video)}".encode() in parts[2]
+    assert parts[2].endswith(b"\r\n\r\n" + video[1000:1020] + b"\r\n")
+    assert int(response.headers.get("Content-Length")) == len(response.content)
+
+    response = client.get(url, headers={"Range": f"bytes={len(video)}-"})
+    assert response.status_code == 416
+    assert response.headers.get("Content-Range") == f"bytes */{len(video)}"
+
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.content == video
+
+
 @pytest.mark.order(209)
 def test_api_films_cache(client: TestClient, server: Server) -> None:
     assert server.cache.films
+    assert server.cache.filmsBody
+
+
+@pytest.mark.order(209)
+def test_api_films_etag(client: TestClient) -> None:
+    response = client.get("/api/get/films")
+    assert response.status_code == 200
+    assert (etag := response.headers.get("ETag"))
+    not_modified = client.get("/api/get/films", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers.get("ETag") == etag
+    assert not not_modified.content
+    modified = client.get("/api/get/films", headers={"If-None-Match": 'W/"stale"'})
+    assert modified.status_code == 200
+
+
+@pytest.mark.order(209)
+def test_api_films_encoding(client: TestClient) -> None:
+    identity = client.get("/api/get/films", headers={"Accept-Encoding": "identity"})
+    assert identity.headers.get("Content-Encoding") is None
+    gzipped = client.get("/api/get/films", headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers.get("Content-Encoding") == "gzip"
+    assert gzipped.json() == identity.json()
+
+
+@pytest.mark.order(209)
+def test_api_films_page(client: TestClient) -> None:
+    response = client.get("/api/get/films/page?limit=5&sort=title&descending=false")
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["films"]) == 5
+    assert page["next_cursor"]
+    next_response = client.get(
+        f"/api/get/films/page?limit=5&sort=title&descending=false&cursor={page['next_cursor']}"
+    )
+    assert next_response.status_code == 200
+    assert not {f["uuid"] for f in page["films"]} & {
+        f["uuid"] for f in next_response.json()["films"]
+    }
+    invalid = client.get("/api/get/films/page?cursor=invalid")
+    assert invalid.status_code == 400
+    assert invalid.json() == {"detail": "invalid cursor"}
 
 
 @pytest.mark.order(209)
@@ -214,12 +328,12 @@ def test_api_thumbnail_cache(
     assert response.headers.get("Content-Type") == "image/png"
     assert isinstance(response.content, bytes)
     assert response.content.decode("utf-8") == "thumbnail"
-    assert film.uuid in list(server.cache.images.keys())
-    assert response.content == server.cache.images[film.uuid]
+    assert film.uuid in server.cache.thumbnails
+    assert response.content == server.cache.thumbnails.get(film.uuid)
 
 
 @pytest.mark.order(212)
-def test_api_poster(client: TestClient, mock_db: Database) -> None:
+def test_api_poster(client: TestClient, mock_db: Database, server: Server) -> None:
     film = mock_db.get_all_films()[0]
     assert film.uuid
     response = client.get(f"/api/get/image?uuid={film.uuid}&image_type=POSTER")
@@ -227,6 +341,61 @@ def test_api_poster(client: TestClient, mock_db: Database) -> None:
     assert response.headers.get("Content-Type") == "image/png"
     assert isinstance(response.content, bytes)
     assert response.content.decode("utf-8") == "poster"
+    assert film.uuid in server.cache.posters
+
+
+@pytest.mark.order(212)
+def test_api_cache_stats(client: TestClient) -> None:
+    response = client.get("/api/get/cache_stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["thumbnails"]["hits"] >= 1
+    assert stats["thumbnails"]["entries"] >= 1
+    assert stats["posters"]["misses"] >= 1
+
+
+@pytest.mark.order(212)
+def test_api_pool_stats(client: TestClient) -> None:
+    response = client.get("/api/get/pool_stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert (stats["min_size"], stats["max_size"]) == (5, 15)
+    assert stats["requests"] >= 1
+    assert stats["size"] >= stats["available"]
+    assert stats["waiting"] == 0
+
+
+@pytest.mark.order(212)
+def test_api_images_batch(
+    client: TestClient, mock_db: Database, server: Server
+) -> None:
+    uuids = [film.uuid for film in mock_db.get_all_films()]
+    assert len(uuids) > 1
+    server.cache.thumbnails.invalidate(uuids[0])
+    missing = uuid4()
+    response = client.post(
+        "/api/get/images?image_type=THUMBNAIL",
+        json={"uuids": [str(i) for i in [*uuids, missing]]},
+    )
+    assert response.status_code == 200
+    assert response.headers.get("Content-Type") == "application/x-image-bundle"
+    bundle, images = response.content, list()
+    while bundle:
+        uuid, length = UUID(bytes=bundle[:16]), struct.unpack(">I", bundle[16:20])[0]
+        images.append((uuid, bundle[20 : 20 + length]))
+        bundle = bundle[20 + length :]
+    assert images == [(uuid, b"thumbnail") for uuid in uuids]
+    assert all(uuid in server.cache.thumbnails for uuid in uuids)
+
+
+@pytest.mark.order(212)
+def test_api_images_batch_too_many(client: TestClient) -> None:
+    response = client.post(
+        "/api/get/images?image_type=POSTER",
+        json={"uuids": [str(uuid4()) for _ in range(1001)]},
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "too many images"}
 
 
 @pytest.mark.order(213)
@@ -259,12 +428,29 @@ def test_api_set_rating(client: TestClient, mock_db: Database) -> None:
 
 
 @pytest.mark.order(214)
-def test_api_delete_film(client: TestClient, mock_db: Database) -> None:
+def test_api_delete_film(client: TestClient, mock_db: Database, server: Server) -> None:
     film = mock_db.get_all_films()[0]
     assert film.uuid
+    client.get(f"/api/get/image?uuid={film.uuid}&image_type=THUMBNAIL")
+    assert film.uuid in server.cache.thumbnails
     response = client.post(f"/api/set/delete?uuid={film.uuid}")
     assert response.status_code == 200
     assert film.uuid not in [str(f.uuid) for f in mock_db.get_all_films()]
+    assert film.uuid not in server.cache.thumbnails
+
+
+@pytest.mark.order(214)
+def test_api_images_invalidated_by_history(
+    client: TestClient, mock_db: Database, server: Server
+) -> None:
+    client.get("/api/get/films")
+    film = mock_db.get_all_films()[0]
+    assert film.uuid
+    client.get(f"/api/get/image?uuid={film.uuid}&image_type=THUMBNAIL")
+    assert film.uuid in server.cache.thumbnails
+    mock_db.delete_film(film.uuid)  # deleted outside of the server
+    client.get("/api/get/films")
+    assert film.uuid not in server.cache.thumbnails
 
 
 @pytest.mark.order(215)
@@ -292,3 +478,339 @@ def test_api_get_actress_detail(client: TestClient, mock_db: Database) -> None:
         assert result.get("name") == actress
 
         assert len(real_result.films) == len(result.get("films"))
+
+
+@pytest.mark.order(217)
+def test_history_event_invalidates_cache(
+    client: TestClient, mock_db: Database, server: Server
+) -> None:
+    film = mock_db.get_all_films()[0]
+    assert film.uuid
+    client.get(f"/api/get/image?uuid={film.uuid}&image_type=POSTER")
+    assert film.uuid in server.cache.posters
+    server.on_history_event(
+        HistoryEvent(
+            uuid=uuid4(),
+            table_name="film",
+            action="update",
+            record_uuid=film.uuid,
+            seq=(seq := mock_db.get_history_seq()),
+        )
+    )
+    assert film.uuid not in server.cache.posters
+    assert server.cache.latestSeq == seq
+
+
+@pytest.mark.order(218)
+def test_api_image_from_image_store(
+    client: TestClient, mock_db: Database, server: Server, tmp_path: Path
+) -> None:
+    film = mock_db.get_all_films()[0]
+    assert film.uuid
+    client.get(f"/api/get/image?uuid={film.uuid}&image_type=POSTER")
+    assert film.uuid in server.cache.imageKeys
+    store = LocalImageStore(tmp_path)
+    server.db.image_store = store
+    try:
+        while mock_db.migrate_image_batch(store, batch_size=100):
+            pass
+        server.cache.posters.clear()  # the cached keys still point to the film record
+        response = client.get(f"/api/get/image?uuid={film.uuid}&image_type=POSTER")
+        assert response.status_code == 200
+        assert response.headers.get("Content-Type") == "image/png"
+        assert response.content == b"poster"
+        assert film.uuid not in server.cache.posters
+    finally:
+        server.db.image_store = PostgresImageStore()
+
+
+@pytest.mark.order(219)
+def test_api_image_variant(
+    client: TestClient, mock_db: Database, server: Server, tmp_path: Path
+) -> None:
+    Image = pytest.importorskip("PIL.Image")
+    source = io.BytesIO()
+    Image.new("RGB", (800, 400)).save(source, "PNG")
+    uuid = mock_db.insert_film(
+        Film(
+            uuid=None,
+            title="variant",
+            date_added=datetime.datetime.now(),
+            filename="variant.mp4",
+            watched=False,
+            state=FilmState.COMPLETE,
+            rating=None,
+            actresses=[],
+            thumbnail=b"thumbnail",
+            poster=source.getvalue(),
+        )
+    )
+    server.variants = VariantCache(tmp_path)
+    try:
+        url = f"/api/get/image?uuid={uuid}&image_type=POSTER&width=300"
+        response = client.get(url, headers={"Accept": "image/webp,*/*"})
+        assert response.status_code == 200
+        assert response.headers.get("Content-Type") == "image/webp"
+        assert response.headers.get("Vary") == "Accept"
+        with Image.open(io.BytesIO(response.content)) as image:
+            assert image.size == (320, 160)
+        assert len(list(tmp_path.rglob("*.webp"))) == 1
+        assert client.get(url, headers={"Accept": "image/webp"}).content == (
+            response.content
+        )  # from the variant cache
+        response = client.get(url + "&format=png", headers={"Accept": "image/webp"})
+        assert response.headers.get("Content-Type") == "image/png"
+        assert "Vary" not in response.headers
+        response = client.get(f"/api/get/image?uuid={uuid}&image_type=POSTER")
+        assert response.content == source.getvalue()
+        response = client.get(
+            f"/api/get/image?uuid={uuid}&image_type=THUMBNAIL&width=300"
+        )
+        assert response.content == b"thumbnail"  # not an image; served as stored
+    finally:
+        mock_db.delete_film(uuid)
+
+
+@pytest.mark.order(210)
+def test_api_stream(client: TestClient, mock_db: Database) -> None:
+    film = next(
+        i for i in mock_db.get_all_films() if i.filename == "test_video_file.mp4"
+    )
+    directory = stream_directory(Path("test/assets") / film.filename)
+    response = client.get(f"/api/get/stream/{film.uuid}/master.m3u8")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "stream not found"}
+    directory.mkdir()
+    try:
+        (directory / "master.m3u8").write_text("#EXTM3U\n")
+        (directory / "chunk-stream0-00001.m4s").write_bytes(b"segment")
+        response = client.get(f"/api/get/stream/{film.uuid}/master.m3u8")
+        assert response.status_code == 200
+        assert response.headers.get("Content-Type") == "application/vnd.apple.mpegurl"
+        assert response.text == "#EXTM3U\n"
+        response = client.get(f"/api/get/stream/{film.uuid}/chunk-stream0-00001.m4s")
+        assert response.headers.get("Content-Type") == "video/iso.segment"
+        assert response.content == b"segment"
+        response = client.get(f"/api/get/stream/{film.uuid}/..%2Ftest_video_file.mp4")
+        assert response.status_code == 404
+        response = client.get(f"/api/get/stream/{uuid4()}/master.m3u8")
+        assert response.json() == {"detail": "film not found"}
+    finally:
+        shutil.rmtree(directory)
+
+
+@pytest.mark.order(220)
+def test_api_transcode_progress(client: TestClient, mock_db: Database) -> None:
+    uuids = [
+        mock_db.insert_film(
+            Film(
+                uuid=None,
+                title=f"queued {i}",
+                date_added=datetime.datetime(2000, 1, 1 + i),
+                filename=f"queued {i}.mp4",
+                watched=False,
+                state=FilmState.NOT_TRANSCODED,
+                rating=None,
+                actresses=[],
+                thumbnail=b"thumbnail",
+                poster=b"poster",
+            )
+        )
+        for i in range(3)
+    ]
+    try:
+        (claimed,) = mock_db.get_not_transcoded_and_set_transcoding_batch(
+            1, worker_id="worker"
+        )
+        assert claimed.uuid == uuids[0]
+        response = client.get(f"/api/get/transcode/status?uuid={uuids[0]}")
+        assert response.json()["state"] == "TRANSCODING"
+        assert response.json()["progress"] is None  # nothing reported yet
+        progress = TranscodeProgress(
+            frame=250, seconds=10.0, duration=40.0, speed=2.0, eta=15.0
+        )
+        mock_db.record_transcode_progress({uuids[0]: progress}, "worker")
+        mock_db.record_transcode_progress({uuids[1]: progress}, "worker")  # not leased
+
+        response = client.get(f"/api/get/transcode/status?uuid={uuids[0]}")
+        assert response.status_code == 200
+        status = response.json()
+        assert status["worker_id"] == "worker"
+        assert status["position"] is None
+        assert status["progress"]["frame"] == 250
+        assert status["progress"]["eta"] == 15.0
+        assert status["progress"]["updated_at"]
+        status = client.get(f"/api/get/transcode/status?uuid={uuids[2]}").json()
+        assert (status["state"], status["position"], status["progress"]) == (
+            "NOT_TRANSCODED",
+            2,
+            None,
+        )
+
+        queue = client.get("/api/get/transcode/queue").json()
+        assert queue["backlog"] == 2
+        assert [i["uuid"] for i in queue["transcoding"]] == [str(uuids[0])]
+        assert [(i["uuid"], i["position"]) for i in queue["queued"]] == [
+            (str(uuids[1]), 1),
+            (str(uuids[2]), 2),
+        ]
+        queue = client.get("/api/get/transcode/queue?limit=1").json()
+        assert [i["uuid"] for i in queue["queued"]] == [str(uuids[1])]
+
+        response = client.get(f"/api/get/transcode/status?uuid={uuid4()}")
+        assert response.status_code == 404
+    finally:
+        for uuid in uuids:
+            mock_db.delete_film(uuid)
+
+
+@pytest.mark.order(221)
+def test_api_actress_index(client: TestClient, mock_db: Database) -> None:
+    def film(actresses: list[str]) -> Film:
+        return Film(
+            uuid=None,
+            title="indexed",
+            date_added=datetime.datetime.now(),
+            filename="indexed",
+            watched=False,
+            state=FilmState.COMPLETE,
+            rating=None,
+            actresses=actresses,
+            thumbnail=None,
+            poster=None,
+        )
+
+    before = client.get("/api/get/actress_counts").json()
+    uuids = [
+        mock_db.insert_film(film(["index one", "index two"])),
+        mock_db.insert_film(film(["index two", "index two"])),
+    ]
+    try:
+        counts = client.get("/api/get/actress_counts").json()
+        assert counts == {**before, "index one": 1, "index two": 2}
+        assert client.get("/api/get/actresses").json() == list(counts)
+        assert sorted(mock_db.get_actress_list()) == list(counts)
+        detail = client.get("/api/get/actress_detail?name=index two").json()
+        assert sorted(i["uuid"] for i in detail["films"]) == sorted(map(str, uuids))
+        assert len(mock_db.get_actress_detail("index two").films) == 2
+
+        mock_db.delete_film(uuids[0])  # picked up from the history
+        counts = client.get("/api/get/actress_counts").json()
+        assert counts == {**before, "index two": 1}
+    finally:
+        for uuid in uuids:
+            mock_db.delete_film(uuid)
+
+
+@pytest.mark.order(222)
+def test_api_search(client: TestClient, mock_db: Database) -> None:
+    uuid = mock_db.insert_film(
+        Film(
+            uuid=None,
+            title="Searched Title",
+            date_added=datetime.datetime.now(),
+            filename="searched",
+            watched=False,
+            state=FilmState.COMPLETE,
+            rating=None,
+            actresses=["Searched Actress"],
+            thumbnail=None,
+            poster=None,
+        )
+    )
+    try:
+        response = client.get("/api/get/search?q=searched titl")
+        assert response.status_code == 200
+        assert [i["uuid"] for i in response.json()] == [str(uuid)]
+        assert client.get("/api/get/search?q=").status_code == 422
+
+        response = client.get("/api/get/search/complete?prefix=searched")
+        assert response.status_code == 200
+        assert response.json() == [
+            {"text": "Searched Actress", "field": "actress", "films": 1},
+            {"text": "Searched Title", "field": "title", "films": 1},
+        ]
+        completions = client.get("/api/get/search/complete?prefix=titl&limit=1")
+        assert [i["text"] for i in completions.json()] == ["Searched Title"]
+    finally:
+        mock_db.delete_film(uuid)
+    assert client.get("/api/get/search/complete?prefix=searched").json() == []
+
+
+@pytest.mark.order(223)
+def test_api_film_changes(client: TestClient, mock_db: Database) -> None:
+    response = client.get("/api/get/films")
+    seq = int(response.headers["History-Seq"])
+    films = {i["uuid"]: i for i in response.json()}
+    film = mock_db.get_all_films()[0]
+    changes = client.get(f"/api/get/films/changes?since={seq}").json()
+    assert changes == {"seq": seq, "upserted": [], "deleted": []}
+
+    client.post(f"/api/set/watched?watch_status={not film.watched}&uuid={film.uuid}")
+    changes = client.get(f"/api/get/films/changes?since={seq}").json()
+    assert changes["seq"] > seq
+    assert changes["deleted"] == []
+    (updated,) = changes["upserted"]
+    assert updated == {**films[str(film.uuid)], "watched": not film.watched}
+
+    # the cached films list is updated with the changes, rather than reloaded.
+    response = client.get("/api/get/films")
+    assert int(response.headers["History-Seq"]) == changes["seq"]
+    films[str(film.uuid)] = updated
+    assert sorted(response.json(), key=lambda i: i["uuid"]) == sorted(
+        films.values(), key=lambda i: i["uuid"]
+    )
+    assert client.get("/api/get/films/changes?since=-1").status_code == 422
+
+
+@pytest.mark.order(224)
+def test_api_film_changes_trimmed(client: TestClient, mock_db: Database) -> None:
+    response = client.get("/api/get/films")
+    seq = int(response.headers["History-Seq"])
+    film = mock_db.get_all_films()[0]
+    client.post(f"/api/set/watched?watch_status={not film.watched}&uuid={film.uuid}")
+    assert mock_db.trim_history(0) > 0
+
+    response = client.get(f"/api/get/films/changes?since={seq}")
+    assert response.status_code == 410
+    # the cached films list is behind the trimmed history, so it is loaded again.
+    response = client.get("/api/get/films")
+    assert int(response.headers["History-Seq"]) == mock_db.get_history_seq()
+    (updated,) = [i for i in response.json() if i["uuid"] == str(film.uuid)]
+    assert updated["watched"] == (not film.watched)
+
+
+@pytest.mark.order(225)
+def test_api_retry_transcode(client: TestClient, mock_db: Database) -> None:
+    uuid = mock_db.insert_film(
+        Film(
+            uuid=None,
+            title="failed transcode",
+            date_added=datetime.datetime(1990, 1, 1),  # claimed first
+            filename="failed transcode.mp4",
+            watched=False,
+            state=FilmState.NOT_TRANSCODED,
+            rating=None,
+            actresses=[],
+            thumbnail=None,
+            poster=None,
+        )
+    )
+    try:
+        mock_db.get_not_transcoded_and_set_transcoding_batch(
+            1, worker_id="worker", lease_seconds=0
+        )
+        assert mock_db.reap_expired_transcodes(max_attempts=1) == []
+        queue = client.get("/api/get/transcode/queue").json()
+        assert [(i["uuid"], i["state"]) for i in queue["failed"]] == [
+            (str(uuid), "FAILED")
+        ]
+
+        assert client.post(f"/api/set/transcode/retry?uuid={uuid}").status_code == 200
+        response = client.post(f"/api/set/transcode/retry?uuid={uuid}")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "no failed transcode of the film"}
+        status = client.get(f"/api/get/transcode/status?uuid={uuid}").json()
+        assert (status["state"], status["attempts"]) == ("NOT_TRANSCODED", 0)
+    finally:
+        mock_db.delete_film(uuid)
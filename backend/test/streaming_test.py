@@ -0,0 +1,48 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from util.streaming import DASH_MANIFEST, HLS_MANIFEST, stream_directory
+from util.streaming.ladder import Rendition, package, select_renditions
+
+LADDER = (
+    Rendition(height=240, video_bitrate=400),
+    Rendition(height=144, video_bitrate=200),
+)
+
+
+def test_select_renditions() -> None:
+    assert [i.height for i in select_renditions(1080)] == [1080, 720, 480, 360]
+    assert [i.height for i in select_renditions(720)] == [720, 480, 360]
+    assert [i.height for i in select_renditions(241)] == [240]  # below the ladder
+    assert [i.height for i in select_renditions(240, LADDER)] == [240, 144]
+
+
+def test_stream_directory() -> None:
+    assert stream_directory(Path("/films/a.mp4")) == Path("/films/a.mp4.abr")
+
+
+@pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg"
+)
+def test_package(tmp_path: Path) -> None:
+    film = tmp_path / "film.mp4"
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error",
+            "-f", "lavfi", "-i", "testsrc=duration=6:size=320x240:rate=25",
+            "-f", "lavfi", "-i", "sine=duration=6",
+            "-c:v", "libx264", "-c:a", "aac", "-shortest", str(film),
+        ],
+        check=True,
+    )  # fmt: skip
+    directory = package(film, LADDER)
+    assert directory == stream_directory(film)
+    assert (directory / DASH_MANIFEST).is_file()
+    master = (directory / HLS_MANIFEST).read_text()
+    assert "RESOLUTION=320x240" in master
+    assert "RESOLUTION=192x144" in master
+    assert list(directory.glob("*.m4s"))
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["film.mp4", "film.mp4.abr"]
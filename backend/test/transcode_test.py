@@ -0,0 +1,277 @@
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from util.models.transcode import TranscodeProgress
+from util.transcode import (
+    Probe,
+    decide,
+    encode,
+    is_faststart,
+    parse_progress,
+    probe,
+    remux,
+)
+from util.transcode.chunked import (
+    SyncError,
+    chunk_boundaries,
+    encode_chunked,
+    verify_sync,
+)
+from util.transcode.images import CANDIDATES, SCORE_SIZE, choose_images, read_pgm, score
+
+MP4 = ("mov", "mp4", "m4a", "3gp", "3g2", "mj2")
+
+
+def box(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", len(payload) + 8, kind) + payload
+
+
+def test_is_faststart(tmp_path: Path) -> None:
+    file = tmp_path / "film.mp4"
+    file.write_bytes(box(b"ftyp", b"isom") + box(b"moov") + box(b"mdat", b"\0" * 64))
+    assert is_faststart(file)
+    file.write_bytes(box(b"ftyp", b"isom") + box(b"mdat", b"\0" * 64) + box(b"moov"))
+    assert not is_faststart(file)
+    # a 64-bit box size
+    file.write_bytes(
+        struct.pack(">I4sQ", 1, b"free", 16 + 4) + b"\0" * 4 + box(b"moov")
+    )
+    assert is_faststart(file)
+    file.write_bytes(b"\x1aE\xdf\xa3 not an mp4")
+    assert not is_faststart(file)
+
+
+def test_decide() -> None:
+    compatible = Probe(
+        containers=MP4,
+        video_codec="h264",
+        pixel_format="yuv420p",
+        audio_codecs=("aac",),
+        faststart=True,
+    )
+    assert decide(compatible) == "skip"
+    assert decide(Probe(MP4, "h264", "yuv420p", (), True)) == "skip"
+    assert decide(Probe(MP4, "h264", "yuv420p", ("aac",), False)) == "remux"
+    assert (
+        decide(Probe(("matroska", "webm"), "h264", "yuv420p", ("aac",), False))
+        == "remux"
+    )
+    assert decide(Probe(MP4, "hevc", "yuv420p", ("aac",), True)) == "encode"
+    assert decide(Probe(MP4, "h264", "yuv420p10le", ("aac",), True)) == "encode"
+    assert decide(Probe(MP4, "h264", "yuv420p", ("aac", "ac3"), True)) == "audio"
+    assert (
+        decide(Probe(("matroska", "webm"), "h264", "yuv420p", ("opus",), False))
+        == "audio"
+    )
+    assert decide(Probe(MP4, "hevc", "yuv420p", ("ac3",), True)) == "encode"
+
+
+def test_parse_progress() -> None:
+    output = """frame=0
+fps=0.00
+out_time_us=N/A
+speed=N/A
+progress=continue
+frame=250
+fps=50.00
+out_time_us=10000000
+out_time=00:00:10.000000
+speed=2.0x
+progress=continue
+frame=1000
+out_time_us=40000000
+speed=2.1x
+progress=end
+"""
+    assert list(parse_progress(output.splitlines(), duration=40.0)) == [
+        TranscodeProgress(frame=0, seconds=0.0, duration=40.0, speed=None, eta=None),
+        TranscodeProgress(frame=250, seconds=10.0, duration=40.0, speed=2.0, eta=15.0),
+        TranscodeProgress(frame=1000, seconds=40.0, duration=40.0, speed=2.1, eta=0.0),
+    ]
+    (progress,) = parse_progress(["frame=25", "speed=1x", "progress=end"])
+    assert (progress.duration, progress.eta) == (None, None)
+
+
+def test_chunk_boundaries() -> None:
+    assert chunk_boundaries(150.0, 60.0, 25.0) == [
+        (0.0, pytest.approx(59.98)),
+        (pytest.approx(59.98), pytest.approx(60.0)),
+        (pytest.approx(119.98), None),
+    ]
+    assert chunk_boundaries(30.0, 60.0, None) == [(0.0, None)]
+
+
+def count_frames(file: Path) -> int:
+    return int(
+        subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-select_streams", "V:0", "-count_frames",
+                "-show_entries", "stream=nb_read_frames", "-of", "csv=p=0", str(file),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    )  # fmt: skip
+
+
+def video_packets(file: Path) -> str:
+    return subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", str(file), "-map", "0:V:0", "-c", "copy", "-f", "md5", "-"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout  # fmt: skip
+
+
+def make_film(file: Path, *options: str, duration: int = 2) -> None:
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc=duration={duration}:size=160x120:rate=25",
+            "-f", "lavfi", "-i", f"sine=duration={duration}",
+            *options, "-shortest", str(file),
+        ],
+        check=True,
+    )  # fmt: skip
+
+
+@pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg"
+)
+def test_probe_remux_encode(tmp_path: Path) -> None:
+    make_film(
+        tmp_path / "faststart.mp4",
+        *("-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac"),
+        *("-movflags", "+faststart"),
+    )
+    assert decide(probe(tmp_path / "faststart.mp4")) == "skip"
+
+    make_film(
+        tmp_path / "film.mkv",
+        *("-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac"),
+    )
+    source = probe(tmp_path / "film.mkv")
+    assert decide(source) == "remux"
+    remux(tmp_path / "film.mkv", tmp_path / "remuxed", source)
+    assert decide(probe(tmp_path / "remuxed")) == "skip"
+
+    make_film(
+        tmp_path / "film.mov",
+        *("-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "mp3"),
+    )
+    source = probe(tmp_path / "film.mov")
+    assert decide(source) == "audio"
+    remux(tmp_path / "film.mov", tmp_path / "audio", source)
+    assert decide(probe(tmp_path / "audio")) == "skip"
+    # the video stream is copied, not encoded again.
+    assert video_packets(tmp_path / "audio") == video_packets(tmp_path / "film.mov")
+
+    make_film(tmp_path / "film.avi", "-c:v", "mpeg4", "-c:a", "mp3")
+    source = probe(tmp_path / "film.avi")
+    assert (source.video_codec, source.audio_codecs) == ("mpeg4", ("mp3",))
+    assert decide(source) == "encode"
+    reported: list[TranscodeProgress] = list()
+    encode(
+        tmp_path / "film.avi", tmp_path / "encoded", source, on_progress=reported.append
+    )
+    assert reported[-1].seconds == pytest.approx(2.0, abs=0.1)
+    assert reported[-1].duration == source.duration
+    assert decide(probe(tmp_path / "encoded")) == "skip"
+
+
+@pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg"
+)
+def test_encode_chunked(tmp_path: Path) -> None:
+    # b-frames across GOPs; cutting at keyframes without decoding would lose the leading b-frames.
+    make_film(
+        tmp_path / "film.mkv",
+        *("-c:v", "mpeg4", "-g", "25", "-bf", "2", "-flags", "-cgop", "-c:a", "mp3"),
+        duration=8,
+    )
+    source = probe(tmp_path / "film.mkv")
+    reported: list[TranscodeProgress] = list()
+    encode_chunked(
+        tmp_path / "film.mkv",
+        tmp_path / "encoded",
+        source,
+        tmp_path / "chunks",
+        workers=2,
+        chunk_seconds=3,
+        on_progress=reported.append,
+    )
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["encoded", "film.mkv"]
+    encode(tmp_path / "film.mkv", tmp_path / "whole", source)
+    assert count_frames(tmp_path / "encoded") == count_frames(tmp_path / "whole")
+    assert decide(probe(tmp_path / "encoded")) == "skip"
+    assert reported[-1].seconds == pytest.approx(8.0, abs=0.5)
+
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-i", str(tmp_path / "encoded"),
+            "-itsoffset", "0.5", "-i", str(tmp_path / "encoded"),
+            "-map", "0:v", "-map", "1:a", "-c", "copy", str(tmp_path / "late.mp4"),
+        ],
+        check=True,
+    )  # fmt: skip
+    verify_sync(tmp_path / "film.mkv", tmp_path / "encoded")
+    with pytest.raises(SyncError):
+        verify_sync(tmp_path / "film.mkv", tmp_path / "late.mp4")
+
+
+def write_candidate(directory: Path, number: int, pixels: bytes) -> None:
+    width, height = SCORE_SIZE
+    (directory / f"score-{number:03d}.pgm").write_bytes(
+        f"P5\n{width} {height}\n255\n".encode() + pixels
+    )
+    (directory / f"thumbnail-{number:03d}.png").write_bytes(b"thumbnail %d" % number)
+    (directory / f"poster-{number:03d}.png").write_bytes(b"poster %d" % number)
+
+
+def test_choose_images(tmp_path: Path) -> None:
+    width, height = SCORE_SIZE
+    black = bytes(width * height)
+    flat = bytes([128]) * (width * height)
+    # a checkerboard is as sharp as a frame gets; its blurred copy has the same mean but soft edges.
+    sharp = bytes(
+        255 * ((x // 8 + y // 8) % 2) for y in range(height) for x in range(width)
+    )
+    blurry = bytes(
+        96 + 64 * ((x // 8 + y // 8) % 2) for y in range(height) for x in range(width)
+    )
+    assert choose_images(tmp_path) is None
+    write_candidate(tmp_path, 1, black)
+    write_candidate(tmp_path, 2, flat)
+    assert [score(*read_pgm(i)) for i in sorted(tmp_path.glob("*.pgm"))] == [0, 0]
+    assert choose_images(tmp_path) == (b"thumbnail 1", b"poster 1")
+    write_candidate(tmp_path, 3, blurry)
+    write_candidate(tmp_path, 4, sharp)
+    assert score(width, height, sharp) > score(width, height, blurry) > 0
+    assert choose_images(tmp_path) == (b"thumbnail 4", b"poster 4")
+
+
+@pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg"
+)
+def test_encode_candidates(tmp_path: Path) -> None:
+    make_film(tmp_path / "film.avi", "-c:v", "mpeg4", "-c:a", "mp3", duration=4)
+    source = probe(tmp_path / "film.avi")
+    (tmp_path / "frames").mkdir()
+    encode(
+        tmp_path / "film.avi",
+        tmp_path / "encoded",
+        source,
+        candidates=tmp_path / "frames",
+    )
+    assert decide(probe(tmp_path / "encoded")) == "skip"
+    for kind in ("score", "thumbnail", "poster"):
+        assert len(list((tmp_path / "frames").glob(f"{kind}-*"))) == CANDIDATES
+    images = choose_images(tmp_path / "frames")
+    assert images is not None
+    thumbnail, poster = images
+    assert thumbnail.startswith(b"\x89PNG") and poster.startswith(b"\x89PNG")
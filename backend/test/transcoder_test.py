@@ -0,0 +1,371 @@
+import datetime
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from transcoder.__main__ import PARTIAL_SUFFIX, Supervisor, report_progress, transcode
+from util.database.database import Database
+from util.database.listener import TranscodeListener
+from util.models.film import Film, FilmNoBytes, FilmState
+from util.models.transcode import TranscodeProgress
+from util.transcode import TranscodeResult
+
+from .database_test import mock_db
+
+PNG = b"\x89PNG"
+
+
+def succeed(film: FilmNoBytes) -> None:
+    time.sleep(0.05)
+
+
+def hang(film: FilmNoBytes) -> None:
+    time.sleep(60)
+
+
+def fail_broken(film: FilmNoBytes) -> None:
+    if film.title == "broken":
+        raise RuntimeError("broken film")
+
+
+def report_and_hang(film: FilmNoBytes) -> None:
+    report = report_progress(film)
+    report(TranscodeProgress(frame=25, seconds=1.0, duration=10.0, speed=1.0, eta=9.0))
+    report(TranscodeProgress(frame=50, seconds=2.0, duration=10.0, speed=1.0, eta=8.0))
+    time.sleep(60)
+
+
+def extract_images(film: FilmNoBytes) -> TranscodeResult:
+    return TranscodeResult("skip", b"extracted thumbnail", b"extracted poster")
+
+
+def insert_films(db: Database, titles: list[str], images: bool = True) -> None:
+    for title in titles:
+        db.insert_film(
+            Film(
+                uuid=None,
+                title=title,
+                date_added=datetime.datetime.now(),
+                filename=f"{title}.mp4",
+                watched=False,
+                state=FilmState.NOT_TRANSCODED,
+                rating=None,
+                actresses=[],
+                thumbnail=b"thumbnail" if images else None,
+                poster=b"poster" if images else None,
+            )
+        )
+
+
+def run_until_idle(supervisor: Supervisor, db: Database) -> None:
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while db.get_transcode_backlog() or any(
+        film.state == FilmState.TRANSCODING.value for film in db.get_all_films()
+    ):
+        assert time.monotonic() < deadline
+        if supervisor.failed:
+            break
+        time.sleep(0.05)
+    supervisor.stop()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+
+
+@pytest.mark.order(300)
+def test_claim_batch(mock_db: Database) -> None:
+    mock_db.database_init(Path("./util/database/schema.sql").read_text())
+    assert mock_db.get_not_transcoded_and_set_transcoding_batch(5) == []
+    insert_films(mock_db, ["one", "two", "three"])
+    assert mock_db.get_transcode_backlog() == 3
+    claimed = mock_db.get_not_transcoded_and_set_transcoding_batch(2)
+    assert len(claimed) == 2
+    assert all(film.state == FilmState.TRANSCODING for film in claimed)
+    assert mock_db.get_transcode_backlog() == 1
+    assert len(mock_db.get_not_transcoded_and_set_transcoding_batch(5)) == 1
+    assert mock_db.get_transcode_backlog() == 0
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+
+
+@pytest.mark.order(301)
+def test_supervisor(mock_db: Database) -> None:
+    insert_films(mock_db, [f"film {i}" for i in range(6)])
+    supervisor = Supervisor(mock_db, job=succeed, workers=2, poll_interval=0.1)
+    run_until_idle(supervisor, mock_db)
+    assert supervisor.completed == 6
+    assert all(
+        film.state == FilmState.COMPLETE.value for film in mock_db.get_all_films()
+    )
+
+
+@pytest.mark.order(302)
+def test_supervisor_failed_job(mock_db: Database) -> None:
+    insert_films(mock_db, ["broken"])
+    supervisor = Supervisor(
+        mock_db,
+        job=fail_broken,
+        workers=2,
+        poll_interval=0.1,
+        lease_seconds=1,
+        max_attempts=2,
+    )
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while supervisor.failed < 2:  # reaped and retried once
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    time.sleep(1)  # out of attempts, it is marked failed rather than reaped again
+    supervisor.stop()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert supervisor.failed == 2
+    broken = next(film for film in mock_db.get_all_films() if film.title == "broken")
+    assert broken.state == FilmState.FAILED.value
+
+
+@pytest.mark.order(303)
+def test_supervisor_abort(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["slow one", "slow two"])
+    supervisor = Supervisor(mock_db, job=hang, workers=2, poll_interval=0.1)
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    while mock_db.get_transcode_backlog():
+        time.sleep(0.05)
+    supervisor.stop(drain=False)
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert supervisor.completed == 0
+    assert mock_db.get_transcode_backlog() == 2  # re-queued
+
+
+@pytest.mark.order(304)
+def test_supervisor_woken_by_notification(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    supervisor = Supervisor(mock_db, job=succeed, workers=1, poll_interval=600)
+    listener = TranscodeListener(mock_db.conninfo, on_notify=supervisor.wake)
+    listener.start()
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        while not listener.connected:
+            time.sleep(0.05)
+        time.sleep(
+            0.2
+        )  # the supervisor found the queue empty, and waits for the next poll
+        insert_films(mock_db, ["notified"])
+        deadline = time.monotonic() + 10  # far sooner than the poll interval
+        while not supervisor.completed:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        supervisor.stop()
+        thread.join(timeout=30)
+        listener.stop()
+    assert not listener.connected
+
+    # a stopped listener can be started again.
+    notified = threading.Event()
+    listener.on_notify = notified.set
+    listener.start()
+    try:
+        assert notified.wait(timeout=10)  # on connecting
+        assert listener.connected
+    finally:
+        listener.stop()
+    assert not listener.connected
+
+
+@pytest.mark.order(305)
+def test_leases(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["leased"])
+    (film,) = mock_db.get_not_transcoded_and_set_transcoding_batch(
+        1, worker_id="a", lease_seconds=60
+    )
+    assert film.uuid
+    assert mock_db.renew_transcode_leases([film.uuid], "b") == []
+    assert mock_db.renew_transcode_leases([film.uuid], "a") == [film.uuid]
+    assert mock_db.get_leased_filenames() == ["leased.mp4"]
+    assert mock_db.reap_expired_transcodes() == []
+    assert not mock_db.complete_transcode(film.uuid, "b")
+    assert mock_db.complete_transcode(film.uuid, "a", "remux")
+    assert mock_db.get_leased_filenames() == []
+    with mock_db.pool.connection() as conn:
+        assert conn.execute(
+            "SELECT transcode_method FROM film WHERE uuid = %s", (film.uuid,)
+        ).fetchone() == ("remux",)
+    assert not mock_db.complete_transcode(film.uuid, "a")
+
+
+@pytest.mark.order(306)
+def test_reap_expired_transcodes(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["crashed"])
+    (film,) = mock_db.get_not_transcoded_and_set_transcoding_batch(
+        1, worker_id="a", lease_seconds=0
+    )
+    assert mock_db.get_leased_filenames() == []
+    assert mock_db.reap_expired_transcodes(max_attempts=2) == [film.uuid]
+    assert mock_db.get_transcode_backlog() == 1
+    assert not mock_db.complete_transcode(film.uuid, "a")  # the lease is gone
+    mock_db.get_not_transcoded_and_set_transcoding_batch(
+        1, worker_id="b", lease_seconds=0
+    )
+    assert mock_db.reap_expired_transcodes(max_attempts=2) == []  # out of attempts
+    assert mock_db.get_transcode_backlog() == 0
+    assert mock_db.get_leased_filenames() == []
+    (failed,) = mock_db.get_transcode_queue().failed
+    assert (failed.uuid, failed.state, failed.attempts) == (
+        film.uuid,
+        FilmState.FAILED,
+        2,
+    )
+
+    assert mock_db.retry_transcode(film.uuid)
+    assert not mock_db.retry_transcode(film.uuid)  # queued, no longer failed
+    assert mock_db.get_transcode_backlog() == 1
+    (retried,) = mock_db.get_transcode_queue().queued
+    assert (retried.uuid, retried.attempts) == (film.uuid, 0)
+
+
+@pytest.mark.order(307)
+def test_sweep_orphans(mock_db: Database, tmp_path: Path) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["leased", "orphan", "shelf/leased"])
+    supervisor = Supervisor(mock_db, job=succeed, workers=1, poll_interval=0.1)
+    mock_db.get_not_transcoded_and_set_transcoding_batch(
+        3, worker_id=supervisor.worker_id
+    )
+    (tmp_path / "leased.mp4").write_bytes(b"film")
+    (tmp_path / f"leased.mp4{PARTIAL_SUFFIX}").write_bytes(b"partial")
+    (tmp_path / f"leased.mp4.chunks{PARTIAL_SUFFIX}").mkdir()
+    (tmp_path / f"orphan.mp4.chunks{PARTIAL_SUFFIX}").mkdir()
+    (tmp_path / f"orphan.mp4{PARTIAL_SUFFIX}").write_bytes(b"partial")
+    (tmp_path / f"orphan.mp4.abr{PARTIAL_SUFFIX}").mkdir()
+    (tmp_path / f"orphan.mp4.abr{PARTIAL_SUFFIX}" / "init-0.m4s").write_bytes(b"")
+    (tmp_path / f"orphan.mp4.abr{PARTIAL_SUFFIX}" / f"0{PARTIAL_SUFFIX}").mkdir()
+    (tmp_path / "shelf").mkdir()
+    (tmp_path / "shelf" / f"leased.mp4{PARTIAL_SUFFIX}").write_bytes(b"partial")
+    (tmp_path / "shelf" / f"orphan.mp4{PARTIAL_SUFFIX}").write_bytes(b"partial")
+    orphan = next(i for i in mock_db.get_all_films() if i.title == "orphan")
+    assert orphan.uuid
+    mock_db.requeue_transcode(orphan.uuid, supervisor.worker_id)
+    assert sorted(
+        i.relative_to(tmp_path).as_posix() for i in supervisor.sweep_orphans(tmp_path)
+    ) == [
+        f"orphan.mp4.abr{PARTIAL_SUFFIX}",
+        f"orphan.mp4{PARTIAL_SUFFIX}",
+        f"orphan.mp4.chunks{PARTIAL_SUFFIX}",
+        f"shelf/orphan.mp4{PARTIAL_SUFFIX}",
+    ]
+    assert sorted(i.relative_to(tmp_path).as_posix() for i in tmp_path.rglob("*")) == [
+        "leased.mp4",
+        f"leased.mp4{PARTIAL_SUFFIX}",
+        f"leased.mp4.chunks{PARTIAL_SUFFIX}",
+        "shelf",
+        f"shelf/leased.mp4{PARTIAL_SUFFIX}",
+    ]
+
+
+@pytest.mark.order(308)
+def test_supervisor_progress(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["reported"])
+    supervisor = Supervisor(
+        mock_db,
+        job=report_and_hang,
+        workers=1,
+        poll_interval=0.1,
+        progress_interval=0.1,
+    )
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        (film,) = mock_db.get_all_films()
+        deadline = time.monotonic() + 10
+        while (status := mock_db.get_transcode_status(film.uuid)) is None or (  # type: ignore[arg-type]
+            status.progress is None
+        ):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert status.worker_id == supervisor.worker_id
+        # the second report came within PROGRESS_INTERVAL of the first, so it was dropped.
+        assert status.progress.frame == 25
+        assert status.progress.eta == 9.0
+    finally:
+        supervisor.stop(drain=False)
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert mock_db.get_transcode_status(film.uuid).progress is None  # type: ignore[arg-type, union-attr]
+
+
+@pytest.mark.order(309)
+def test_supervisor_images(mock_db: Database) -> None:
+    for film in mock_db.get_all_films():
+        mock_db.delete_film(film.uuid)  # type: ignore[arg-type]
+    insert_films(mock_db, ["without images"], images=False)
+    insert_films(mock_db, ["with images"])
+    supervisor = Supervisor(mock_db, job=extract_images, workers=1, poll_interval=0.1)
+    run_until_idle(supervisor, mock_db)
+    images = {
+        film.title: (
+            mock_db.get_thumbnail(film.uuid),  # type: ignore[arg-type]
+            mock_db.get_poster(film.uuid),  # type: ignore[arg-type]
+        )
+        for film in mock_db.get_all_films()
+    }
+    assert images == {
+        "without images": (b"extracted thumbnail", b"extracted poster"),
+        "with images": (b"thumbnail", b"poster"),
+    }
+
+
+@pytest.mark.skipif(
+    not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="needs ffmpeg"
+)
+@pytest.mark.parametrize("split_threshold", [0, 1])
+def test_transcode(tmp_path: Path, split_threshold: float) -> None:
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error",
+            "-f", "lavfi", "-i", "testsrc=duration=4:size=160x120:rate=25",
+            "-f", "lavfi", "-i", "sine=duration=4",
+            "-c:v", "mpeg4", "-c:a", "mp3", "-f", "matroska", str(tmp_path / "film.mp4"),
+        ],
+        check=True,
+    )  # fmt: skip
+    film = FilmNoBytes(
+        uuid=None,
+        title="film",
+        date_added=datetime.datetime.now(),
+        filename="film.mp4",
+        watched=False,
+        state=FilmState.TRANSCODING,
+        rating=None,  # type: ignore[arg-type]
+        actresses=[],
+    )
+    result = transcode(
+        film, tmp_path, "progressive", 2, split_threshold=split_threshold
+    )
+    assert result.method == "encode"
+    # extracted in the same pass as the encode, or by seeking once encoded in chunks.
+    assert result.thumbnail is not None and result.thumbnail.startswith(PNG)
+    assert result.poster is not None and result.poster.startswith(PNG)
+    assert [i.name for i in tmp_path.iterdir()] == ["film.mp4"]
+    result = transcode(film, tmp_path, "progressive", 2)
+    assert result.method == "skip"
+    assert result.thumbnail is not None and result.thumbnail.startswith(PNG)
@@ -0,0 +1,32 @@
+import pytest
+
+from util.video import MAX_RANGES, parse_range
+
+
+def test_parse_range_whole_file() -> None:
+    assert parse_range(None, 100) is None
+    assert parse_range("items=0-5", 100) is None
+    assert parse_range("bytes=5-1", 100) is None  # malformed; ignored
+    assert parse_range("bytes=a-b", 100) is None
+    assert parse_range("bytes=-", 100) is None
+    many = ",".join(f"{i}-{i}" for i in range(MAX_RANGES + 1))
+    assert parse_range(f"bytes={many}", 100) is None
+
+
+def test_parse_range() -> None:
+    assert parse_range("bytes=0-9", 100) == [(0, 9)]
+    assert parse_range("bytes=90-", 100) == [(90, 99)]
+    assert parse_range("bytes=90-500", 100) == [(90, 99)]
+    assert parse_range("bytes=-10", 100) == [(90, 99)]
+    assert parse_range("bytes=-500", 100) == [(0, 99)]
+    assert parse_range("bytes=0-0, 50-59, -1", 100) == [(0, 0), (50, 59), (99, 99)]
+    assert parse_range("bytes=0-9, 200-", 100) == [(0, 9)]
+
+
+def test_parse_range_not_satisfiable() -> None:
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+    with pytest.raises(ValueError):
+        parse_range("bytes=-0", 100)
+    with pytest.raises(ValueError):
+        parse_range("bytes=0-", 0)
@@ -1,13 +1,42 @@
+import functools
 import logging
+import multiprocessing
 import os
+import queue
 import shutil
+import signal
+import socket
+import tempfile
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import Callable, Literal, TypeAlias
+from uuid import UUID, uuid4
 
 import ffmpeg
 
-from util.database.database import Database
-from util.models.film import FilmState
+from util.database.database import (
+    DEFAULT_LEASE_SECONDS,
+    MAX_TRANSCODE_ATTEMPTS,
+    Database,
+)
+from util.database.listener import TranscodeListener
+from util.models.film import FilmNoBytes
+from util.models.transcode import TranscodeProgress
+from util.streaming import STREAM_DIRECTORY_SUFFIX
+from util.streaming.ladder import package
+from util.transcode import (
+    Probe,
+    TranscodeMethod,
+    TranscodeResult,
+    decide,
+    encode,
+    probe,
+    remux,
+)
+from util.transcode.chunked import SPLIT_THRESHOLD, SyncError, encode_chunked
+from util.transcode.images import choose_images, sample_candidates
 
 
 def ensure_io_permissions(path: Path) -> bool:
@@ -19,52 +48,479 @@ def ensure_io_permissions(path: Path) -> bool:
     )
 
 
-def encode(input_file: Path, output_file: Path) -> None:
-    ...
+Packaging = Literal["progressive", "adaptive"]
 
+# suffix of the partial output of a transcode, a file or a directory next to the film file.
+PARTIAL_SUFFIX = ".artranscode"
 
-def delete(file: Path) -> None:
-    assert file.exists()
-    assert file.is_file()
-    assert not file.is_dir()
-    shutil.rmtree(path=file)
+# suffix of the directory of the chunks of a film encoded in chunks.
+CHUNK_DIRECTORY_SUFFIX = ".chunks"
 
+# seconds between the progress reports of a worker; the supervisor batches them into fewer writes.
+PROGRESS_INTERVAL = 1.0
 
-def rename(target: Path, destination: Path) -> None:
-    assert target.exists()
-    assert target.is_file()
-    assert destination.is_file()
-    target.rename(destination)
+ProgressQueue: TypeAlias = "multiprocessing.Queue[tuple[UUID, TranscodeProgress]]"
 
+# set in each worker process by init_worker.
+_progress_queue: "ProgressQueue | None" = None
 
-def main() -> int:
-    db = Database.from_env(load_dot_env=True)
-    db.database_init(Path("../util/database/schema.sql").read_text())
 
-    sleep_time = int(os.environ["TRANSCODER_SLEEP_TIME"])
-    media_path = Path(os.environ["APP_FILM_PATH"])
+def init_worker(
+    progress_queue: ProgressQueue, pid_queue: "multiprocessing.Queue[int]"
+) -> None:
+    """
+    :param progress_queue: the progress of the films is sent to the supervisor through it.
+    :param pid_queue: the worker sends its pid through it, for the supervisor to interrupt it.
+    """
+    global _progress_queue
+    # workers get their own process group, so a ctrl-c in the terminal only reaches the supervisor.
+    os.setpgrp()
+    _progress_queue = progress_queue
+    pid_queue.put(os.getpid())
+
+
+def report_progress(film: FilmNoBytes) -> Callable[[TranscodeProgress], None]:
+    """
+    :param film: film transcoded by this worker
+    :return: sends the progress of the film to the supervisor, at most every PROGRESS_INTERVAL seconds.
+    """
+    last = 0.0
+
+    def report(progress: TranscodeProgress) -> None:
+        nonlocal last
+        if _progress_queue is None or time.monotonic() - last < PROGRESS_INTERVAL:
+            return
+        last = time.monotonic()
+        assert film.uuid
+        _progress_queue.put((UUID(str(film.uuid)), progress))
+
+    return report
+
+
+def transcode(
+    film: FilmNoBytes,
+    media_path: Path,
+    packaging: Packaging,
+    threads: int,
+    split_threshold: float = SPLIT_THRESHOLD,
+) -> TranscodeResult:
+    """
+    Transcodes the file of a film, and extracts a thumbnail and a poster from it. Runs in a worker process of the
+    supervisor.
+    :param film:
+    :param media_path: directory of the film files
+    :param packaging: progressive: a single mp4 replaces the film. adaptive: a bitrate ladder is written next to it.
+    :param threads: threads ffmpeg may use
+    :param split_threshold: films at least this many seconds long are encoded in chunks, threads chunks at once.
+    0 never splits.
+    :return: how the film was made playable, and its images.
+    """
+    with tempfile.TemporaryDirectory(prefix="abstracted.reaction-frames-") as frames:
+        method, source = _transcode(
+            film, media_path, packaging, threads, split_threshold, Path(frames)
+        )
+        if (
+            source.video_codec is not None
+            and source.duration is not None
+            and not any(Path(frames).iterdir())
+        ):
+            # the film wasn't decoded whole; seeking to each candidate decodes a few frames each.
+            try:
+                sample_candidates(
+                    media_path / film.filename, source.duration, Path(frames)
+                )
+            except ffmpeg.Error as e:
+                # the film is playable; it only goes without images.
+                logging.warning(
+                    f"Extracting the images of film {film.uuid} failed: {e!r}"
+                )
+        images = choose_images(Path(frames))
+    if images is None:
+        return TranscodeResult(method)
+    return TranscodeResult(method, *images)
+
 
-    while True:
-        if (film := db.get_not_transcoded_and_set_transcoding()) is None:
-            logging.info(
-                f"No films waiting for transcode. Waiting {sleep_time} seconds."
+def _transcode(
+    film: FilmNoBytes,
+    media_path: Path,
+    packaging: Packaging,
+    threads: int,
+    split_threshold: float,
+    frames: Path,
+) -> tuple[TranscodeMethod | None, Probe]:
+    """
+    :param frames: directory the candidate frames are extracted to, when the film is encoded in a single pass.
+    :return: how the film was made playable, none for adaptive packaging; and the probe of the film.
+    """
+    film_file_path = media_path / film.filename
+    on_progress = report_progress(film)
+    source = probe(film_file_path)
+    if packaging == "adaptive":
+        package(input_file=film_file_path, threads=threads, on_progress=on_progress)
+        return None, source
+    method = decide(source)
+    if method == "skip":
+        return method, source
+    transcoded_file_path = media_path / f"{film.filename}{PARTIAL_SUFFIX}"
+    split = bool(split_threshold) and (source.duration or 0) >= split_threshold
+    if method in ("remux", "audio"):
+        remux(
+            input_file=film_file_path,
+            output_file=transcoded_file_path,
+            source=source,
+            on_progress=on_progress,
+        )
+    elif split:
+        try:
+            encode_chunked(
+                input_file=film_file_path,
+                output_file=transcoded_file_path,
+                source=source,
+                work_directory=media_path
+                / f"{film.filename}{CHUNK_DIRECTORY_SUFFIX}{PARTIAL_SUFFIX}",
+                workers=max(threads, 1),
+                on_progress=on_progress,
+            )
+        except SyncError as e:
+            logging.warning(
+                f"Chunks of film {film.uuid} are out of sync ({e}), encoding it whole."
             )
-            time.sleep(sleep_time)
-            continue
-        film_file_path = media_path / film.filename
-        transcoded_file_path = media_path / f"{film.filename}.artranscode"
+            split = False
+    if method == "encode" and not split:
         encode(
             input_file=film_file_path,
             output_file=transcoded_file_path,
+            source=source,
+            threads=threads,
+            on_progress=on_progress,
+            candidates=frames,
+        )
+    # replaces the film in one step, so it is never missing.
+    transcoded_file_path.replace(film_file_path)
+    return method, source
+
+
+class Supervisor:
+    def __init__(
+        self,
+        db: Database,
+        job: Callable[[FilmNoBytes], TranscodeResult | None],
+        workers: int,
+        poll_interval: float,
+        report_interval: float = 60.0,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = MAX_TRANSCODE_ATTEMPTS,
+        media_path: Path | None = None,
+        progress_interval: float = 5.0,
+    ) -> None:
+        """
+        Runs jobs on a pool of worker processes. Free workers are filled by claiming that many films in one query.
+        While the queue is empty, the supervisor waits for wake(), polling every poll_interval seconds as a fallback.
+        Claimed films are leased to this supervisor, and the leases renewed while the films are transcoded.
+        Films whose lease expired, because their transcoder crashed, hung or failed, are put back in the queue
+        by whichever supervisor notices first.
+        :param db:
+        :param job: transcodes a film and returns how, and the images extracted from it; must be picklable.
+        :param workers: number of worker processes
+        :param poll_interval: seconds between claims while the queue is empty and no wake-up came
+        :param report_interval: seconds between throughput reports
+        :param lease_seconds: how long a film stays claimed without a heartbeat
+        :param max_attempts: failed transcodes are retried until a film was claimed that many times
+        :param media_path: directory of the film files, swept for partial outputs of dead transcodes. None to skip.
+        :param progress_interval: seconds between the writes of the progress of the films in progress
+        """
+        self.db = db
+        self.job = job
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.media_path = media_path
+        self.progress_interval = progress_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.completed = 0
+        self.failed = 0
+        self.stopping = False  # finish the films in progress, claim no more.
+        self.aborting = (
+            False  # interrupt the films in progress, and put them back in the queue.
         )
+        self._wake = threading.Event()
+
+    def stop(self, drain: bool = True) -> None:
+        """
+        Stops the supervisor. Safe to call from a signal handler.
+        :param drain: wait for the films in progress to finish. If False, they are interrupted and re-queued.
+        """
+        self.stopping = True
+        self.aborting = self.aborting or not drain
+        self._wake.set()
+
+    def wake(self) -> None:
+        """
+        Claims films right away instead of waiting for the next poll. Safe to call from any thread.
+        """
+        self._next_claim = 0.0
+        self._wake.set()
+
+    def run(self) -> None:
+        """
+        Transcodes films until stopped.
+        """
+        started = last_report = last_heartbeat = last_progress = time.monotonic()
+        self._next_claim = 0.0
+        # renewed a few times per lease, so a slow database round trip doesn't cost a lease.
+        heartbeat_interval = self.lease_seconds / 3
+        reap_interval = self.lease_seconds / 2
+        next_reap = 0.0
+        in_progress: dict[Future[TranscodeResult | None], FilmNoBytes] = dict()
+        # latest progress of each film, written in one batch every progress_interval.
+        progress_queue: ProgressQueue = multiprocessing.Queue()
+        progress: dict[UUID, TranscodeProgress] = dict()
+        pid_queue: "multiprocessing.Queue[int]" = multiprocessing.Queue()
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(progress_queue, pid_queue),
+        )
+        try:
+            while not self.aborting:
+                # cleared before looking at the state, so a wake-up in between is never lost.
+                self._wake.clear()
+                while True:
+                    try:
+                        uuid, film_progress = progress_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    progress[uuid] = film_progress
+                for future in [i for i in in_progress if i.done()]:
+                    film = in_progress.pop(future)
+                    progress.pop(UUID(str(film.uuid)), None)
+                    self._finish(film, future)
+                    self._next_claim = 0.0  # a worker was freed; refill it right away.
+
+                if (
+                    not self.stopping
+                    and len(in_progress) < self.workers
+                    and time.monotonic() >= self._next_claim
+                ):
+                    self._next_claim = time.monotonic() + self.poll_interval
+                    claimed = self.db.get_not_transcoded_and_set_transcoding_batch(
+                        self.workers - len(in_progress),
+                        worker_id=self.worker_id,
+                        lease_seconds=self.lease_seconds,
+                    )
+                    for film in claimed:
+                        future = pool.submit(self.job, film)
+                        future.add_done_callback(lambda _: self._wake.set())
+                        in_progress[future] = film
+
+                if self.stopping and not in_progress:
+                    break
+                if (
+                    in_progress
+                    and time.monotonic() - last_heartbeat >= heartbeat_interval
+                ):
+                    last_heartbeat = time.monotonic()
+                    self._heartbeat(list(in_progress.values()))
+                if (
+                    progress
+                    and time.monotonic() - last_progress >= self.progress_interval
+                ):
+                    last_progress = time.monotonic()
+                    self.db.record_transcode_progress(progress, self.worker_id)
+                    progress.clear()
+                if not self.stopping and time.monotonic() >= next_reap:
+                    next_reap = time.monotonic() + reap_interval
+                    if self.reap():
+                        self._next_claim = 0.0
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self._report(last_report - started)
+
+                deadlines = [last_report + self.report_interval]
+                if in_progress:
+                    deadlines.append(last_heartbeat + heartbeat_interval)
+                    deadlines.append(last_progress + self.progress_interval)
+                if not self.stopping:
+                    deadlines.append(next_reap)
+                    if len(in_progress) < self.workers:
+                        # the poll is only a safety net; wake() ends the wait as soon as films are queued.
+                        deadlines.append(self._next_claim)
+                self._wake.wait(max(min(deadlines) - time.monotonic(), 0))
+        finally:
+            if in_progress:
+                self._abort(pid_queue, in_progress)
+            pool.shutdown(wait=True, cancel_futures=True)
+            self._report(time.monotonic() - started)
+
+    def reap(self) -> list[UUID]:
+        """
+        Puts the films whose lease expired back in the queue, then deletes the partial outputs nobody holds a
+        lease for.
+        :return: uuids of the films put back in the queue
+        """
+        reaped = self.db.reap_expired_transcodes(self.max_attempts)
+        if reaped:
+            logging.warning(f"Lease of {len(reaped)} films expired, queued them again.")
+        if self.media_path is not None:
+            for orphan in self.sweep_orphans(self.media_path):
+                logging.warning(f"Deleted partial transcode {orphan}.")
+        return reaped
+
+    def sweep_orphans(self, media_path: Path) -> list[Path]:
+        """
+        Deletes the partial outputs of the transcodes that are no longer leased, in the directories of the film files
+        as well.
+        :param media_path: directory of the film files
+        :return: the deleted paths
+        """
+        # listed before the leases are read: a partial written after the read belongs to a film claimed after it.
+        partials = sorted(media_path.rglob(f"*{PARTIAL_SUFFIX}"))
+        leased = set(self.db.get_leased_filenames())
+        deleted: list[Path] = list()
+        for partial in partials:
+            if any(partial.is_relative_to(i) for i in deleted):
+                continue  # inside a partial directory that was swept
+            # the film filenames are relative to the media path.
+            filename = (
+                partial.relative_to(media_path).as_posix().removesuffix(PARTIAL_SUFFIX)
+            )
+            for suffix in (STREAM_DIRECTORY_SUFFIX, CHUNK_DIRECTORY_SUFFIX):
+                filename = filename.removesuffix(suffix)
+            if filename in leased:
+                continue
+            try:
+                if partial.is_dir():
+                    shutil.rmtree(partial)
+                else:
+                    partial.unlink()
+            except FileNotFoundError:
+                continue  # swept by another supervisor
+            deleted.append(partial)
+        return deleted
+
+    def _heartbeat(self, films: list[FilmNoBytes]) -> None:
+        uuids = [film.uuid for film in films if film.uuid]
+        renewed = set(
+            self.db.renew_transcode_leases(uuids, self.worker_id, self.lease_seconds)
+        )
+        for lost in set(uuids) - renewed:
+            logging.warning(
+                f"Lost the lease of film {lost}; it may be transcoded twice."
+            )
+
+    def _finish(
+        self, film: FilmNoBytes, future: Future[TranscodeResult | None]
+    ) -> None:
+        assert film.uuid
+        if (exception := future.exception()) is not None:
+            # the lease is released; the reaper queues it again until it used up its attempts.
+            self.failed += 1
+            logging.error(f"Transcode of film {film.uuid} failed: {exception!r}")
+            self.db.fail_transcode(film.uuid, self.worker_id)
+            return
+        self.completed += 1
+        result = future.result()
+        method = result.method if result is not None else None
+        if method is not None:
+            logging.info(f"Film {film.uuid} transcoded by {method}.")
+        if result is not None and (result.thumbnail or result.poster):
+            self.db.set_missing_film_images(film.uuid, result.thumbnail, result.poster)
+        if not self.db.complete_transcode(film.uuid, self.worker_id, method):
+            # deleted, or the lease expired and the film was queued again.
+            logging.warning(
+                f"Lost the lease of film {film.uuid} before it was complete."
+            )
+
+    def _abort(
+        self,
+        pid_queue: "multiprocessing.Queue[int]",
+        in_progress: dict[Future[TranscodeResult | None], FilmNoBytes],
+    ) -> None:
+        """
+        :param pid_queue: pids of the workers of the pool, sent by init_worker
+        :param in_progress:
+        """
+        logging.warning(f"Interrupting {len(in_progress)} transcodes.")
+        pids = set()
+        while True:
+            try:
+                pids.add(pid_queue.get(timeout=0.1))
+            except queue.Empty:
+                break
+        for pid in pids:
+            try:
+                os.killpg(pid, signal.SIGTERM)  # the worker and its ffmpeg
+            except ProcessLookupError:
+                pass
+        for film in in_progress.values():
+            assert film.uuid
+            self.db.requeue_transcode(film.uuid, self.worker_id)
+
+    def _report(self, elapsed: float) -> None:
+        backlog = self.db.get_transcode_backlog()
+        rate = self.completed / elapsed * 3600 if elapsed else 0.0
+        eta = f"{backlog / rate:.1f} hours" if rate else "unknown"
+        logging.info(
+            f"Transcoded {self.completed} films ({self.failed} failed) in {elapsed / 3600:.2f} hours, "
+            f"{rate:.1f} films/hour. {backlog} films waiting, done in {eta}."
+        )
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO)
+    db = Database.from_env(load_dot_env=True)
+    db.database_init(Path("../util/database/schema.sql").read_text())
+
+    sleep_time = int(os.environ["TRANSCODER_SLEEP_TIME"])
+    media_path = Path(os.environ["APP_FILM_PATH"])
+    packaging: Packaging = os.environ.get("TRANSCODER_PACKAGING", "progressive")  # type: ignore[assignment]
+    assert packaging in ("progressive", "adaptive")
+    # each film is given a fixed thread budget; the cores are shared out between that many workers.
+    threads = int(os.environ.get("TRANSCODER_THREADS_PER_JOB", 4))
+    workers = int(
+        os.environ.get("TRANSCODER_WORKERS", max((os.cpu_count() or 1) // threads, 1))
+    )
+    # films at least this long are split in chunks, encoded threads at a time. 0 never splits.
+    split_threshold = float(
+        os.environ.get("TRANSCODER_SPLIT_THRESHOLD", SPLIT_THRESHOLD)
+    )
+    logging.info(f"Starting {workers} transcode workers, {threads} threads each.")
+
+    supervisor = Supervisor(
+        db,
+        job=functools.partial(
+            transcode,
+            media_path=media_path,
+            packaging=packaging,
+            threads=threads,
+            split_threshold=split_threshold,
+        ),
+        workers=workers,
+        poll_interval=sleep_time,
+        lease_seconds=int(
+            os.environ.get("TRANSCODER_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)
+        ),
+        max_attempts=int(
+            os.environ.get("TRANSCODER_MAX_ATTEMPTS", MAX_TRANSCODE_ATTEMPTS)
+        ),
+        media_path=media_path,
+    )
+
+    def on_signal(*_: object) -> None:
+        # the first signal lets the films in progress finish, the second interrupts them.
+        logging.info("Stopping transcoder.")
+        supervisor.stop(drain=not supervisor.stopping)
 
-        delete(file=film_file_path)
-        rename(target=transcoded_file_path, destination=film_file_path)
-        updated_film = db.get_single_film(
-            film.uuid
-        )  # fetch again to ensure data is the most up to date.
-        updated_film.state = FilmState.COMPLETE
-        db.update_film(updated_film)
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+    listener = TranscodeListener(db.conninfo, on_notify=supervisor.wake)
+    listener.start()
+    try:
+        supervisor.run()
+    finally:
+        listener.stop()
     return 0
 
 
@@ -0,0 +1,359 @@
+import bisect
+import dataclasses
+import gzip
+import re
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable
+from uuid import UUID
+
+try:
+    import brotli  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    brotli = None  # brotli is optional; responses fall back to gzip.
+
+from util.models.film import FilmNoBytes
+from util.models.film_changes import FilmChanges
+from util.models.search import SearchCompletion, SearchField
+
+
+def accepted_codings(accept_encoding: str | None) -> set[str]:
+    """
+    Reads the content codings a client accepts. Codings with a quality of 0, or a malformed one, are refused.
+    :param accept_encoding: value of the Accept-Encoding request header
+    :return: lowercase names of the accepted codings
+    """
+    accepted = set()
+    for coding in (accept_encoding or "").split(","):
+        name, *params = (i.strip() for i in coding.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name.lower())
+    return accepted
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    entries: int
+    size_bytes: int
+    max_bytes: int
+
+
+class LRUByteCache:
+    def __init__(self, max_bytes: int) -> None:
+        """
+        Least-recently-used cache of bytes values, bounded by the total size of the stored values
+        rather than by the number of entries.
+        :param max_bytes: memory budget in bytes. A budget of 0 disables the cache.
+        """
+        if max_bytes < 0:
+            raise ValueError("max_bytes must not be negative")
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+        # the routes use it from the event loop; the lock guards calls made from to_thread workers
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> bytes | None:
+        """
+        Gets a value and marks it as the most recently used.
+        :param key:
+        :return: bytes, none if not cached.
+        """
+        with self._lock:
+            value = self._entries.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """
+        Stores a value, evicting the least recently used entries until it fits the budget.
+        Values larger than the whole budget are not stored.
+        :param key:
+        :param value:
+        """
+        size = len(value)
+        with self._lock:
+            if (previous := self._entries.pop(key, None)) is not None:
+                self.size_bytes -= len(previous)
+            if size > self.max_bytes:
+                return
+            while self.size_bytes + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+            self._entries[key] = value
+            self.size_bytes += size
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drops a single entry, if it is cached.
+        :param key:
+        """
+        with self._lock:
+            if (value := self._entries.pop(key, None)) is not None:
+                self.size_bytes -= len(value)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+                entries=len(self._entries),
+                size_bytes=self.size_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+@dataclasses.dataclass
+class EncodedBody:
+    etag: str
+    identity: bytes
+    gzip: bytes
+    br: bytes | None
+
+    @classmethod
+    def encode(cls, body: bytes, etag: str) -> "EncodedBody":
+        """
+        Compresses a response body once, so that every request for it can be answered from memory.
+        :param body: uncompressed response body
+        :param etag: entity tag of the body, including its quotes
+        :return:
+        """
+        return EncodedBody(
+            etag=etag,
+            identity=body,
+            gzip=gzip.compress(body, compresslevel=6),
+            br=brotli.compress(body, quality=5) if brotli is not None else None,
+        )
+
+    def negotiate(self, accept_encoding: str | None) -> tuple[bytes, str | None]:
+        """
+        Picks the smallest representation accepted by the client.
+        :param accept_encoding: value of the Accept-Encoding request header
+        :return: body, value of the Content-Encoding response header
+        """
+        accepted = accepted_codings(accept_encoding)
+        if self.br is not None and "br" in accepted:
+            return self.br, "br"
+        if "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.identity, None
+
+    def matches(self, if_none_match: str | None) -> bool:
+        """
+        Weak comparison of the entity tag against the If-None-Match request header.
+        :param if_none_match:
+        :return: True if the client's copy is current
+        """
+        if if_none_match is None:
+            return False
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or self.etag.removeprefix("W/") in tags
+
+
+class ActressIndex:
+    def __init__(self, films: Iterable[FilmNoBytes] = ()) -> None:
+        """
+        Inverted index of the actresses of a list of films, so the actress endpoints are answered without
+        scanning the film table.
+        :param films: in the order the films of an actress are listed
+        """
+        self._films: dict[UUID, FilmNoBytes] = dict()
+        self._uuids: dict[str, list[UUID]] = dict()
+        for film in films:
+            assert film.uuid
+            uuid = UUID(str(film.uuid))
+            self._films[uuid] = film
+            for name in dict.fromkeys(film.actresses):  # listed twice, counted once
+                self._uuids.setdefault(name, []).append(uuid)
+
+    def __len__(self) -> int:
+        return len(self._uuids)
+
+    def names(self) -> list[str]:
+        """
+        :return: every actress, by name
+        """
+        return sorted(self._uuids)
+
+    def counts(self) -> dict[str, int]:
+        """
+        :return: number of films of every actress, by name
+        """
+        return {name: len(self._uuids[name]) for name in self.names()}
+
+    def films(self, name: str) -> list[FilmNoBytes]:
+        """
+        :param name:
+        :return: films of the actress, empty if the name isn't in the index.
+        """
+        return [self._films[uuid] for uuid in self._uuids.get(name, ())]
+
+
+def apply_film_changes(
+    films: list[FilmNoBytes], changes: FilmChanges
+) -> list[FilmNoBytes]:
+    """
+    :param films: list the changes are applied to; left as it is.
+    :param changes:
+    :return: the updated list. Updated films keep their place; inserted ones are added at the end.
+    """
+    upserted = {UUID(str(i.uuid)): i for i in changes.upserted}
+    gone = set(changes.deleted)
+    output = list()
+    for film in films:
+        uuid = UUID(str(film.uuid))
+        if uuid in gone:
+            continue
+        output.append(upserted.pop(uuid, film))
+    output.extend(upserted.values())
+    return output
+
+
+def search_words(text: str) -> list[str]:
+    """
+    :param text:
+    :return: the words of the text, lowercased; punctuation and spacing are dropped.
+    """
+    return re.findall(r"[^\W_]+", text.lower())
+
+
+class PrefixIndex:
+    # above this many keys changed at once, the keys are re-sorted instead of inserted one at a time.
+    BULK_CHANGES = 256
+
+    def __init__(self) -> None:
+        """
+        Sorted index of the titles and actresses of films, for typeahead completions. Each title and name is
+        indexed from each of its words on, so "red" completes "Big Red Car" too. Films are indexed
+        incrementally: an update only re-indexes the films that changed since the previous one.
+        """
+        # what is indexed of each film: its title and actresses.
+        self._films: dict[UUID, tuple[str, tuple[str, ...]]] = dict()
+        # films of each title and actress indexed
+        self._counts: dict[tuple[SearchField, str], int] = dict()
+        # the words of a title or name from one of its words on, field, the title or name as written; sorted.
+        self._keys: list[tuple[str, SearchField, str]] = list()
+        # taken in to_thread workers only: both update and complete are run off the event loop
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._films)
+
+    @staticmethod
+    def _entries(indexed: tuple[str, tuple[str, ...]]) -> list[tuple[SearchField, str]]:
+        title, actresses = indexed
+        return [("title", title), *(("actress", name) for name in actresses)]
+
+    @staticmethod
+    def _keys_of(field: SearchField, text: str) -> list[tuple[str, SearchField, str]]:
+        words = search_words(text)
+        return [(" ".join(words[i:]), field, text) for i in range(len(words))]
+
+    def update(self, films: Iterable[FilmNoBytes]) -> int:
+        """
+        Brings the index up to date with a list of films.
+        :param films: every film; films left out are dropped from the index.
+        :return: number of films re-indexed or dropped
+        """
+        current = {
+            UUID(str(film.uuid)): (film.title, tuple(dict.fromkeys(film.actresses)))
+            for film in films
+        }
+        with self._lock:
+            changed = [
+                uuid
+                for uuid in self._films.keys() | current.keys()
+                if self._films.get(uuid) != current.get(uuid)
+            ]
+            added: list[tuple[str, SearchField, str]] = list()
+            removed: set[tuple[str, SearchField, str]] = set()
+            for uuid in changed:
+                if (previous := self._films.pop(uuid, None)) is not None:
+                    for entry in self._entries(previous):
+                        self._counts[entry] -= 1
+                        if not self._counts[entry]:
+                            del self._counts[entry]
+                            removed.update(self._keys_of(*entry))
+                if (indexed := current.get(uuid)) is not None:
+                    self._films[uuid] = indexed
+                    for entry in self._entries(indexed):
+                        self._counts[entry] = self._counts.get(entry, 0) + 1
+                        if self._counts[entry] == 1:
+                            added.extend(self._keys_of(*entry))
+            # a title or name dropped and added back within the update is in both.
+            kept = removed.intersection(added)
+            removed -= kept
+            added = [key for key in added if key not in kept]
+            if len(added) + len(removed) > self.BULK_CHANGES:
+                self._keys = sorted(
+                    [key for key in self._keys if key not in removed] + added
+                )
+            else:
+                for key in removed:
+                    del self._keys[bisect.bisect_left(self._keys, key)]
+                for key in added:
+                    bisect.insort(self._keys, key)
+            return len(changed)
+
+    def complete(self, prefix: str, limit: int) -> list[SearchCompletion]:
+        """
+        :param prefix: as typed
+        :param limit: maximum number of completions
+        :return: the titles and actresses with a word starting with the prefix, in alphabetical order from that
+        word on.
+        """
+        if not (normalized := " ".join(search_words(prefix))):
+            return list()
+        found: dict[tuple[SearchField, str], None] = dict()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (normalized,))
+            while (
+                len(found) < limit
+                and i < len(self._keys)
+                and self._keys[i][0].startswith(normalized)
+            ):
+                _, field, text = self._keys[i]
+                found[field, text] = None
+                i += 1
+            return [
+                SearchCompletion(
+                    text=text, field=field, films=self._counts[field, text]
+                )
+                for field, text in found
+            ]
@@ -0,0 +1,736 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from typing import Any, Iterable
+from uuid import UUID
+
+import psycopg_pool
+
+from util.database.database import (
+    ACTRESS_DETAIL_QUERY,
+    ACTRESS_LIST_QUERY,
+    ALL_FILMS_QUERY,
+    CHANGED_FILMS_AFTER_SEQ_QUERY,
+    CHANGED_FILMS_SINCE_QUERY,
+    CLAIM_NOT_TRANSCODED_QUERY,
+    COMPLETE_TRANSCODE_QUERY,
+    DEFAULT_INSERT_BATCH,
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_TRIM_BATCH,
+    DELETE_FILM_QUERY,
+    FAIL_TRANSCODE_QUERY,
+    FILENAME_QUERY,
+    FILMS_QUERY,
+    FUZZY_SEARCH_AVAILABLE_QUERY,
+    FUZZY_SEARCH_FILMS_QUERY,
+    HISTORY_VERSION_QUERY,
+    IMAGE_KEYS_QUERY,
+    INSERT_FILM_QUERY,
+    LATEST_COMMIT_QUERY,
+    LEASED_FILENAMES_QUERY,
+    LEGACY_IMAGES_QUERY,
+    MAX_TRANSCODE_ATTEMPTS,
+    MOVE_IMAGES_QUERY,
+    NOT_TRANSCODED_QUERY,
+    POSTER_QUERY,
+    POSTERS_QUERY,
+    REAP_EXPIRED_TRANSCODES_QUERY,
+    RECORD_PROGRESS_QUERY,
+    RENEW_LEASES_QUERY,
+    REQUEUE_TRANSCODE_QUERY,
+    RETRY_TRANSCODE_QUERY,
+    SEARCH_FILMS_QUERY,
+    SET_MISSING_POSTER_QUERY,
+    SET_MISSING_THUMBNAIL_QUERY,
+    SET_TRANSCODING_QUERY,
+    SINGLE_FILM_QUERY,
+    THUMBNAIL_QUERY,
+    THUMBNAILS_QUERY,
+    TRANSCODE_BACKLOG_QUERY,
+    TRANSCODE_QUEUE_QUERY,
+    TRANSCODE_STATUS_QUERY,
+    TRIM_HISTORY_QUERY,
+    UPDATE_FILM_QUERY,
+    UPDATE_RATING_QUERY,
+    DictRowFactory,
+    build_conninfo,
+    build_film_page_query,
+    check_not_trimmed,
+    config_from_env,
+    film_changes_from,
+    film_page_from_records,
+    film_row,
+    images_from_records,
+    insert_film_params,
+    pool_stats_from,
+    reconnect_timeout,
+    search_params,
+    transcode_status_from_record,
+)
+from util.image_store import ImageStore, LocalImageStore, PostgresImageStore
+from util.models.actress_detail import ActressDetail
+from util.models.film import Film, FilmNoBytes, FilmState
+from util.models.film_changes import FilmChanges
+from util.models.film_page import FilmPage, FilmPageQuery
+from util.models.pool import PoolStats
+from util.models.rating import Rating
+from util.models.transcode import TranscodeProgress, TranscodeQueue, TranscodeStatus
+from util.models.uuid import RecordUUIDLike
+
+
+class AsyncDatabase:
+    def __init__(
+        self,
+        db_name: str,
+        db_user: str,
+        db_password: str,
+        db_host: str,
+        db_port: str,
+        max_connections: int,
+        min_connections: int,
+        max_retries: int,
+        retry_interval: int,
+        image_store: ImageStore | None = None,
+    ) -> None:
+        """
+        asyncio counterpart of Database, with the same method surface and pool configuration.
+        The pool is bound to the event loop it is opened in; call open() from within the running loop.
+        :param image_store: where inserted images are written. Defaults to the film record itself.
+        """
+        self.image_store = image_store or PostgresImageStore()
+        # whether pg_trgm is installed; checked on the first search.
+        self.fuzzy_search: bool | None = None
+        self.conninfo = build_conninfo(db_name, db_user, db_password, db_host, db_port)
+        self.pool = psycopg_pool.AsyncConnectionPool(
+            self.conninfo,
+            open=False,
+            min_size=min_connections,
+            max_size=max_connections,
+            reconnect_timeout=reconnect_timeout(max_retries, retry_interval),
+        )
+
+    async def open(self) -> None:
+        await self.pool.open(wait=True, timeout=self.pool.reconnect_timeout)
+
+    async def get_pool_stats(self) -> PoolStats:
+        """
+        :return: size and usage of the connection pool; the counters run from when the pool was opened.
+        """
+        return pool_stats_from(self.pool.get_stats())
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def get_latest_commit_uuid(self) -> UUID | None:
+        """
+        Gets the uuid of the latest commit
+        :return: uuid - latest commit
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=DictRowFactory
+        ) as cur:
+            await cur.execute(LATEST_COMMIT_QUERY, prepare=True)
+            result: dict[str, UUID] | None = await cur.fetchone()
+            if result is not None:
+                return result["uuid"]
+            return None
+
+    async def get_changed_films_since(self, seq: int) -> list[UUID]:
+        """
+        Gets the uuids of the films that were updated or deleted after a history entry.
+        :param seq: of the history entry, as returned by get_history_seq
+        :return: list of film uuids
+        :raises ValueError: if history entries after it were trimmed
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(CHANGED_FILMS_SINCE_QUERY, (seq,))
+            pulled: list[tuple[UUID]] = await cur.fetchall()
+            await cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+            check_not_trimmed(await cur.fetchone(), seq)  # type: ignore[arg-type]
+            return [i[0] for i in pulled]
+
+    async def get_history_seq(self) -> int:
+        """
+        See Database.get_history_seq
+        :return: seq of the latest history entry, 0 if there is none.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+            result: tuple[int, int] = await cur.fetchone()  # type: ignore
+            return result[0]
+
+    async def trim_history(
+        self, retention: float, batch_size: int = DEFAULT_TRIM_BATCH
+    ) -> int:
+        """
+        See Database.trim_history
+        :param retention: seconds history entries are kept for
+        :param batch_size: maximum number of entries deleted
+        :return: number of entries deleted; less than batch_size once no entry is older than the retention.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(TRIM_HISTORY_QUERY, (retention, batch_size))
+            result: tuple[int] = await cur.fetchone()  # type: ignore
+            return result[0]
+
+    async def get_film_changes(self, since: int) -> FilmChanges:
+        """
+        See Database.get_film_changes
+        :param since: seq of the history entry the list is at, 0 for every film
+        :return:
+        :raises ValueError: if history entries after it were trimmed
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+                seq: int = (await cur.fetchone())[0]  # type: ignore[index]
+                await cur.execute(CHANGED_FILMS_AFTER_SEQ_QUERY, {"since": since})
+                changed = [i[0] for i in await cur.fetchall()]
+                await cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+                check_not_trimmed(await cur.fetchone(), since)  # type: ignore[arg-type]
+            async with conn.cursor(row_factory=film_row) as films:
+                await films.execute(FILMS_QUERY, (changed,))
+                return film_changes_from(seq, changed, await films.fetchall())
+
+    async def database_init(self, schema: str) -> None:
+        """Creates tables if they don't exist. Runs on production; ensure schema is clean.
+        :param schema: string of initial database schema
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(schema)
+        logging.info("Database initialized")
+
+    async def get_all_films(self) -> list[FilmNoBytes]:
+        """Returns all films in the database
+        :return: list of FilmNoBytes
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(ALL_FILMS_QUERY)
+            return await cur.fetchall()
+
+    async def get_single_film(self, uuid: RecordUUIDLike) -> FilmNoBytes | None:
+        """Returns a single film from the database
+        :param uuid: uuid of the film record
+        :return:
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(SINGLE_FILM_QUERY, (uuid,), prepare=True)
+            film = await cur.fetchone()
+            if film is None:
+                return None
+            film.state = FilmState.__members__[film.state]  # type: ignore[index]
+            return film
+
+    async def get_filename(self, uuid: RecordUUIDLike) -> str | None:
+        """
+        gets the filename of a film, without the rest of the record.
+        :param uuid: uuid of film record
+        :return: filename, none if not found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(FILENAME_QUERY, (uuid,), prepare=True)
+            result: tuple[str] | None = await cur.fetchone()
+            return result[0] if result is not None else None
+
+    async def get_thumbnail(self, uuid: RecordUUIDLike) -> bytes | None:
+        """
+        gets a thumbnail from the database
+        :param uuid: uuid of film record
+        :return: bytes, none if not found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(THUMBNAIL_QUERY, (uuid,), prepare=True)
+            image: tuple[bytes] | None = await cur.fetchone()
+            if image is None:
+                return None
+            return image[0]
+
+    async def get_poster(self, uuid: RecordUUIDLike) -> bytes | None:
+        """
+        gets a poster from the database
+        :param uuid: uuid of film record
+        :return: bytes, none if not found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(POSTER_QUERY, (uuid,), prepare=True)
+            image: tuple[bytes] | None = await cur.fetchone()
+            if image is None:
+                return None
+            return image[0]
+
+    async def get_thumbnails(self, uuids: list[UUID]) -> dict[UUID, bytes]:
+        """
+        gets the thumbnails of many films in one query.
+        :param uuids: uuids of film records
+        :return: thumbnail of each film found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(THUMBNAILS_QUERY, (uuids,))
+            records = await cur.fetchall()
+        return await asyncio.to_thread(images_from_records, records, self.image_store)
+
+    async def get_posters(self, uuids: list[UUID]) -> dict[UUID, bytes]:
+        """
+        gets the posters of many films in one query.
+        :param uuids: uuids of film records
+        :return: poster of each film found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(POSTERS_QUERY, (uuids,))
+            records = await cur.fetchall()
+        return await asyncio.to_thread(images_from_records, records, self.image_store)
+
+    async def get_image_keys(
+        self, uuid: RecordUUIDLike
+    ) -> tuple[str | None, str | None] | None:
+        """
+        gets the image store keys of the thumbnail and poster of a film.
+        :param uuid: uuid of film record
+        :return: thumbnail key, poster key; a key is none if the image is kept in the film record.
+        none if the film is not found.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(IMAGE_KEYS_QUERY, (uuid,), prepare=True)
+            keys: tuple[str | None, str | None] | None = await cur.fetchone()
+            return keys
+
+    async def migrate_image_batch(self, store: LocalImageStore, batch_size: int) -> int:
+        """
+        Moves the images of a batch of films out of the film records into the given store, in one transaction.
+        :param store: destination
+        :param batch_size: maximum number of films to migrate
+        :return: number of films migrated; 0 once every film is migrated.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(LEGACY_IMAGES_QUERY, (batch_size,))
+            rows: list[tuple[UUID, bytes | None, bytes | None]] = await cur.fetchall()
+            keys = await asyncio.to_thread(
+                lambda: [
+                    (
+                        store.put(thumbnail) if thumbnail is not None else None,
+                        store.put(poster) if poster is not None else None,
+                        uuid,
+                    )
+                    for uuid, thumbnail, poster in rows
+                ]
+            )
+            await cur.executemany(MOVE_IMAGES_QUERY, keys)
+            return len(rows)
+
+    async def insert_film(self, new_film: Film) -> RecordUUIDLike:
+        """
+        inserts a film into the database.
+        :param new_film: Film; without images, they are extracted from the film when it is transcoded.
+        :return: uuid of the new film record
+        """
+        params = await asyncio.to_thread(insert_film_params, new_film, self.image_store)
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(INSERT_FILM_QUERY, params)
+            result: tuple[UUID] = await cur.fetchone()  # type: ignore
+            return result[0]
+
+    async def insert_films(
+        self, films: Iterable[Film], batch_size: int = DEFAULT_INSERT_BATCH
+    ) -> list[UUID]:
+        """
+        Inserts many films. Each batch is sent in a single round trip in pipeline mode, and committed in its own
+        transaction, so only a batch of films is held in memory at once and an interrupted import keeps the
+        batches already committed.
+        :param films: read lazily, a batch at a time.
+        :param batch_size: films per transaction
+        :return: uuids of the new film records, in the order of the films.
+        """
+        uuids: list[UUID] = list()
+        iterator = iter(films)
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            while batch := list(itertools.islice(iterator, batch_size)):
+                params = await asyncio.to_thread(
+                    lambda: [
+                        insert_film_params(film, self.image_store) for film in batch
+                    ]
+                )
+                async with conn.transaction():
+                    await cur.executemany(INSERT_FILM_QUERY, params, returning=True)
+                    while True:  # one result per film
+                        result: tuple[UUID] = await cur.fetchone()  # type: ignore
+                        uuids.append(result[0])
+                        if not cur.nextset():
+                            break
+        return uuids
+
+    async def set_missing_film_images(
+        self, uuid: RecordUUIDLike, thumbnail: bytes | None, poster: bytes | None
+    ) -> None:
+        """
+        Sets the images of a film that has none, e.g. the ones the transcoder extracted from it.
+        Images the film already has are kept.
+        :param uuid: uuid of film record
+        :param thumbnail: none to leave it as it is
+        :param poster: none to leave it as it is
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            for query, image in (
+                (SET_MISSING_THUMBNAIL_QUERY, thumbnail),
+                (SET_MISSING_POSTER_QUERY, poster),
+            ):
+                if image is None:
+                    continue
+                key = await asyncio.to_thread(self.image_store.put, image)
+                await cur.execute(query, (image if key is None else None, key, uuid))
+
+    async def update_film(self, new_film_data: FilmNoBytes) -> None:
+        """
+        Updates the data in the film record.
+        Does not change: thumbnail, poster, rating.
+        :param new_film_data:
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                UPDATE_FILM_QUERY,
+                (
+                    new_film_data.title,
+                    new_film_data.date_added,
+                    new_film_data.filename,
+                    new_film_data.watched,
+                    new_film_data.state,
+                    new_film_data.actresses,
+                    new_film_data.uuid,
+                ),
+            )
+            if not await cur.fetchone():
+                raise ValueError("film does not exist")
+
+    async def update_rating(self, new_rating_data: Rating) -> None:
+        """
+        update the rating data.
+        :param new_rating_data:
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                UPDATE_RATING_QUERY,
+                (
+                    new_rating_data.story,
+                    new_rating_data.positions,
+                    new_rating_data.pussy,
+                    new_rating_data.shots,
+                    new_rating_data.boobs,
+                    new_rating_data.face,
+                    new_rating_data.rearview,
+                    new_rating_data.uuid,
+                ),
+            )
+            if not await cur.fetchone():
+                raise ValueError("rating does not exist")
+
+    async def get_actress_list(self) -> list[str]:
+        """
+        gets the list of actresses in the database
+        :return:
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(ACTRESS_LIST_QUERY)
+            pulled: list[tuple[str]] = await cur.fetchall()
+            return [i[0] for i in pulled]
+
+    async def get_actress_detail(self, name: str) -> ActressDetail:
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(ACTRESS_DETAIL_QUERY, (name,))
+            return ActressDetail(name=name, films=await cur.fetchall())
+
+    async def delete_film(self, uuid: RecordUUIDLike) -> None:
+        """
+        deletes a film from the database. Does not handle file deletion
+        :param uuid:
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(DELETE_FILM_QUERY, (uuid,))
+
+    async def get_not_transcoded_and_set_transcoding(self) -> FilmNoBytes | None:
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(NOT_TRANSCODED_QUERY, (FilmState.NOT_TRANSCODED,))
+            ret = await cur.fetchone()
+
+            if ret is None:
+                return None
+            ret.state = FilmState.TRANSCODING
+            await cur.execute(
+                SET_TRANSCODING_QUERY, (ret.state, DEFAULT_LEASE_SECONDS, ret.uuid)
+            )
+
+            return ret
+
+    async def get_not_transcoded_and_set_transcoding_batch(
+        self,
+        limit: int,
+        worker_id: str | None = None,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ) -> list[FilmNoBytes]:
+        """
+        Claims up to limit films waiting for transcode, oldest first, in a single statement.
+        Rows claimed concurrently by another transcoder are skipped.
+        A claimed film is leased; if the lease isn't renewed before it expires, the film is put back in the queue.
+        :param limit: maximum number of films to claim
+        :param worker_id: id of the transcoder, to renew and release the leases with
+        :param lease_seconds: lease duration
+        :return: the claimed films, now in state TRANSCODING
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(
+                CLAIM_NOT_TRANSCODED_QUERY,
+                (
+                    FilmState.TRANSCODING,
+                    worker_id,
+                    lease_seconds,
+                    FilmState.NOT_TRANSCODED,
+                    limit,
+                ),
+            )
+            output = await cur.fetchall()
+            for film in output:
+                film.state = FilmState.__members__[film.state]  # type: ignore[index]
+            return output
+
+    async def renew_transcode_leases(
+        self,
+        uuids: list[RecordUUIDLike],
+        worker_id: str,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ) -> list[UUID]:
+        """
+        Extends the leases a transcoder holds, recording a heartbeat.
+        :param uuids: uuids of the films being transcoded
+        :param worker_id: id the films were claimed with
+        :param lease_seconds: new lease duration
+        :return: uuids of the films whose lease is still held; the others were reaped or deleted.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                RENEW_LEASES_QUERY,
+                (lease_seconds, uuids, worker_id, FilmState.TRANSCODING),
+            )
+            return [i[0] for i in await cur.fetchall()]
+
+    async def complete_transcode(
+        self, uuid: RecordUUIDLike, worker_id: str, method: str | None = None
+    ) -> bool:
+        """
+        Marks a transcoded film as complete, if the lease is still held.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        :param method: how the film was transcoded: skip, remux, audio or encode.
+        :return: whether the lease was still held
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                COMPLETE_TRANSCODE_QUERY,
+                (FilmState.COMPLETE, method, uuid, worker_id, FilmState.TRANSCODING),
+            )
+            return await cur.fetchone() is not None
+
+    async def fail_transcode(self, uuid: RecordUUIDLike, worker_id: str) -> None:
+        """
+        Expires the lease of a film that failed to transcode, so the reaper retries it.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                FAIL_TRANSCODE_QUERY, (uuid, worker_id, FilmState.TRANSCODING)
+            )
+
+    async def requeue_transcode(self, uuid: RecordUUIDLike, worker_id: str) -> None:
+        """
+        Puts an interrupted film back in the queue.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                REQUEUE_TRANSCODE_QUERY,
+                (FilmState.NOT_TRANSCODED, uuid, worker_id, FilmState.TRANSCODING),
+            )
+
+    async def reap_expired_transcodes(
+        self, max_attempts: int = MAX_TRANSCODE_ATTEMPTS
+    ) -> list[UUID]:
+        """
+        Puts the films whose lease expired back in the queue; their transcoder crashed, hung or failed.
+        Films that already failed max_attempts times are marked FAILED instead, until they are retried.
+        Safe to run from several transcoders at once.
+        :param max_attempts:
+        :return: uuids of the films put back in the queue
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                REAP_EXPIRED_TRANSCODES_QUERY,
+                (
+                    max_attempts,
+                    FilmState.TRANSCODING,
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.FAILED,
+                ),
+            )
+            reaped: list[tuple[UUID, bool]] = await cur.fetchall()
+        if failed := [uuid for uuid, retry in reaped if not retry]:
+            logging.warning(
+                f"Transcode of {len(failed)} films failed {max_attempts} times, marked them failed."
+            )
+        return [uuid for uuid, retry in reaped if retry]
+
+    async def retry_transcode(self, uuid: RecordUUIDLike) -> bool:
+        """
+        Puts a film whose transcode failed back in the queue, with all its attempts.
+        :param uuid: uuid of film record
+        :return: False if the film doesn't exist or its transcode didn't fail.
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                RETRY_TRANSCODE_QUERY,
+                (FilmState.NOT_TRANSCODED, uuid, FilmState.FAILED),
+            )
+            return await cur.fetchone() is not None
+
+    async def get_leased_filenames(self) -> list[str]:
+        """
+        :return: filenames of the films being transcoded under a live lease
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(LEASED_FILENAMES_QUERY, (FilmState.TRANSCODING,))
+            return [i[0] for i in await cur.fetchall()]
+
+    async def record_transcode_progress(
+        self, progress: dict[UUID, TranscodeProgress], worker_id: str
+    ) -> None:
+        """
+        Records the progress of several films in a single statement.
+        Progress of the films the transcoder no longer holds a lease for is dropped.
+        :param progress: latest progress of each film
+        :param worker_id: id the films were claimed with
+        """
+        values = list(progress.values())
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(
+                RECORD_PROGRESS_QUERY,
+                (
+                    list(progress.keys()),
+                    [i.frame for i in values],
+                    [i.seconds for i in values],
+                    [i.duration for i in values],
+                    [i.speed for i in values],
+                    [i.eta for i in values],
+                    worker_id,
+                    FilmState.TRANSCODING,
+                ),
+            )
+
+    async def get_transcode_status(
+        self, uuid: RecordUUIDLike
+    ) -> TranscodeStatus | None:
+        """
+        :param uuid: uuid of film record
+        :return: queue position or progress of the film, none if it doesn't exist.
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=DictRowFactory
+        ) as cur:
+            await cur.execute(
+                TRANSCODE_STATUS_QUERY,
+                (FilmState.NOT_TRANSCODED, FilmState.TRANSCODING, uuid),
+            )
+            record: dict[str, Any] | None = await cur.fetchone()
+            return transcode_status_from_record(record) if record else None
+
+    async def get_transcode_queue(self, limit: int = 100) -> TranscodeQueue:
+        """
+        :param limit: maximum number of waiting films to list
+        :return: the films being transcoded with their progress, the next films to be transcoded, and the films
+        whose transcode failed.
+        """
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=DictRowFactory
+        ) as cur:
+            await cur.execute(
+                TRANSCODE_QUEUE_QUERY,
+                (
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.TRANSCODING,
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.TRANSCODING,
+                    FilmState.FAILED,
+                    limit,
+                ),
+            )
+            statuses = [transcode_status_from_record(i) for i in await cur.fetchall()]
+        return TranscodeQueue(
+            backlog=await self.get_transcode_backlog(),
+            transcoding=[i for i in statuses if i.state == FilmState.TRANSCODING],
+            queued=[i for i in statuses if i.state == FilmState.NOT_TRANSCODED],
+            failed=[i for i in statuses if i.state == FilmState.FAILED],
+        )
+
+    async def get_transcode_backlog(self) -> int:
+        """
+        :return: number of films waiting for transcode
+        """
+        async with self.pool.connection() as conn, conn.cursor() as cur:
+            await cur.execute(TRANSCODE_BACKLOG_QUERY, (FilmState.NOT_TRANSCODED,))
+            result: tuple[int] = await cur.fetchone()  # type: ignore
+            return result[0]
+
+    async def search_films(self, text: str, limit: int = 20) -> list[FilmNoBytes]:
+        """
+        Finds films by title and actresses. Every word searched must start a word of the film, or, if pg_trgm is
+        installed, closely match a part of it.
+        :param text: searched text, as typed
+        :param limit: maximum number of films found
+        :return: the films found, best match first.
+        """
+        if (params := search_params(text, limit)) is None:
+            return list()
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            if self.fuzzy_search is None:
+                result = await conn.execute(FUZZY_SEARCH_AVAILABLE_QUERY)
+                self.fuzzy_search = bool((await result.fetchone())[0])  # type: ignore[index]
+            await cur.execute(
+                FUZZY_SEARCH_FILMS_QUERY if self.fuzzy_search else SEARCH_FILMS_QUERY,
+                params,
+            )
+            return await cur.fetchall()
+
+    async def get_films_page(self, query: FilmPageQuery) -> FilmPage:
+        """
+        Returns one page of films, filtered and sorted. Pages are addressed with keyset cursors, so the cost
+        of a page does not grow with its position in the library.
+        :param query:
+        :return: the films of the page, and the cursor of the next page if there is one.
+        :raises ValueError: if the cursor is invalid
+        """
+        composed, params = build_film_page_query(query)
+        async with self.pool.connection() as conn, conn.cursor(
+            row_factory=film_row
+        ) as cur:
+            await cur.execute(composed, params)
+            return film_page_from_records(await cur.fetchall(), query)
+
+    @classmethod
+    def from_env(cls, load_dot_env: bool = False) -> AsyncDatabase:  # pragma: no cover
+        """
+        Builds an AsyncDatabase instance using pre-defined strings in the local environment.
+        :param load_dot_env:
+        :return:
+        """
+        return AsyncDatabase(**config_from_env(load_dot_env))
@@ -1,48 +1,661 @@
 from __future__ import annotations
 
+import base64
+import itertools
+import json
 import logging
 import os
-from typing import Any, Sequence, TypeAlias
+import re
+from datetime import date
+from typing import Any, Iterable, Sequence, TypeAlias
 from uuid import UUID
 
 import dotenv
 import psycopg
 import psycopg_pool
-from psycopg import Cursor
-from psycopg.rows import class_row
+from psycopg import sql
+from psycopg.cursor import BaseCursor
+from psycopg.rows import RowMaker, class_row
 
+from util.image_store import (
+    ImageStore,
+    LocalImageStore,
+    PostgresImageStore,
+    image_store_from_env,
+)
 from util.models.actress_detail import ActressDetail
 from util.models.film import Film, FilmNoBytes, FilmState
+from util.models.film_changes import FilmChanges
+from util.models.film_page import FilmPage, FilmPageQuery
+from util.models.pool import PoolStats
 from util.models.rating import Rating
+from util.models.transcode import TranscodeProgress, TranscodeQueue, TranscodeStatus
 from util.models.uuid import RecordUUIDLike
 
 Record: TypeAlias = Film | FilmNoBytes | Rating
 
+LATEST_COMMIT_QUERY = "SELECT uuid FROM public.history ORDER BY seq DESC LIMIT 1;"
 
-def split_rating_and_record(
-    film_data: dict[str, Any],
-) -> tuple[Rating, dict[str, Any]]:
+CHANGED_FILMS_SINCE_QUERY = """
+    SELECT DISTINCT record_uuid FROM public.history
+    WHERE seq > %s AND table_name = 'film' AND action IN ('update', 'delete')
+      AND record_uuid IS NOT NULL;
+"""
+
+# seq of the latest history entry, and of the latest one trimmed. Read once the changes since an entry are, a
+# trimmed seq still before the entry means none of the changes were trimmed before they were read.
+HISTORY_VERSION_QUERY = "SELECT seq, trimmed_seq FROM public.history_version;"
+
+# the oldest history entries, up to the latest one older than the retention; in order, so the trimmed seq
+# marks every entry trimmed.
+TRIM_HISTORY_QUERY = """
+    WITH trimmed AS (
+        DELETE FROM public.history WHERE seq IN (
+            SELECT seq FROM public.history
+                WHERE seq <= (
+                    SELECT seq FROM public.history
+                        WHERE timestamp < now() - make_interval(secs => %s)
+                        ORDER BY timestamp DESC LIMIT 1
+                )
+                ORDER BY seq LIMIT %s
+        )
+        RETURNING seq
+    ), version AS (
+        UPDATE public.history_version SET trimmed_seq = (SELECT max(seq) FROM trimmed)
+        WHERE EXISTS (SELECT 1 FROM trimmed)
+    )
+    SELECT count(*) FROM trimmed;
+"""
+
+# history entries deleted per transaction by trim_history
+DEFAULT_TRIM_BATCH = 1000
+
+# films inserted, updated or deleted after a history entry, or whose rating was updated.
+CHANGED_FILMS_AFTER_SEQ_QUERY = """
+    SELECT record_uuid FROM public.history
+        WHERE seq > %(since)s AND table_name = 'film' AND record_uuid IS NOT NULL
+    UNION
+    SELECT f.uuid FROM public.history h
+        JOIN public.film f ON f.rating = h.record_uuid
+        WHERE h.seq > %(since)s AND h.table_name = 'rating';
+"""
+
+# columns of every query returning films, in the order of the fields of FilmNoBytes and Rating; see film_row.
+FILM_COLUMNS = """f.uuid, f.title, f.date_added, f.filename, f.watched, f.state, f.actresses,
+     r.uuid, r.average, r.story, r.positions, r.pussy, r.shots, r.boobs, r.face, r.rearview"""
+
+ALL_FILMS_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid;
+"""
+
+FILMS_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE f.uuid = ANY(%s);
+"""
+
+SINGLE_FILM_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE f.uuid = %s;
+"""
+
+FILENAME_QUERY = "SELECT filename FROM film WHERE uuid = %s;"
+
+THUMBNAIL_QUERY = "SELECT thumbnail FROM film WHERE uuid = %s;"
+
+POSTER_QUERY = "SELECT poster FROM film WHERE uuid = %s;"
+
+THUMBNAILS_QUERY = (
+    "SELECT uuid, thumbnail, thumbnail_hash FROM film WHERE uuid = ANY(%s);"
+)
+
+POSTERS_QUERY = "SELECT uuid, poster, poster_hash FROM film WHERE uuid = ANY(%s);"
+
+IMAGE_KEYS_QUERY = "SELECT thumbnail_hash, poster_hash FROM film WHERE uuid = %s;"
+
+LEGACY_IMAGES_QUERY = """
+    SELECT uuid, thumbnail, poster FROM film
+        WHERE thumbnail IS NOT NULL OR poster IS NOT NULL
+        LIMIT %s FOR UPDATE SKIP LOCKED;
+"""
+
+MOVE_IMAGES_QUERY = """
+    UPDATE film
+    SET thumbnail = NULL, poster = NULL,
+     thumbnail_hash = COALESCE(%s, thumbnail_hash), poster_hash = COALESCE(%s, poster_hash)
+    WHERE uuid = %s;
+"""
+
+# images extracted by the transcoder; the images the film was inserted with, if any, are kept.
+SET_MISSING_THUMBNAIL_QUERY = """
+    UPDATE film SET thumbnail = %s, thumbnail_hash = %s
+    WHERE uuid = %s AND thumbnail IS NULL AND thumbnail_hash IS NULL;
+"""
+
+SET_MISSING_POSTER_QUERY = """
+    UPDATE film SET poster = %s, poster_hash = %s
+    WHERE uuid = %s AND poster IS NULL AND poster_hash IS NULL;
+"""
+
+# films inserted per transaction by insert_films
+DEFAULT_INSERT_BATCH = 500
+
+INSERT_FILM_QUERY = """
+    WITH rating_record_uuid AS (
+        INSERT INTO rating (average, story, positions, pussy, shots, boobs, face, rearview)
+        VALUES (0.0, 0, 0, 0, 0, 0, 0, 0)
+        RETURNING uuid
+    )
+    INSERT INTO film (title, date_added, filename, watched, state, thumbnail, poster, thumbnail_hash,
+     poster_hash, actresses, rating)
+    SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, uuid
+    FROM rating_record_uuid
+    RETURNING uuid;
+"""
+
+UPDATE_FILM_QUERY = """
+    UPDATE public.film
+    SET title = %s, date_added = %s, filename = %s, watched = %s, state = %s, actresses = %s
+    WHERE uuid = %s
+    RETURNING uuid;
+"""
+
+UPDATE_RATING_QUERY = """
+    UPDATE RATING
+    SET  story = %s, positions = %s,
+    pussy = %s, shots = %s, boobs = %s, face = %s, rearview = %s
+    WHERE uuid = %s RETURNING uuid;
+"""
+
+ACTRESS_LIST_QUERY = "SELECT DISTINCT unnest(actresses) FROM film;"
+
+ACTRESS_DETAIL_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE f.actresses @> ARRAY[%s]::text[];
+"""
+
+DELETE_FILM_QUERY = "DELETE FROM film WHERE uuid = %s;"
+
+NOT_TRANSCODED_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM film f
+        JOIN rating r ON f.rating = r.uuid
+        WHERE state = %s FOR UPDATE SKIP LOCKED LIMIT 1;
+"""
+
+CLAIM_NOT_TRANSCODED_QUERY = f"""
+    WITH claimed AS (
+        UPDATE film SET state = %s, worker_id = %s, heartbeat_at = now(),
+         lease_expires_at = now() + make_interval(secs => %s),
+         transcode_attempts = transcode_attempts + 1
+        WHERE uuid IN (
+            SELECT uuid FROM film WHERE state = %s
+                ORDER BY date_added, uuid LIMIT %s FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    ), stale_progress AS (
+        DELETE FROM transcode_progress WHERE film IN (SELECT uuid FROM claimed)
+    )
+    SELECT {FILM_COLUMNS}
+        FROM claimed f
+        JOIN rating r ON f.rating = r.uuid;
+"""
+
+TRANSCODE_BACKLOG_QUERY = "SELECT count(*) FROM film WHERE state = %s;"
+
+DEFAULT_LEASE_SECONDS = 300
+
+MAX_TRANSCODE_ATTEMPTS = 3
+
+SET_TRANSCODING_QUERY = """
+    UPDATE film SET state = %s, worker_id = NULL, heartbeat_at = now(),
+     lease_expires_at = now() + make_interval(secs => %s),
+     transcode_attempts = transcode_attempts + 1
+    WHERE uuid = %s;
+"""
+
+RENEW_LEASES_QUERY = """
+    UPDATE film SET heartbeat_at = now(), lease_expires_at = now() + make_interval(secs => %s)
+    WHERE uuid = ANY(%s) AND worker_id = %s AND state = %s
+    RETURNING uuid;
+"""
+
+COMPLETE_TRANSCODE_QUERY = """
+    WITH completed AS (
+        UPDATE film SET state = %s, transcode_method = %s,
+         worker_id = NULL, heartbeat_at = NULL, lease_expires_at = NULL
+        WHERE uuid = %s AND worker_id = %s AND state = %s
+        RETURNING uuid
+    ), progress AS (
+        DELETE FROM transcode_progress WHERE film IN (SELECT uuid FROM completed)
+    )
+    SELECT uuid FROM completed;
+"""
+
+# a failed transcode keeps its lease holder for the record, and is left to the reaper to retry.
+FAIL_TRANSCODE_QUERY = """
+    UPDATE film SET lease_expires_at = now()
+    WHERE uuid = %s AND worker_id = %s AND state = %s;
+"""
+
+# an interrupted transcode is put back in the queue right away, and doesn't count as an attempt.
+REQUEUE_TRANSCODE_QUERY = """
+    UPDATE film SET state = %s, worker_id = NULL, heartbeat_at = NULL, lease_expires_at = NULL,
+     transcode_attempts = greatest(transcode_attempts - 1, 0)
+    WHERE uuid = %s AND worker_id = %s AND state = %s;
+"""
+
+# films with attempts left go back in the queue, the others are marked failed.
+REAP_EXPIRED_TRANSCODES_QUERY = """
+    WITH expired AS (
+        SELECT uuid, transcode_attempts < %s AS retry FROM film
+            WHERE state = %s AND lease_expires_at < now()
+            FOR UPDATE SKIP LOCKED
+    )
+    UPDATE film f SET state = CASE WHEN e.retry THEN %s::film_state ELSE %s::film_state END,
+     worker_id = NULL, heartbeat_at = NULL, lease_expires_at = NULL
+        FROM expired e
+        WHERE f.uuid = e.uuid
+    RETURNING f.uuid, e.retry;
+"""
+
+RETRY_TRANSCODE_QUERY = """
+    UPDATE film SET state = %s, transcode_attempts = 0
+    WHERE uuid = %s AND state = %s
+    RETURNING uuid;
+"""
+
+LEASED_FILENAMES_QUERY = """
+    SELECT filename FROM film WHERE state = %s AND lease_expires_at >= now();
+"""
+
+# only the films still leased by the transcoder reporting the progress are written.
+RECORD_PROGRESS_QUERY = """
+    INSERT INTO transcode_progress (film, frame, seconds, duration, speed, eta, updated_at)
+    SELECT p.film, p.frame, p.seconds, p.duration, p.speed, p.eta, now()
+        FROM unnest(%s::uuid[], %s::integer[], %s::float8[], %s::float8[], %s::float8[], %s::float8[])
+         AS p(film, frame, seconds, duration, speed, eta)
+        JOIN film f ON f.uuid = p.film
+        WHERE f.worker_id = %s AND f.state = %s
+    ON CONFLICT (film) DO UPDATE SET frame = excluded.frame, seconds = excluded.seconds,
+     duration = excluded.duration, speed = excluded.speed, eta = excluded.eta, updated_at = excluded.updated_at;
+"""
+
+TRANSCODE_STATUS_COLUMNS = """
+    f.uuid, f.title, f.state, f.worker_id, f.transcode_attempts AS attempts,
+     p.frame, p.seconds, p.duration, p.speed, p.eta, p.updated_at
+"""
+
+# the position counts the films claimed before this one, in claim order.
+TRANSCODE_STATUS_QUERY = f"""
+    SELECT {TRANSCODE_STATUS_COLUMNS},
+     CASE WHEN f.state = %s THEN (
+        SELECT count(*) + 1 FROM film q
+            WHERE q.state = f.state AND (q.date_added, q.uuid) < (f.date_added, f.uuid)
+     ) END AS position
+        FROM film f
+        LEFT JOIN transcode_progress p ON p.film = f.uuid AND f.state = %s
+        WHERE f.uuid = %s;
+"""
+
+TRANSCODE_QUEUE_QUERY = f"""
+    SELECT * FROM (
+        SELECT {TRANSCODE_STATUS_COLUMNS},
+         CASE WHEN f.state = %s
+          THEN row_number() OVER (PARTITION BY f.state ORDER BY f.date_added, f.uuid) END AS position
+            FROM film f
+            LEFT JOIN transcode_progress p ON p.film = f.uuid AND f.state = %s
+            WHERE f.state IN (%s, %s, %s)
+    ) queue
+        WHERE position IS NULL OR position <= %s
+        ORDER BY position NULLS FIRST, uuid;
+"""
+
+FILM_PAGE_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE {{conditions}}
+        ORDER BY {{column}} {{direction}}, {{tiebreak}} {{direction}}
+        LIMIT %s;
+"""
+
+# sort column, unique column breaking ties. film and rating are 1:1, so rating sorts break ties on the rating
+# uuid and can walk the rating index. unset averages sort as 0, as a row comparison with a null is never true.
+FILM_PAGE_SORT_COLUMNS = {
+    "date_added": ("f.date_added", "f.uuid"),
+    "title": ("f.title", "f.uuid"),
+    "average": ("coalesce(r.average, 0)", "r.uuid"),
+}
+
+FUZZY_SEARCH_AVAILABLE_QUERY = (
+    "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm');"
+)
+
+# films whose title or actresses hold every searched word, or a word starting with it.
+SEARCH_FILMS_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE to_tsvector('simple', film_search_text(f.title, f.actresses)) @@ to_tsquery('simple', %(prefixes)s)
+        ORDER BY ts_rank(to_tsvector('simple', film_search_text(f.title, f.actresses)),
+         to_tsquery('simple', %(prefixes)s)) DESC, f.title, f.uuid
+        LIMIT %(limit)s;
+"""
+
+# misspelled words match too; films are ranked by how closely a part of their text matches the searched text.
+FUZZY_SEARCH_FILMS_QUERY = f"""
+    SELECT {FILM_COLUMNS}
+        FROM public.film f
+        JOIN public.rating r ON f.rating = r.uuid
+        WHERE to_tsvector('simple', film_search_text(f.title, f.actresses)) @@ to_tsquery('simple', %(prefixes)s)
+         OR %(text)s <%% film_search_text(f.title, f.actresses)
+        ORDER BY word_similarity(%(text)s, film_search_text(f.title, f.actresses)) DESC, f.title, f.uuid
+        LIMIT %(limit)s;
+"""
+
+
+def make_film(values: Sequence[Any]) -> FilmNoBytes:
+    """
+    :param values: record of FILM_COLUMNS
+    :return: the film, state as stored.
+    """
+    return FilmNoBytes(*values[:6], Rating(*values[7:]), values[6])  # type: ignore[call-arg]
+
+
+def film_row(cursor: BaseCursor[Any, Any]) -> RowMaker[FilmNoBytes]:
+    """
+    Row factory of the queries selecting FILM_COLUMNS. Films are built straight from the record tuples, by
+    position; no dict is made for each row.
+    :param cursor:
+    :return:
+    """
+    return make_film
+
+
+def check_not_trimmed(version: tuple[int, int], since: int) -> None:
+    """
+    :param version: record of HISTORY_VERSION_QUERY, read after the changes since the entry
+    :param since: seq of a history entry
+    :raises ValueError: if history entries after it were trimmed
+    """
+    if version[1] > since:
+        raise ValueError(
+            f"history trimmed up to entry {version[1]}, after entry {since}"
+        )
+
+
+def film_changes_from(
+    seq: int, changed: list[UUID], films: list[FilmNoBytes]
+) -> FilmChanges:
+    """
+    :param seq: latest history entry when the changes were read
+    :param changed: uuids of the films changed
+    :param films: the changed films still in the database
+    :return:
+    """
+    present = {i.uuid for i in films}
+    return FilmChanges(
+        seq=seq, upserted=films, deleted=[i for i in changed if i not in present]
+    )
+
+
+def build_conninfo(
+    db_name: str, db_user: str, db_password: str, db_host: str, db_port: str
+) -> str:
+    return f"""
+            dbname={db_name}
+            user={db_user}
+            password={db_password}
+            host={db_host}
+            port={db_port}
+        """
+
+
+def reconnect_timeout(max_retries: int, retry_interval: int) -> float:
+    """
+    :param max_retries: a connection that can't be opened is retried, backing off, for this many retry intervals
+    before the pool gives up on it.
+    :param retry_interval: seconds
+    :return: reconnect_timeout of ConnectionPool and AsyncConnectionPool
+    """
+    return float(max(max_retries, 1) * retry_interval)
+
+
+def pool_stats_from(stats: dict[str, int]) -> PoolStats:
+    """
+    :param stats: returned by get_stats of a connection pool; counters still at 0 are left out of it.
+    :return:
+    """
+    return PoolStats(
+        size=stats.get("pool_size", 0),
+        available=stats.get("pool_available", 0),
+        min_size=stats.get("pool_min", 0),
+        max_size=stats.get("pool_max", 0),
+        waiting=stats.get("requests_waiting", 0),
+        requests=stats.get("requests_num", 0),
+        queued=stats.get("requests_queued", 0),
+        wait_ms=stats.get("requests_wait_ms", 0),
+        usage_ms=stats.get("usage_ms", 0),
+        request_errors=stats.get("requests_errors", 0),
+        connection_errors=stats.get("connections_errors", 0),
+        connections_lost=stats.get("connections_lost", 0) + stats.get("returns_bad", 0),
+    )
+
+
+def config_from_env(load_dot_env: bool = False) -> dict[str, Any]:  # pragma: no cover
+    """
+    Reads the database configuration from pre-defined strings in the local environment.
+    If load_dot_env is True, dotenv.load_env() will be run to retrieve the environment vars from .env file.
+    :param load_dot_env:
+    :return: keyword arguments of Database and AsyncDatabase
+    """
+    if load_dot_env:
+        assert dotenv.load_dotenv()
+    try:
+        return dict(
+            db_name=os.environ["POSTGRES_DB"],
+            db_user=os.environ["POSTGRES_USER"],
+            db_password=os.environ["POSTGRES_PASSWORD"],
+            db_host=os.environ["POSTGRES_HOST"],
+            db_port=os.environ["POSTGRES_PORT"],
+            max_retries=int(os.environ["POSTGRES_MAX_RETRIES"]),
+            max_connections=int(os.environ["POSTGRES_MAX_CONNECTIONS"]),
+            min_connections=int(os.environ["POSTGRES_MIN_CONNECTIONS"]),
+            retry_interval=int(os.environ["POSTGRES_RETRY_INTERVAL"]),
+            image_store=image_store_from_env(),
+        )
+    except* (KeyError, ValueError):
+        logging.critical("Environment variables are not correctly configured.")
+        raise
+
+
+def encode_film_page_cursor(query: FilmPageQuery, last: FilmNoBytes) -> str:
+    """
+    Builds the keyset cursor of the page following the given film.
+    :param query: query of the current page
+    :param last: last film of the current page
+    :return: url-safe opaque cursor
+    """
+    value: Any
+    if query.sort == "date_added":
+        value = last.date_added.isoformat()
+    elif query.sort == "title":
+        value = last.title
+    else:
+        value = last.rating.average or 0.0  # as FILM_PAGE_SORT_COLUMNS sorts it
+    tiebreak = last.rating.uuid if query.sort == "average" else last.uuid
+    payload = [query.sort, query.descending, value, str(tiebreak)]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_film_page_cursor(query: FilmPageQuery) -> tuple[Any, UUID]:
+    """
+    Reads the keyset position out of the cursor of the query.
+    :param query:
+    :return: sort value, tie-breaking uuid of the last film of the previous page
+    :raises ValueError: if the cursor is malformed or was issued for a different sort
+    """
+    assert query.cursor is not None
+    try:
+        sort, descending, value, uuid = json.loads(
+            base64.urlsafe_b64decode(query.cursor.encode())
+        )
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError("malformed cursor") from e
+    if (sort, descending) != (query.sort, query.descending):
+        raise ValueError("cursor was issued for a different sort")
+    # the value is bound to the sort column; a value of another type would fail in the database instead.
+    if sort == "average":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("malformed cursor")
+        value = float(value)
+    elif not isinstance(value, str):
+        raise ValueError("malformed cursor")
+    elif sort == "date_added":
+        value = date.fromisoformat(value)
+    if not isinstance(uuid, str):
+        raise ValueError("malformed cursor")
+    return value, UUID(uuid)
+
+
+def build_film_page_query(query: FilmPageQuery) -> tuple[sql.Composed, list[Any]]:
+    """
+    Builds the keyset-paginated film query. One row more than the limit is selected to detect the next page.
+    :param query:
+    :return: query, parameters
+    :raises ValueError: if the cursor is invalid
+    """
+    conditions: list[sql.Composable] = [sql.SQL("TRUE")]
+    params: list[Any] = list()
+    for condition, value in (
+        ("f.state = %s", query.state),
+        ("f.watched = %s", query.watched),
+        ("f.actresses @> ARRAY[%s]::text[]", query.actress),
+        ("f.date_added >= %s", query.date_from),
+        ("f.date_added <= %s", query.date_to),
+        ("r.average >= %s", query.min_average),
+    ):
+        if value is not None:
+            conditions.append(sql.SQL(condition))
+            params.append(value)
+
+    column, tiebreak = (sql.SQL(name) for name in FILM_PAGE_SORT_COLUMNS[query.sort])
+    if query.cursor is not None:
+        value, uuid = decode_film_page_cursor(query)
+        conditions.append(
+            sql.SQL("({column}, {tiebreak}) {operator} (%s, %s)").format(
+                column=column,
+                tiebreak=tiebreak,
+                operator=sql.SQL("<" if query.descending else ">"),
+            )
+        )
+        params.extend((value, uuid))
+    params.append(query.limit + 1)
+
+    composed = sql.SQL(FILM_PAGE_QUERY).format(
+        conditions=sql.SQL(" AND ").join(conditions),
+        column=column,
+        tiebreak=tiebreak,
+        direction=sql.SQL("DESC" if query.descending else "ASC"),
+    )
+    return composed, params
+
+
+def film_page_from_records(
+    records: list[FilmNoBytes], query: FilmPageQuery
+) -> FilmPage:
+    films = records[: query.limit]
+    next_cursor = (
+        encode_film_page_cursor(query, films[-1])
+        if len(records) > query.limit
+        else None
+    )
+    return FilmPage(films=films, next_cursor=next_cursor)
+
+
+def search_params(text: str, limit: int) -> dict[str, Any] | None:
+    """
+    :param text: searched text, as typed
+    :param limit: maximum number of films found
+    :return: parameters of the search queries, none if the text has no words.
+    """
+    words = re.findall(r"[^\W_]+", text.lower())
+    if not words:
+        return None
+    return {
+        "text": " ".join(words),
+        "prefixes": " & ".join(f"{word}:*" for word in words),
+        "limit": limit,
+    }
+
+
+def insert_film_params(film: Film, store: ImageStore) -> tuple[Any, ...]:
     """
-    Removes the rating-related objects
-    :param film_data: dict row mapped database record
-    :return: rating, remaining data
+    Writes the images of a film to the image store.
+    :param film:
+    :param store:
+    :return: parameters of INSERT_FILM_QUERY
     """
-    rating = Rating(
-        uuid=film_data.pop("r_uuid"),
-        average=film_data.pop("average"),
-        story=film_data.pop("story"),
-        positions=film_data.pop("positions"),
-        pussy=film_data.pop("pussy"),
-        shots=film_data.pop("shots"),
-        boobs=film_data.pop("boobs"),
-        face=film_data.pop("face"),
-        rearview=film_data.pop("rearview"),
+    thumbnail_key = store.put(film.thumbnail) if film.thumbnail is not None else None
+    poster_key = store.put(film.poster) if film.poster is not None else None
+    return (
+        film.title,
+        film.date_added,
+        film.filename,
+        film.watched,
+        film.state,
+        film.thumbnail if thumbnail_key is None else None,
+        film.poster if poster_key is None else None,
+        thumbnail_key,
+        poster_key,
+        film.actresses,
+    )
+
+
+def images_from_records(
+    records: list[tuple[UUID, bytes | None, str | None]], store: ImageStore
+) -> dict[UUID, bytes]:
+    """
+    Resolves the images of a batch query, reading the ones moved to the image store from disk.
+    :param records: uuid, image kept in the film record, image store key
+    :param store:
+    :return: image of each film; films whose image is missing are left out.
+    """
+    images = dict()
+    for uuid, image, key in records:
+        if image is None and key is not None and (path := store.path(key)):
+            image = path.read_bytes()
+        if image is not None:
+            images[uuid] = image
+    return images
+
+
+def transcode_status_from_record(record: dict[str, Any]) -> TranscodeStatus:
+    """
+    :param record: dict row mapped record of the transcode status queries
+    :return:
+    """
+    progress_columns = ("frame", "seconds", "duration", "speed", "eta", "updated_at")
+    progress = {i: record.pop(i) for i in progress_columns}
+    return TranscodeStatus(
+        state=FilmState.__members__[record.pop("state")],
+        progress=TranscodeProgress(**progress)
+        if progress["frame"] is not None
+        else None,
+        **record,
     )
-    return rating, film_data
 
 
 class DictRowFactory:
-    def __init__(self, cursor: Cursor[Any]):
+    def __init__(self, cursor: BaseCursor[Any, Any]):
         self.fields = (
             [c.name for c in cursor.description]
             if cursor.description is not None
@@ -70,18 +683,36 @@ class Database:
         min_connections: int,
         max_retries: int,
         retry_interval: int,
+        image_store: ImageStore | None = None,
     ) -> None:
+        """
+        The hottest lookups run as prepared statements, parsed and planned once per connection.
+        :param max_connections: size of the pool under load
+        :param min_connections: connections kept open even while idle
+        :param max_retries: a connection that can't be opened is retried, backing off, for this many retry
+        intervals. The pool is given as long to open its first connections.
+        :param retry_interval: seconds
+        :param image_store: where inserted images are written. Defaults to the film record itself.
+        """
+        self.image_store = image_store or PostgresImageStore()
+        # whether pg_trgm is installed; checked on the first search.
+        self.fuzzy_search: bool | None = None
+        self.conninfo = build_conninfo(db_name, db_user, db_password, db_host, db_port)
+        timeout = reconnect_timeout(max_retries, retry_interval)
         self.pool = psycopg_pool.ConnectionPool(
-            f"""        
-            dbname={db_name}
-            user={db_user}
-            password={db_password}
-            host={db_host}
-            port={db_port}
-        """,
+            self.conninfo,
             open=True,  # ensure connection is open (note: default: True is being removed in the next version of psycopg
+            min_size=min_connections,
+            max_size=max_connections,
+            reconnect_timeout=timeout,
         )
-        self.pool.wait(timeout=60)
+        self.pool.wait(timeout=timeout)
+
+    def get_pool_stats(self) -> PoolStats:
+        """
+        :return: size and usage of the connection pool; the counters run from when the pool was opened.
+        """
+        return pool_stats_from(self.pool.get_stats())
 
     def get_latest_commit_uuid(self) -> UUID | None:
         """
@@ -91,14 +722,74 @@ class Database:
         with self.pool.connection() as conn, conn.cursor(
             row_factory=DictRowFactory
         ) as cur:
-            cur.execute(
-                "SELECT uuid FROM public.history ORDER BY timestamp DESC LIMIT 1;"
-            )
+            cur.execute(LATEST_COMMIT_QUERY, prepare=True)
             result: dict[str, UUID] | None = cur.fetchone()
             if result is not None:
                 return result["uuid"]
             return None
 
+    def get_changed_films_since(self, seq: int) -> list[UUID]:
+        """
+        Gets the uuids of the films that were updated or deleted after a history entry.
+        :param seq: of the history entry, as returned by get_history_seq
+        :return: list of film uuids
+        :raises ValueError: if history entries after it were trimmed
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CHANGED_FILMS_SINCE_QUERY, (seq,))
+            pulled: list[tuple[UUID]] = cur.fetchall()
+            cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+            check_not_trimmed(cur.fetchone(), seq)  # type: ignore[arg-type]
+            return [i[0] for i in pulled]
+
+    def get_history_seq(self) -> int:
+        """
+        The version of the data; it is kept in a counter, so reading it costs the same however long the history.
+        :return: seq of the latest history entry, 0 if there is none.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+            result: tuple[int, int] = cur.fetchone()  # type: ignore
+            return result[0]
+
+    def trim_history(
+        self, retention: float, batch_size: int = DEFAULT_TRIM_BATCH
+    ) -> int:
+        """
+        Deletes a batch of the history entries older than the retention, oldest first. Each batch is a
+        transaction of its own, so writers never wait on the history for longer than a batch takes.
+        Changes since a trimmed entry can no longer be read.
+        :param retention: seconds history entries are kept for
+        :param batch_size: maximum number of entries deleted
+        :return: number of entries deleted; less than batch_size once no entry is older than the retention.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(TRIM_HISTORY_QUERY, (retention, batch_size))
+            result: tuple[int] = cur.fetchone()  # type: ignore
+            return result[0]
+
+    def get_film_changes(self, since: int) -> FilmChanges:
+        """
+        Gets the films inserted, updated or deleted after a history entry, to bring a films list loaded at that
+        entry up to date. Entries are numbered in the order they are committed, so no change is skipped. A film
+        changed several times is reported once, as it is now; changes committed while they are read may be
+        reported again by the next call, which is harmless.
+        :param since: seq of the history entry the list is at, 0 for every film
+        :return:
+        :raises ValueError: if history entries after it were trimmed; the whole list must be loaded again.
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+                seq: int = cur.fetchone()[0]  # type: ignore[index]
+                cur.execute(CHANGED_FILMS_AFTER_SEQ_QUERY, {"since": since})
+                changed = [i[0] for i in cur.fetchall()]
+                cur.execute(HISTORY_VERSION_QUERY, prepare=True)
+                check_not_trimmed(cur.fetchone(), since)  # type: ignore[arg-type]
+            with conn.cursor(row_factory=film_row) as films:
+                films.execute(FILMS_QUERY, (changed,))
+                return film_changes_from(seq, changed, films.fetchall())
+
     def database_init(self, schema: str) -> None:
         """Creates tables if they don't exist. Runs on production; ensure schema is clean.
         :param schema: string of initial database schema
@@ -113,24 +804,9 @@ class Database:
         """Returns all films in the database
         :return: list of FilmNoBytes
         """
-        with self.pool.connection() as conn, conn.cursor(
-            row_factory=DictRowFactory
-        ) as cur:
-            cur.execute(
-                """SELECT f.uuid, f.title, f.date_added, f.filename, f.watched, f.state, f.actresses,
-                 r.uuid as "r_uuid", r.average, r.boobs, r.face, r.rearview, r.shots,
-                 r.story, r.positions, r.pussy
-                    FROM public.film f
-                    JOIN public.rating r ON f.rating = r.uuid;
-                """
-            )
-            # type behaviour is changed due to psycopg2.extras.DictCursor used in get_db_connection
-            films_data_including_rating: list[dict[str, Any]] = cur.fetchall()
-            output = list()
-            for film in films_data_including_rating:
-                rating, film_data = split_rating_and_record(film)
-                output.append(FilmNoBytes(rating=rating, **film_data))
-            return output
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            cur.execute(ALL_FILMS_QUERY)
+            return cur.fetchall()
 
     def get_single_film(self, uuid: RecordUUIDLike) -> FilmNoBytes | None:
         """Returns a single film from the database
@@ -138,29 +814,24 @@ class Database:
         :return:
         """
 
-        with self.pool.connection() as conn, conn.cursor(
-            row_factory=DictRowFactory
-        ) as cur:
-            cur.execute(
-                """SELECT f.uuid, f.title, f.date_added, f.filename, f.watched, f.state, f.actresses,
-                 r.uuid as "r_uuid", r.average, r.boobs, r.average, r.face, r.rearview, r.shots,
-                 r.story, r.positions, r.pussy
-                    FROM public.film f
-                    JOIN public.rating r ON f.rating = r.uuid
-                    WHERE f.uuid = %s;
-                            """,
-                (uuid,),
-            )
-            # type behaviour is changed due to psycopg2.extras.DictCursor used in get_db_connection
-            film_data_including_rating: dict | None = cur.fetchone()  # type: ignore
-            if film_data_including_rating is None:
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            cur.execute(SINGLE_FILM_QUERY, (uuid,), prepare=True)
+            film = cur.fetchone()
+            if film is None:
                 return None
-            rating, film_data = split_rating_and_record(film_data_including_rating)
-            return FilmNoBytes(
-                rating=rating,
-                state=FilmState.__members__[film_data.pop("state")],
-                **film_data,
-            )
+            film.state = FilmState.__members__[film.state]  # type: ignore[index]
+            return film
+
+    def get_filename(self, uuid: RecordUUIDLike) -> str | None:
+        """
+        gets the filename of a film, without the rest of the record.
+        :param uuid: uuid of film record
+        :return: filename, none if not found.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(FILENAME_QUERY, (uuid,), prepare=True)
+            result: tuple[str] | None = cur.fetchone()
+            return result[0] if result is not None else None
 
     def get_thumbnail(self, uuid: RecordUUIDLike) -> bytes | None:
         """
@@ -171,12 +842,7 @@ class Database:
         with self.pool.connection() as conn, conn.cursor(
             row_factory=DictRowFactory
         ) as cur:
-            cur.execute(
-                """
-                    SELECT thumbnail FROM film WHERE uuid = %s
-                    """,
-                (uuid,),
-            )
+            cur.execute(THUMBNAIL_QUERY, (uuid,), prepare=True)
             image: dict[str, bytes] | None = cur.fetchone()
             if image is None:
                 return None
@@ -191,51 +857,129 @@ class Database:
         with self.pool.connection() as conn, conn.cursor(
             row_factory=DictRowFactory
         ) as cur:
-            cur.execute(
-                """
-                SELECT poster FROM film WHERE uuid = %s;
-                """,
-                (uuid,),
-            )
+            cur.execute(POSTER_QUERY, (uuid,), prepare=True)
             image: psycopg2.extras.DictRow | None = cur.fetchone()  # type: ignore
             if image is None:
                 return None
             ret: memoryview = image["poster"]
             return ret
 
+    def get_thumbnails(self, uuids: list[UUID]) -> dict[UUID, bytes]:
+        """
+        gets the thumbnails of many films in one query.
+        :param uuids: uuids of film records
+        :return: thumbnail of each film found.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(THUMBNAILS_QUERY, (uuids,))
+            return images_from_records(cur.fetchall(), self.image_store)
+
+    def get_posters(self, uuids: list[UUID]) -> dict[UUID, bytes]:
+        """
+        gets the posters of many films in one query.
+        :param uuids: uuids of film records
+        :return: poster of each film found.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(POSTERS_QUERY, (uuids,))
+            return images_from_records(cur.fetchall(), self.image_store)
+
+    def get_image_keys(
+        self, uuid: RecordUUIDLike
+    ) -> tuple[str | None, str | None] | None:
+        """
+        gets the image store keys of the thumbnail and poster of a film.
+        :param uuid: uuid of film record
+        :return: thumbnail key, poster key; a key is none if the image is kept in the film record.
+        none if the film is not found.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(IMAGE_KEYS_QUERY, (uuid,), prepare=True)
+            keys: tuple[str | None, str | None] | None = cur.fetchone()
+            return keys
+
+    def migrate_image_batch(self, store: LocalImageStore, batch_size: int) -> int:
+        """
+        Moves the images of a batch of films out of the film records into the given store, in one transaction.
+        Rows being migrated concurrently are skipped, and images are content-addressed, so the migration can be
+        interrupted and resumed at any point.
+        :param store: destination
+        :param batch_size: maximum number of films to migrate
+        :return: number of films migrated; 0 once every film is migrated.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(LEGACY_IMAGES_QUERY, (batch_size,))
+            rows: list[tuple[UUID, bytes | None, bytes | None]] = cur.fetchall()
+            cur.executemany(
+                MOVE_IMAGES_QUERY,
+                [
+                    (
+                        store.put(thumbnail) if thumbnail is not None else None,
+                        store.put(poster) if poster is not None else None,
+                        uuid,
+                    )
+                    for uuid, thumbnail, poster in rows
+                ],
+            )
+            return len(rows)
+
     def insert_film(self, new_film: Film) -> RecordUUIDLike:
         """
         inserts a film into the database.
-        :param new_film: Film
+        :param new_film: Film; without images, they are extracted from the film when it is transcoded.
         :return: FilmNoBytes
         """
+        params = insert_film_params(new_film, self.image_store)
         with self.pool.connection() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                WITH rating_record_uuid AS (
-                    INSERT INTO rating (average, story, positions, pussy, shots, boobs, face, rearview) 
-                    VALUES (0.0, 0, 0, 0, 0, 0, 0, 0)
-                    RETURNING uuid
-                )
-                INSERT INTO film (title, date_added, filename, watched, state, thumbnail, poster, actresses, rating) 
-                SELECT %s, %s, %s, %s, %s, %s, %s, %s, uuid
-                FROM rating_record_uuid
-                RETURNING uuid;
-                """,
-                (
-                    new_film.title,
-                    new_film.date_added,
-                    new_film.filename,
-                    new_film.watched,
-                    new_film.state,
-                    new_film.thumbnail,
-                    new_film.poster,
-                    new_film.actresses,
-                ),
-            )
+            cur.execute(INSERT_FILM_QUERY, params)
             result: tuple[UUID] = cur.fetchone()  # type: ignore
             return result[0]
 
+    def insert_films(
+        self, films: Iterable[Film], batch_size: int = DEFAULT_INSERT_BATCH
+    ) -> list[UUID]:
+        """
+        Inserts many films. Each batch is sent in a single round trip in pipeline mode, and committed in its own
+        transaction, so only a batch of films is held in memory at once and an interrupted import keeps the
+        batches already committed.
+        :param films: read lazily, a batch at a time.
+        :param batch_size: films per transaction
+        :return: uuids of the new film records, in the order of the films.
+        """
+        uuids: list[UUID] = list()
+        iterator = iter(films)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            while batch := list(itertools.islice(iterator, batch_size)):
+                params = [insert_film_params(film, self.image_store) for film in batch]
+                with conn.transaction():
+                    cur.executemany(INSERT_FILM_QUERY, params, returning=True)
+                    while True:  # one result per film
+                        result: tuple[UUID] = cur.fetchone()  # type: ignore
+                        uuids.append(result[0])
+                        if not cur.nextset():
+                            break
+        return uuids
+
+    def set_missing_film_images(
+        self, uuid: RecordUUIDLike, thumbnail: bytes | None, poster: bytes | None
+    ) -> None:
+        """
+        Sets the images of a film that has none, e.g. the ones the transcoder extracted from it.
+        Images the film already has are kept.
+        :param uuid: uuid of film record
+        :param thumbnail: none to leave it as it is
+        :param poster: none to leave it as it is
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            for query, image in (
+                (SET_MISSING_THUMBNAIL_QUERY, thumbnail),
+                (SET_MISSING_POSTER_QUERY, poster),
+            ):
+                if image is None:
+                    continue
+                key = self.image_store.put(image)
+                cur.execute(query, (image if key is None else None, key, uuid))
+
     def update_film(self, new_film_data: FilmNoBytes) -> None:
         """
         Updates the data in the film record.
@@ -244,12 +988,7 @@ class Database:
         """
         with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute(
-                """
-                UPDATE public.film
-                SET title = %s, date_added = %s, filename = %s, watched = %s, state = %s, actresses = %s
-                WHERE uuid = %s
-                RETURNING uuid;
-                """,
+                UPDATE_FILM_QUERY,
                 (
                     new_film_data.title,
                     new_film_data.date_added,
@@ -276,12 +1015,7 @@ class Database:
             row_factory=DictRowFactory
         ) as cur:
             cur.execute(
-                """ 
-                UPDATE RATING
-                SET  story = %s, positions = %s,
-                pussy = %s, shots = %s, boobs = %s, face = %s, rearview = %s
-                WHERE uuid = %s RETURNING uuid;
-                """,
+                UPDATE_RATING_QUERY,
                 (
                     new_rating_data.story,
                     new_rating_data.positions,
@@ -307,31 +1041,14 @@ class Database:
         :return:
         """
         with self.pool.connection() as conn, conn.cursor() as cur:
-            cur.execute("SELECT DISTINCT unnest(actresses) FROM film;")
+            cur.execute(ACTRESS_LIST_QUERY)
             pulled: list[tuple[str]] = cur.fetchall()
             return [i[0] for i in pulled]
 
     def get_actress_detail(self, name: str) -> ActressDetail:
-        with self.pool.connection() as conn, conn.cursor(
-            row_factory=DictRowFactory
-        ) as cur:
-            cur.execute(
-                """
-                 SELECT f.uuid, f.title, f.date_added, f.filename, f.watched, f.state, f.actresses,
-                 r.uuid as "r_uuid", r.average, r.boobs, r.average, r.face, r.rearview, r.shots,
-                 r.story, r.positions, r.pussy
-                    FROM public.film f
-                    JOIN public.rating r ON f.rating = r.uuid
-                    WHERE %s = ANY(f.actresses);
-            """,
-                (name,),
-            )
-            films_data: list[dict[str, Any]] = cur.fetchall()
-            output = list()
-            for film in films_data:
-                rating, film_data = split_rating_and_record(film)
-                output.append(FilmNoBytes(rating=rating, **film_data))
-            return ActressDetail(name=name, films=output)
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            cur.execute(ACTRESS_DETAIL_QUERY, (name,))
+            return ActressDetail(name=name, films=cur.fetchall())
 
     def delete_film(self, uuid: RecordUUIDLike) -> None:
         """
@@ -341,41 +1058,275 @@ class Database:
         """
 
         with self.pool.connection() as conn, conn.cursor() as cur:
-            cur.execute("DELETE FROM film WHERE uuid = %s", (uuid,))
+            cur.execute(DELETE_FILM_QUERY, (uuid,))
             conn.commit()
 
     def get_not_transcoded_and_set_transcoding(self) -> FilmNoBytes | None:
-        with self.pool.connection() as conn, conn.cursor(
-            row_factory=DictRowFactory
-        ) as cur:
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
             cur.execute(
-                """
-            SELECT f.uuid, f.title, f.date_added, f.filename, f.watched, f.state, f.actresses,
-                 r.uuid as "r_uuid", r.average, r.boobs, r.average, r.face, r.rearview, r.shots,
-                 r.story, r.positions, r.pussy 
-             FROM film f
-             JOIN rating r ON f.rating = r.uuid
-            WHERE state = %s FOR UPDATE SKIP LOCKED LIMIT 1;
-            """,
+                NOT_TRANSCODED_QUERY,
                 (FilmState.NOT_TRANSCODED,),
             )
-            result: dict[str, Any] | None = cur.fetchone()
+            ret = cur.fetchone()
 
-            if result is None:
+            if ret is None:
                 return None
-            rating, remaining = split_rating_and_record(result)
-
-            ret = FilmNoBytes(rating=rating, **remaining)
             ret.state = FilmState.TRANSCODING
             cur.execute(
-                """
-            UPDATE film SET state = %s WHERE uuid = %s
-           """,
-                (ret.state, ret.uuid),
+                SET_TRANSCODING_QUERY,
+                (ret.state, DEFAULT_LEASE_SECONDS, ret.uuid),
             )
 
             return ret
 
+    def get_not_transcoded_and_set_transcoding_batch(
+        self,
+        limit: int,
+        worker_id: str | None = None,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ) -> list[FilmNoBytes]:
+        """
+        Claims up to limit films waiting for transcode, oldest first, in a single statement.
+        Rows claimed concurrently by another transcoder are skipped.
+        A claimed film is leased; if the lease isn't renewed before it expires, the film is put back in the queue.
+        :param limit: maximum number of films to claim
+        :param worker_id: id of the transcoder, to renew and release the leases with
+        :param lease_seconds: lease duration
+        :return: the claimed films, now in state TRANSCODING
+        """
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            cur.execute(
+                CLAIM_NOT_TRANSCODED_QUERY,
+                (
+                    FilmState.TRANSCODING,
+                    worker_id,
+                    lease_seconds,
+                    FilmState.NOT_TRANSCODED,
+                    limit,
+                ),
+            )
+            output = cur.fetchall()
+            for film in output:
+                film.state = FilmState.__members__[film.state]  # type: ignore[index]
+            return output
+
+    def renew_transcode_leases(
+        self,
+        uuids: list[RecordUUIDLike],
+        worker_id: str,
+        lease_seconds: int = DEFAULT_LEASE_SECONDS,
+    ) -> list[UUID]:
+        """
+        Extends the leases a transcoder holds, recording a heartbeat.
+        :param uuids: uuids of the films being transcoded
+        :param worker_id: id the films were claimed with
+        :param lease_seconds: new lease duration
+        :return: uuids of the films whose lease is still held; the others were reaped or deleted.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                RENEW_LEASES_QUERY,
+                (lease_seconds, uuids, worker_id, FilmState.TRANSCODING),
+            )
+            return [i[0] for i in cur.fetchall()]
+
+    def complete_transcode(
+        self, uuid: RecordUUIDLike, worker_id: str, method: str | None = None
+    ) -> bool:
+        """
+        Marks a transcoded film as complete, if the lease is still held.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        :param method: how the film was transcoded: skip, remux, audio or encode.
+        :return: whether the lease was still held
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                COMPLETE_TRANSCODE_QUERY,
+                (FilmState.COMPLETE, method, uuid, worker_id, FilmState.TRANSCODING),
+            )
+            return cur.fetchone() is not None
+
+    def fail_transcode(self, uuid: RecordUUIDLike, worker_id: str) -> None:
+        """
+        Expires the lease of a film that failed to transcode, so the reaper retries it.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(FAIL_TRANSCODE_QUERY, (uuid, worker_id, FilmState.TRANSCODING))
+
+    def requeue_transcode(self, uuid: RecordUUIDLike, worker_id: str) -> None:
+        """
+        Puts an interrupted film back in the queue.
+        :param uuid: uuid of film record
+        :param worker_id: id the film was claimed with
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                REQUEUE_TRANSCODE_QUERY,
+                (FilmState.NOT_TRANSCODED, uuid, worker_id, FilmState.TRANSCODING),
+            )
+
+    def reap_expired_transcodes(
+        self, max_attempts: int = MAX_TRANSCODE_ATTEMPTS
+    ) -> list[UUID]:
+        """
+        Puts the films whose lease expired back in the queue; their transcoder crashed, hung or failed.
+        Films that already failed max_attempts times are marked FAILED instead, until they are retried.
+        Safe to run from several transcoders at once.
+        :param max_attempts:
+        :return: uuids of the films put back in the queue
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                REAP_EXPIRED_TRANSCODES_QUERY,
+                (
+                    max_attempts,
+                    FilmState.TRANSCODING,
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.FAILED,
+                ),
+            )
+            reaped: list[tuple[UUID, bool]] = cur.fetchall()
+        if failed := [uuid for uuid, retry in reaped if not retry]:
+            logging.warning(
+                f"Transcode of {len(failed)} films failed {max_attempts} times, marked them failed."
+            )
+        return [uuid for uuid, retry in reaped if retry]
+
+    def retry_transcode(self, uuid: RecordUUIDLike) -> bool:
+        """
+        Puts a film whose transcode failed back in the queue, with all its attempts.
+        :param uuid: uuid of film record
+        :return: False if the film doesn't exist or its transcode didn't fail.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                RETRY_TRANSCODE_QUERY,
+                (FilmState.NOT_TRANSCODED, uuid, FilmState.FAILED),
+            )
+            return cur.fetchone() is not None
+
+    def get_leased_filenames(self) -> list[str]:
+        """
+        :return: filenames of the films being transcoded under a live lease
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(LEASED_FILENAMES_QUERY, (FilmState.TRANSCODING,))
+            return [i[0] for i in cur.fetchall()]
+
+    def record_transcode_progress(
+        self, progress: dict[UUID, TranscodeProgress], worker_id: str
+    ) -> None:
+        """
+        Records the progress of several films in a single statement.
+        Progress of the films the transcoder no longer holds a lease for is dropped.
+        :param progress: latest progress of each film
+        :param worker_id: id the films were claimed with
+        """
+        values = list(progress.values())
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                RECORD_PROGRESS_QUERY,
+                (
+                    list(progress.keys()),
+                    [i.frame for i in values],
+                    [i.seconds for i in values],
+                    [i.duration for i in values],
+                    [i.speed for i in values],
+                    [i.eta for i in values],
+                    worker_id,
+                    FilmState.TRANSCODING,
+                ),
+            )
+
+    def get_transcode_status(self, uuid: RecordUUIDLike) -> TranscodeStatus | None:
+        """
+        :param uuid: uuid of film record
+        :return: queue position or progress of the film, none if it doesn't exist.
+        """
+        with self.pool.connection() as conn, conn.cursor(
+            row_factory=DictRowFactory
+        ) as cur:
+            cur.execute(
+                TRANSCODE_STATUS_QUERY,
+                (FilmState.NOT_TRANSCODED, FilmState.TRANSCODING, uuid),
+            )
+            record: dict[str, Any] | None = cur.fetchone()
+            return transcode_status_from_record(record) if record else None
+
+    def get_transcode_queue(self, limit: int = 100) -> TranscodeQueue:
+        """
+        :param limit: maximum number of waiting films to list
+        :return: the films being transcoded with their progress, the next films to be transcoded, and the films
+        whose transcode failed.
+        """
+        with self.pool.connection() as conn, conn.cursor(
+            row_factory=DictRowFactory
+        ) as cur:
+            cur.execute(
+                TRANSCODE_QUEUE_QUERY,
+                (
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.TRANSCODING,
+                    FilmState.NOT_TRANSCODED,
+                    FilmState.TRANSCODING,
+                    FilmState.FAILED,
+                    limit,
+                ),
+            )
+            statuses = [transcode_status_from_record(i) for i in cur.fetchall()]
+        return TranscodeQueue(
+            backlog=self.get_transcode_backlog(),
+            transcoding=[i for i in statuses if i.state == FilmState.TRANSCODING],
+            queued=[i for i in statuses if i.state == FilmState.NOT_TRANSCODED],
+            failed=[i for i in statuses if i.state == FilmState.FAILED],
+        )
+
+    def get_transcode_backlog(self) -> int:
+        """
+        :return: number of films waiting for transcode
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(TRANSCODE_BACKLOG_QUERY, (FilmState.NOT_TRANSCODED,))
+            result: tuple[int] = cur.fetchone()  # type: ignore
+            return result[0]
+
+    def search_films(self, text: str, limit: int = 20) -> list[FilmNoBytes]:
+        """
+        Finds films by title and actresses. Every word searched must start a word of the film, or, if pg_trgm is
+        installed, closely match a part of it.
+        :param text: searched text, as typed
+        :param limit: maximum number of films found
+        :return: the films found, best match first.
+        """
+        if (params := search_params(text, limit)) is None:
+            return list()
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            if self.fuzzy_search is None:
+                self.fuzzy_search = bool(
+                    conn.execute(FUZZY_SEARCH_AVAILABLE_QUERY).fetchone()[0]  # type: ignore[index]
+                )
+            cur.execute(
+                FUZZY_SEARCH_FILMS_QUERY if self.fuzzy_search else SEARCH_FILMS_QUERY,
+                params,
+            )
+            return cur.fetchall()
+
+    def get_films_page(self, query: FilmPageQuery) -> FilmPage:
+        """
+        Returns one page of films, filtered and sorted. Pages are addressed with keyset cursors, so the cost
+        of a page does not grow with its position in the library.
+        :param query:
+        :return: the films of the page, and the cursor of the next page if there is one.
+        :raises ValueError: if the cursor is invalid
+        """
+        composed, params = build_film_page_query(query)
+        with self.pool.connection() as conn, conn.cursor(row_factory=film_row) as cur:
+            cur.execute(composed, params)
+            return film_page_from_records(cur.fetchall(), query)
+
     @classmethod
     def from_env(cls, load_dot_env: bool = False) -> Database:  # pragma: no cover
         """
@@ -384,20 +1335,4 @@ class Database:
         :param load_dot_env:
         :return:
         """
-        if load_dot_env:
-            assert dotenv.load_dotenv()
-        try:
-            return Database(
-                db_name=os.environ["POSTGRES_DB"],
-                db_user=os.environ["POSTGRES_USER"],
-                db_password=os.environ["POSTGRES_PASSWORD"],
-                db_host=os.environ["POSTGRES_HOST"],
-                db_port=os.environ["POSTGRES_PORT"],
-                max_retries=int(os.environ["POSTGRES_MAX_RETRIES"]),
-                max_connections=int(os.environ["POSTGRES_MAX_CONNECTIONS"]),
-                min_connections=int(os.environ["POSTGRES_MIN_CONNECTIONS"]),
-                retry_interval=int(os.environ["POSTGRES_RETRY_INTERVAL"]),
-            )
-        except* (KeyError, ValueError):
-            logging.critical("Environment variables are not correctly configured.")
-            raise
+        return Database(**config_from_env(load_dot_env))
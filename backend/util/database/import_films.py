@@ -0,0 +1,72 @@
+"""
+Imports films from a manifest: a JSONL file with one film per line, e.g.
+{"title": "...", "filename": "film.mp4", "actresses": ["..."], "thumbnail": "images/film.png", "poster": "..."}
+filename is relative to APP_FILM_PATH, and the images to the manifest. Optional keys: date_added (an ISO 8601 date,
+defaults to today), watched (defaults to false), state (defaults to NOT_TRANSCODED), thumbnail and poster (extracted
+by the transcoder when left out).
+The manifest is streamed; only a batch of films and their images is held in memory at once.
+"""
+import argparse
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+from util.database.database import DEFAULT_INSERT_BATCH, Database
+from util.models.film import Film, FilmState
+
+
+def read_manifest(manifest: Path) -> Iterator[Film]:
+    """
+    :param manifest: JSONL file, see the module docstring
+    :return: the films of the manifest, read one line at a time.
+    :raises ValueError: if a line is not a valid film, with its line number.
+    """
+    with manifest.open(encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                yield Film(
+                    uuid=None,
+                    title=entry["title"],
+                    date_added=datetime.fromisoformat(entry["date_added"])
+                    if "date_added" in entry
+                    else datetime.now(),
+                    filename=entry["filename"],
+                    watched=bool(entry.get("watched", False)),
+                    state=FilmState(entry.get("state", FilmState.NOT_TRANSCODED.value)),
+                    rating=None,
+                    actresses=list(entry.get("actresses", [])),
+                    thumbnail=(manifest.parent / entry["thumbnail"]).read_bytes()
+                    if entry.get("thumbnail")
+                    else None,
+                    poster=(manifest.parent / entry["poster"]).read_bytes()
+                    if entry.get("poster")
+                    else None,
+                )
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                raise ValueError(f"{manifest}:{number}: invalid film: {e!r}") from e
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("manifest", type=Path)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_INSERT_BATCH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = Database.from_env(load_dot_env=True)
+    try:
+        uuids = db.insert_films(read_manifest(args.manifest), args.batch_size)
+    except ValueError as e:
+        logging.critical(f"{e}. The batches before it were imported.")
+        return 1
+    logging.info(f"Import complete, {len(uuids)} films imported.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
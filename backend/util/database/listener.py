@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import threading
+from typing import Awaitable, Callable
+from uuid import UUID
+
+import psycopg
+
+from util.models.history import HistoryEvent
+
+HISTORY_CHANNEL = "history"
+
+TRANSCODE_CHANNEL = "transcode"
+
+
+class HistoryListener:
+    def __init__(
+        self,
+        conninfo: str,
+        on_event: Callable[[HistoryEvent], None],
+        on_connect: Callable[[], Awaitable[None]],
+        reconnect_interval: float = 5.0,
+    ) -> None:
+        """
+        Listens for the notifications published by the history triggers on a dedicated connection.
+        Runs as a task on the event loop it is started in; while disconnected, `connected` is False so
+        callers can fall back to polling.
+        :param conninfo: connection string of the database
+        :param on_event: called for every history entry committed
+        :param on_connect: awaited after every (re)connection, as events may have been missed while disconnected
+        :param reconnect_interval: seconds to wait before reconnecting after the connection drops
+        """
+        self.conninfo = conninfo
+        self.on_event = on_event
+        self.on_connect = on_connect
+        self.reconnect_interval = reconnect_interval
+        self.connected = False
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="history-listener")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _handle(self, notify: psycopg.Notify) -> None:
+        payload = json.loads(notify.payload)
+        self.on_event(
+            HistoryEvent(
+                uuid=UUID(payload["uuid"]),
+                table_name=payload["table_name"],
+                action=payload["action"],
+                record_uuid=UUID(payload["record_uuid"])
+                if payload["record_uuid"]
+                else None,
+                seq=payload["seq"],
+            )
+        )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.conninfo, autocommit=True
+                ) as conn:
+                    await conn.execute(f"LISTEN {HISTORY_CHANNEL};")
+                    self.connected = True
+                    logging.info("Listening for history notifications")
+                    await self.on_connect()
+                    async for notify in conn.notifies():
+                        self._handle(notify)
+            except Exception:  # the listener must outlive any failure
+                logging.exception(
+                    f"History listener disconnected. Reconnecting in {self.reconnect_interval} seconds."
+                )
+            finally:
+                self.connected = False
+            await asyncio.sleep(self.reconnect_interval)
+
+
+class TranscodeListener:
+    def __init__(
+        self,
+        conninfo: str,
+        on_notify: Callable[[], None],
+        reconnect_interval: float = 5.0,
+    ) -> None:
+        """
+        Listens for films entering the transcode queue on a dedicated connection, in a background thread.
+        Notifications only wake the transcoder up early; it must keep polling as a safety net, as notifications
+        sent while disconnected are lost.
+        :param conninfo: connection string of the database
+        :param on_notify: called when films were queued, and after every (re)connection. Runs on the listener thread.
+        :param reconnect_interval: seconds to wait before reconnecting after the connection drops
+        """
+        self.conninfo = conninfo
+        self.on_notify = on_notify
+        self.reconnect_interval = reconnect_interval
+        self.connected = False
+        self._stopped = threading.Event()
+        self._conn: psycopg.Connection[tuple[object, ...]] | None = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._stopped.clear()  # may be started again after a stop
+        self._thread = threading.Thread(
+            target=self._run, name="transcode-listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if (conn := self._conn) is not None:
+            conn.close()  # ends the blocking wait for notifications
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as conn:
+                    self._conn = conn
+                    if self._stopped.is_set():
+                        break
+                    conn.execute(f"LISTEN {TRANSCODE_CHANNEL};")
+                    self.connected = True
+                    logging.info("Listening for transcode notifications")
+                    self.on_notify()  # films may have been queued while disconnected
+                    for _ in conn.notifies():
+                        self.on_notify()
+            except Exception:  # the listener must outlive any failure
+                if not self._stopped.is_set():
+                    logging.exception(
+                        f"Transcode listener disconnected. Reconnecting in {self.reconnect_interval} seconds."
+                    )
+            finally:
+                self.connected = False
+                self._conn = None
+            self._stopped.wait(self.reconnect_interval)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from util.database.async_database import AsyncDatabase
+from util.database.database import DEFAULT_TRIM_BATCH
+
+DEFAULT_RETENTION_DAYS = 30
+
+# seconds between two runs of the retention job
+DEFAULT_TRIM_INTERVAL = 3600.0
+
+# seconds between two batches, so the writers waiting on a batch catch up before the next one.
+TRIM_PAUSE = 0.1
+
+
+class HistoryRetention:
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        retention: float,
+        interval: float = DEFAULT_TRIM_INTERVAL,
+        batch_size: int = DEFAULT_TRIM_BATCH,
+    ) -> None:
+        """
+        Deletes the history entries older than the retention, in the background. Runs as a task on the event loop it
+        is started in, in batches of short transactions.
+        Clients that have not synchronized within the retention must load the whole films list again.
+        :param db:
+        :param retention: seconds history entries are kept for
+        :param interval: seconds between two runs
+        :param batch_size: entries deleted per transaction
+        """
+        self.db = db
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="history-retention")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def trim(self) -> int:
+        """
+        Deletes every history entry older than the retention, a batch at a time.
+        :return: number of entries deleted
+        """
+        total = 0
+        while True:
+            deleted = await self.db.trim_history(self.retention, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            await asyncio.sleep(TRIM_PAUSE)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if deleted := await self.trim():
+                    logging.info(f"Trimmed {deleted} history entries.")
+            except Exception:  # the job must outlive any failure
+                logging.exception(
+                    f"History retention failed. Retrying in {self.interval} seconds."
+                )
+            await asyncio.sleep(self.interval)
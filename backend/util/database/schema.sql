@@ -9,6 +9,8 @@ BEGIN
         CREATE TYPE film_state AS ENUM ('NOT_TRANSCODED','TRANSCODING', 'COMPLETE');
     END IF;
 END $$;
+-- films whose transcode ran out of attempts; they wait for a retry.
+ALTER TYPE film_state ADD VALUE IF NOT EXISTS 'FAILED';
 
 -- Rating table
 CREATE TABLE IF NOT EXISTS rating (
@@ -61,6 +63,78 @@ CREATE TABLE IF NOT EXISTS film (
   rating uuid REFERENCES rating(uuid) ON DELETE CASCADE
 );
 
+-- images may live in an image store instead, in which case the film record only keeps their keys.
+ALTER TABLE film ADD COLUMN IF NOT EXISTS thumbnail_hash text;
+ALTER TABLE film ADD COLUMN IF NOT EXISTS poster_hash text;
+ALTER TABLE film ALTER COLUMN thumbnail DROP NOT NULL;
+ALTER TABLE film ALTER COLUMN poster DROP NOT NULL;
+
+-- transcoders lease the films they claim and renew the lease while they work on them.
+-- a film whose lease expired is put back in the queue by the reaper, or marked FAILED once out of attempts.
+ALTER TABLE film ADD COLUMN IF NOT EXISTS worker_id text;
+ALTER TABLE film ADD COLUMN IF NOT EXISTS lease_expires_at timestamptz;
+ALTER TABLE film ADD COLUMN IF NOT EXISTS heartbeat_at timestamptz;
+ALTER TABLE film ADD COLUMN IF NOT EXISTS transcode_attempts integer NOT NULL DEFAULT 0;
+-- skip, remux, audio or encode: what the transcoder found it had to do to make the film playable.
+ALTER TABLE film ADD COLUMN IF NOT EXISTS transcode_method text;
+
+-- films left in TRANSCODING before leases existed are orphaned; let the reaper requeue them.
+UPDATE film SET lease_expires_at = now()
+WHERE state = 'TRANSCODING' AND lease_expires_at IS NULL;
+
+-- progress of the films being transcoded, reported by the transcoders a few times a minute.
+-- kept out of the film table so the frequent writes don't churn film rows or their history.
+CREATE TABLE IF NOT EXISTS transcode_progress (
+  film uuid PRIMARY KEY REFERENCES film(uuid) ON DELETE CASCADE,
+  frame integer NOT NULL,
+  seconds float NOT NULL,
+  duration float,
+  speed float,
+  eta float,
+  updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- films whose images are still to be moved out by the image migration.
+CREATE INDEX IF NOT EXISTS film_legacy_images_idx ON film (uuid)
+WHERE thumbnail IS NOT NULL OR poster IS NOT NULL;
+
+-- indexes backing the keyset-paginated film queries. the uuid breaks ties between equal sort values.
+CREATE INDEX IF NOT EXISTS film_date_added_uuid_idx ON film (date_added, uuid);
+CREATE INDEX IF NOT EXISTS film_title_uuid_idx ON film (title, uuid);
+CREATE INDEX IF NOT EXISTS film_state_idx ON film (state);
+CREATE INDEX IF NOT EXISTS film_lease_expires_at_idx ON film (lease_expires_at)
+WHERE state = 'TRANSCODING';
+CREATE INDEX IF NOT EXISTS film_rating_idx ON film (rating);
+CREATE INDEX IF NOT EXISTS rating_average_uuid_idx ON rating ((coalesce(average, 0)), uuid);
+
+-- containment queries on the actresses of a film (actresses @> ARRAY[name]) use this index.
+CREATE INDEX IF NOT EXISTS film_actresses_idx ON film USING gin (actresses);
+
+-- search over the title and actresses of films. pg_trgm ships with postgres, but creating it takes privileges
+-- a managed database may not grant; without it, search only matches words and word prefixes, not misspellings.
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is unavailable, search will not be fuzzy: %', SQLERRM;
+END $$;
+
+-- the searched text of a film. immutable, so it can be indexed.
+CREATE OR REPLACE FUNCTION film_search_text(title text, actresses text[]) RETURNS text AS $$
+    SELECT lower(title || ' ' || array_to_string(actresses, ' '));
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+CREATE INDEX IF NOT EXISTS film_search_tsv_idx ON film
+USING gin (to_tsvector('simple', film_search_text(title, actresses)));
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        CREATE INDEX IF NOT EXISTS film_search_trgm_idx ON film
+        USING gin (film_search_text(title, actresses) gin_trgm_ops);
+    END IF;
+END $$;
+
 
 -- function to get the weighted average of a film and write it to the entry.
 CREATE OR REPLACE FUNCTION update_rating_average() RETURNS TRIGGER AS $$
@@ -82,31 +156,69 @@ CREATE TABLE IF NOT EXISTS history (
   uuid UUID,
   table_name VARCHAR(255),
   action VARCHAR(10),
-  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  record_uuid UUID
 );
 
+-- record_uuid was added after the initial release; bring existing history tables up to date.
+ALTER TABLE history ADD COLUMN IF NOT EXISTS record_uuid UUID;
+
+-- position of the entry in the history; existing entries are numbered as they are stored.
+ALTER TABLE history ADD COLUMN IF NOT EXISTS seq BIGSERIAL;
+CREATE UNIQUE INDEX IF NOT EXISTS history_seq_idx ON history (seq);
+
+CREATE INDEX IF NOT EXISTS history_timestamp_idx ON history (timestamp);
+
+-- a single row: the seq of the latest entry, so the version of the data is read without scanning the history,
+-- and the seq of the latest entry deleted by the retention job; changes since an earlier entry are lost.
+CREATE TABLE IF NOT EXISTS history_version (
+  single boolean PRIMARY KEY DEFAULT true CHECK (single),
+  seq bigint NOT NULL,
+  trimmed_seq bigint NOT NULL DEFAULT 0
+);
+INSERT INTO history_version (seq) SELECT coalesce(max(seq), 0) FROM history ON CONFLICT DO NOTHING;
+
+-- entries are numbered in the order their transactions commit, so a reader that has seen an entry has seen
+-- every entry before it: the row of the counter stays locked from the first entry of a transaction until it
+-- commits. the history triggers are deferred, so a transaction only writes its entries as it commits: writers
+-- queue up on the counter for their commit, not for their whole transaction.
+CREATE OR REPLACE FUNCTION next_history_seq() RETURNS bigint AS $$
+  UPDATE history_version SET seq = seq + 1 RETURNING seq;
+$$ LANGUAGE sql;
+
+-- the sequence of the column only numbered the existing entries.
+ALTER TABLE history ALTER COLUMN seq SET DEFAULT next_history_seq();
+DROP SEQUENCE IF EXISTS history_seq_seq;
+
 
 CREATE OR REPLACE FUNCTION insert_update_delete_history_film()
 RETURNS TRIGGER AS $$
 BEGIN
   IF (TG_OP = 'INSERT') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'film', 'insert');
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'film', 'insert', NEW.uuid);
     RETURN NEW;
   ELSIF (TG_OP = 'UPDATE') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'film', 'update');
+    -- lease renewals are bookkeeping of the transcoders, not changes to the film.
+    IF (to_jsonb(NEW) - ARRAY['worker_id', 'lease_expires_at', 'heartbeat_at', 'transcode_attempts'])
+       = (to_jsonb(OLD) - ARRAY['worker_id', 'lease_expires_at', 'heartbeat_at', 'transcode_attempts']) THEN
+      RETURN NEW;
+    END IF;
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'film', 'update', NEW.uuid);
     RETURN NEW;
   ELSIF (TG_OP = 'DELETE') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'film', 'delete');
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'film', 'delete', OLD.uuid);
     RETURN OLD;
   END IF;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE TRIGGER insert_update_delete_history_film_trigger
+DROP TRIGGER IF EXISTS insert_update_delete_history_film_trigger ON film;
+CREATE CONSTRAINT TRIGGER insert_update_delete_history_film_trigger
 AFTER INSERT OR UPDATE OR DELETE ON film
+DEFERRABLE INITIALLY DEFERRED
 FOR EACH ROW
 EXECUTE FUNCTION insert_update_delete_history_film();
 
@@ -114,16 +226,16 @@ CREATE OR REPLACE FUNCTION insert_update_delete_history_rating()
 RETURNS TRIGGER AS $$
 BEGIN
   IF (TG_OP = 'INSERT') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'rating', 'insert');
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'rating', 'insert', NEW.uuid);
     RETURN NEW;
   ELSIF (TG_OP = 'UPDATE') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'rating', 'update');
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'rating', 'update', NEW.uuid);
     RETURN NEW;
   ELSIF (TG_OP = 'DELETE') THEN
-    INSERT INTO history (uuid, table_name, action)
-    VALUES (uuid_generate_v4(), 'rating', 'delete');
+    INSERT INTO history (uuid, table_name, action, record_uuid)
+    VALUES (uuid_generate_v4(), 'rating', 'delete', OLD.uuid);
     RETURN OLD;
   END IF;
 END;
@@ -134,8 +246,45 @@ $$ LANGUAGE plpgsql;
 
 
 -- function to log history
-CREATE OR REPLACE TRIGGER  insert_update_delete_history_rating_trigger
+DROP TRIGGER IF EXISTS insert_update_delete_history_rating_trigger ON rating;
+CREATE CONSTRAINT TRIGGER insert_update_delete_history_rating_trigger
 AFTER INSERT OR UPDATE OR DELETE ON rating
+DEFERRABLE INITIALLY DEFERRED
 FOR EACH ROW
 EXECUTE FUNCTION insert_update_delete_history_rating();
 
+-- publish every history entry on the "history" channel so listeners can invalidate their caches
+CREATE OR REPLACE FUNCTION notify_history()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM pg_notify('history', json_build_object(
+    'uuid', NEW.uuid,
+    'table_name', NEW.table_name,
+    'action', NEW.action,
+    'record_uuid', NEW.record_uuid,
+    'seq', NEW.seq
+  )::text);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER notify_history_trigger
+AFTER INSERT ON history
+FOR EACH ROW
+EXECUTE FUNCTION notify_history();
+
+-- wake the transcoders up on the "transcode" channel whenever a film enters the queue.
+-- the payload is constant, so a transaction queuing many films sends a single notification.
+CREATE OR REPLACE FUNCTION notify_transcode()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM pg_notify('transcode', '');
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER notify_transcode_trigger
+AFTER INSERT OR UPDATE OF state ON film
+FOR EACH ROW
+WHEN (NEW.state = 'NOT_TRANSCODED')
+EXECUTE FUNCTION notify_transcode();
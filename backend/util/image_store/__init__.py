@@ -0,0 +1,83 @@
+import abc
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+
+class ImageStore(abc.ABC):
+    @abc.abstractmethod
+    def put(self, image: bytes) -> str | None:
+        """
+        Stores an image.
+        :param image:
+        :return: key of the stored image, none if the image is to be kept in the film record.
+        """
+
+    @abc.abstractmethod
+    def path(self, key: str) -> Path | None:
+        """
+        Locates a stored image on disk, so it can be served straight from the file.
+        :param key: key returned by put
+        :return: path, none if the image is not stored.
+        """
+
+
+class PostgresImageStore(ImageStore):
+    """
+    Legacy backend; images are kept in the bytea columns of the film table.
+    """
+
+    def put(self, image: bytes) -> str | None:
+        return None
+
+    def path(self, key: str) -> Path | None:
+        return None
+
+
+class LocalImageStore(ImageStore):
+    def __init__(self, root: Path) -> None:
+        """
+        Content-addressed directory. Images are keyed by their sha256 digest, so identical images are stored once
+        and writing the same image twice is a no-op.
+        :param root: directory of the store, created if it doesn't exist.
+        """
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        if len(key) != 64 or not all(c in "0123456789abcdef" for c in key):
+            raise ValueError("invalid image key")
+        return self.root / key[:2] / key
+
+    def put(self, image: bytes) -> str:
+        key = hashlib.sha256(image).hexdigest()
+        path = self._path(key)
+        if path.exists():
+            return key
+        path.parent.mkdir(exist_ok=True)
+        # write next to the destination and rename, so a crash never leaves a partial image behind the key.
+        fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(image)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return key
+
+    def path(self, key: str) -> Path | None:
+        path = self._path(key)
+        return path if path.is_file() else None
+
+
+def image_store_from_env() -> ImageStore:  # pragma: no cover
+    """
+    Builds the image store configured in the local environment.
+    APP_IMAGE_STORE_PATH selects the local store; without it, images are kept in postgres.
+    :return:
+    """
+    if root := os.environ.get("APP_IMAGE_STORE_PATH"):
+        return LocalImageStore(Path(root))
+    return PostgresImageStore()
@@ -0,0 +1,35 @@
+"""
+Moves the thumbnails and posters stored in the film table into the image store at APP_IMAGE_STORE_PATH.
+Runs in batches, one transaction each; it can be interrupted and re-run at any time to resume.
+"""
+import argparse
+import logging
+
+from util.database.database import Database
+from util.image_store import LocalImageStore
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = Database.from_env(load_dot_env=True)
+    if not isinstance(store := db.image_store, LocalImageStore):
+        logging.critical("APP_IMAGE_STORE_PATH must be set to migrate images.")
+        return 1
+
+    total = 0
+    while migrated := db.migrate_image_batch(store, batch_size=args.batch_size):
+        total += migrated
+        logging.info(f"Migrated {total} films")
+    logging.info(
+        f"Migration complete, {total} films migrated. "
+        "Run VACUUM FULL film to return the space of the removed images to the OS."
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,152 @@
+import functools
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+from typing import Literal
+
+try:
+    from PIL import Image, features
+except ImportError:  # pragma: no cover
+    # Pillow is a server dependency; without it, images are served as stored and the server warns on startup.
+    Image = None  # type: ignore[assignment]
+
+VariantFormat = Literal["png", "webp", "avif"]
+
+MEDIA_TYPES: dict[VariantFormat, str] = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+# requested widths are rounded up to one of these, so every image has a bounded number of variants.
+WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)
+
+
+@functools.cache
+def available_formats() -> list[VariantFormat]:
+    """
+    Formats the installed Pillow can encode, most compact first.
+    :return: empty if Pillow is not installed.
+    """
+    if Image is None:  # pragma: no cover
+        return list()
+    formats: list[VariantFormat] = [i for i in ("avif", "webp") if features.check(i)]
+    return [*formats, "png"]
+
+
+def negotiate_format(accept: str | None) -> VariantFormat:
+    """
+    Picks the most compact format the client accepts.
+    :param accept: Accept header of the request
+    :return:
+    """
+    accepted = {
+        i.split(";")[0].strip().lower() for i in (accept or "").split(",") if i.strip()
+    }
+    for format in available_formats():
+        if MEDIA_TYPES[format] in accepted:
+            return format
+    return "png"
+
+
+def snap_width(width: int) -> int:
+    """
+    :param width: requested width in pixels
+    :return: smallest bucket of WIDTHS that is at least as wide, or the widest bucket.
+    """
+    for bucket in WIDTHS:
+        if bucket >= width:
+            return bucket
+    return WIDTHS[-1]
+
+
+def render_variant(source: bytes | Path, width: int, format: VariantFormat) -> bytes:
+    """
+    Resizes and re-encodes an image. Images are never upscaled.
+    Runs in a worker process; the source may be a path so the image isn't copied between processes.
+    :param source: image, or path of the image
+    :param width: maximum width in pixels; the aspect ratio is kept.
+    :param format:
+    :return: encoded variant
+    """
+    assert Image is not None
+    with Image.open(
+        source if isinstance(source, Path) else io.BytesIO(source)
+    ) as image:
+        image.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        variant: Image.Image = image
+        if format != "png" and image.mode not in ("RGB", "RGBA"):
+            variant = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        output = io.BytesIO()
+        match format:
+            case "avif":
+                variant.save(output, "AVIF", quality=60, speed=6)
+            case "webp":
+                variant.save(output, "WEBP", quality=80, method=4)
+            case "png":
+                variant.save(output, "PNG", optimize=True)
+        return output.getvalue()
+
+
+class VariantCache:
+    def __init__(self, root: Path) -> None:
+        """
+        Disk cache of rendered variants. Variants are keyed by the sha256 digest of their source image,
+        so they never need to be invalidated; a changed image simply has a new digest.
+        :param root: directory of the cache, created if it doesn't exist.
+        """
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def digest(image: bytes) -> str:
+        return hashlib.sha256(image).hexdigest()
+
+    def path(self, digest: str, width: int, format: VariantFormat) -> Path:
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError("invalid image digest")
+        return self.root / digest[:2] / f"{digest}-{width}.{format}"
+
+    def get(self, digest: str, width: int, format: VariantFormat) -> Path | None:
+        """
+        :return: path of the variant, none if it wasn't rendered yet.
+        """
+        path = self.path(digest, width, format)
+        return path if path.is_file() else None
+
+    def put(
+        self, digest: str, width: int, format: VariantFormat, variant: bytes
+    ) -> Path:
+        """
+        Stores a rendered variant.
+        :return: path of the variant
+        """
+        path = self.path(digest, width, format)
+        path.parent.mkdir(exist_ok=True)
+        # write next to the destination and rename, so a crash never leaves a partial variant behind.
+        fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(variant)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return path
+
+    @classmethod
+    def from_env(cls) -> "VariantCache":  # pragma: no cover
+        """
+        Builds a VariantCache in APP_IMAGE_VARIANT_CACHE_PATH, or in the temporary directory.
+        :return:
+        """
+        return VariantCache(
+            Path(
+                os.environ.get(
+                    "APP_IMAGE_VARIANT_CACHE_PATH",
+                    Path(tempfile.gettempdir()) / "abstracted.reaction-variants",
+                )
+            )
+        )
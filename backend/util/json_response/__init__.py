@@ -0,0 +1,56 @@
+import dataclasses
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any
+from uuid import UUID
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]  # orjson is optional; responses fall back to the json module.
+
+
+def default(value: Any) -> Any:
+    """
+    Encodes the types json can't, as FastAPI's jsonable_encoder does.
+    :param value:
+    :return: json encodable value
+    """
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {i.name: getattr(value, i.name) for i in dataclasses.fields(value)}
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encodes the util.models dataclasses, and the lists and dicts of them, straight to JSON, without validating
+    them or converting them to dicts first. The output is the same as FastAPI's: compact, UTF-8, fields in
+    order, UUIDs as strings, dates in ISO 8601 and enums as their value.
+    :param content:
+    :return: JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content,
+        default=default,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
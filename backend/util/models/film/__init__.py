@@ -10,9 +10,10 @@ class FilmState(Enum):
     NOT_TRANSCODED = "NOT_TRANSCODED"
     TRANSCODING = "TRANSCODING"
     COMPLETE = "COMPLETE"
+    FAILED = "FAILED"  # the transcode ran out of attempts; it waits for a retry.
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class FilmNoBytes:
     uuid: RecordUUIDLikeNullable
     title: str
@@ -24,9 +25,9 @@ class FilmNoBytes:
     actresses: list[str]
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Film(FilmNoBytes):
-    thumbnail: bytes
-    poster: bytes
+    thumbnail: bytes | None  # none to extract it from the film when it is transcoded.
+    poster: bytes | None
     rating: Rating | None  # type: ignore
     # type ignored because I disagree.
@@ -0,0 +1,11 @@
+import dataclasses
+from uuid import UUID
+
+from util.models.film import FilmNoBytes
+
+
+@dataclasses.dataclass
+class FilmChanges:
+    seq: int  # last history entry the changes cover; the since of the next request.
+    upserted: list[FilmNoBytes]  # inserted or updated, as they are now
+    deleted: list[UUID]
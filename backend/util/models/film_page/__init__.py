@@ -0,0 +1,27 @@
+import dataclasses
+from datetime import date
+from typing import Literal
+
+from util.models.film import FilmNoBytes, FilmState
+
+FilmSortKey = Literal["date_added", "title", "average"]
+
+
+@dataclasses.dataclass
+class FilmPageQuery:
+    limit: int = 50
+    cursor: str | None = None  # opaque keyset cursor returned with the previous page
+    sort: FilmSortKey = "date_added"
+    descending: bool = True
+    state: FilmState | None = None
+    watched: bool | None = None
+    actress: str | None = None
+    date_from: date | None = None
+    date_to: date | None = None
+    min_average: float | None = None
+
+
+@dataclasses.dataclass
+class FilmPage:
+    films: list[FilmNoBytes]
+    next_cursor: str | None
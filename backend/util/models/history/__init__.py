@@ -0,0 +1,11 @@
+import dataclasses
+from uuid import UUID
+
+
+@dataclasses.dataclass
+class HistoryEvent:
+    uuid: UUID
+    table_name: str
+    action: str
+    record_uuid: UUID | None
+    seq: int  # position in the history, see Database.get_film_changes
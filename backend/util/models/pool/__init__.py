@@ -0,0 +1,17 @@
+import dataclasses
+
+
+@dataclasses.dataclass
+class PoolStats:
+    size: int  # connections open
+    available: int  # idle connections
+    min_size: int
+    max_size: int
+    waiting: int  # clients waiting for a connection right now
+    requests: int  # connections handed out since the pool opened
+    queued: int  # requests that had to wait for a connection
+    wait_ms: int  # total time requests waited for a connection
+    usage_ms: int  # total time connections were checked out
+    request_errors: int  # requests that timed out waiting, or were turned away
+    connection_errors: int  # failed attempts to open a connection
+    connections_lost: int  # connections found broken
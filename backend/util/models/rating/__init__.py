@@ -3,7 +3,7 @@ import dataclasses
 from util.models.uuid import RecordUUIDLikeNullable
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Rating:
     uuid: RecordUUIDLikeNullable
     average: float
@@ -0,0 +1,11 @@
+import dataclasses
+from typing import Literal
+
+SearchField = Literal["title", "actress"]
+
+
+@dataclasses.dataclass
+class SearchCompletion:
+    text: str  # the title or name, as written
+    field: SearchField
+    films: int  # with this title, or with this actress
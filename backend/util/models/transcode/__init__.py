@@ -0,0 +1,34 @@
+import dataclasses
+from datetime import datetime
+from uuid import UUID
+
+from util.models.film import FilmState
+
+
+@dataclasses.dataclass
+class TranscodeProgress:
+    frame: int
+    seconds: float  # of the film transcoded so far
+    duration: float | None  # of the film, none if ffprobe doesn't know it
+    speed: float | None  # times realtime
+    eta: float | None  # seconds left
+    updated_at: datetime | None = None
+
+
+@dataclasses.dataclass
+class TranscodeStatus:
+    uuid: UUID
+    title: str
+    state: FilmState
+    position: int | None  # in the queue, from 1; none unless NOT_TRANSCODED.
+    worker_id: str | None
+    attempts: int
+    progress: TranscodeProgress | None  # none unless TRANSCODING, and reported at least once.
+
+
+@dataclasses.dataclass
+class TranscodeQueue:
+    backlog: int  # films waiting for a transcoder
+    transcoding: list[TranscodeStatus]
+    queued: list[TranscodeStatus]  # the next films to be claimed, in order
+    failed: list[TranscodeStatus]  # out of attempts, until they are retried
@@ -0,0 +1,23 @@
+from pathlib import Path
+
+# written by the transcoder next to the film file, read by the server.
+STREAM_DIRECTORY_SUFFIX = ".abr"
+
+DASH_MANIFEST = "manifest.mpd"
+
+HLS_MANIFEST = "master.m3u8"
+
+STREAM_MEDIA_TYPES = {
+    ".mpd": "application/dash+xml",
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+
+
+def stream_directory(film_file: Path) -> Path:
+    """
+    :param film_file: path of the film file
+    :return: directory of the adaptive-bitrate renditions of the film
+    """
+    return film_file.with_name(film_file.name + STREAM_DIRECTORY_SUFFIX)
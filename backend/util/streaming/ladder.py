@@ -0,0 +1,119 @@
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+import ffmpeg
+
+from util.models.transcode import TranscodeProgress
+from util.streaming import DASH_MANIFEST, stream_directory
+from util.transcode import run
+
+
+@dataclass(frozen=True)
+class Rendition:
+    height: int
+    video_bitrate: int  # kbit/s
+
+
+LADDER = (
+    Rendition(height=1080, video_bitrate=5000),
+    Rendition(height=720, video_bitrate=2800),
+    Rendition(height=480, video_bitrate=1400),
+    Rendition(height=360, video_bitrate=800),
+)
+
+AUDIO_BITRATE = 128  # kbit/s, shared by every rendition
+
+SEGMENT_SECONDS = 4
+
+
+def select_renditions(
+    source_height: int, ladder: tuple[Rendition, ...] = LADDER
+) -> list[Rendition]:
+    """
+    Drops the renditions taller than the source; films are never upscaled.
+    :param source_height: height of the source video in pixels
+    :param ladder:
+    :return: renditions to encode, tallest first. A source shorter than the whole ladder gets a single
+    rendition at its own height.
+    """
+    renditions = [i for i in ladder if i.height <= source_height]
+    if not renditions:
+        smallest = min(ladder, key=lambda i: i.height)
+        renditions = [
+            Rendition(source_height - source_height % 2, smallest.video_bitrate)
+        ]
+    return sorted(renditions, key=lambda i: i.height, reverse=True)
+
+
+def package(
+    input_file: Path,
+    ladder: tuple[Rendition, ...] = LADDER,
+    threads: int = 0,
+    on_progress: Callable[[TranscodeProgress], None] | None = None,
+) -> Path:
+    """
+    Encodes a film into a ladder of renditions, segmented for adaptive streaming, in a single ffmpeg pass.
+    The segments are fragmented mp4, referenced by both a DASH manifest and HLS playlists. Keyframes are
+    forced on segment boundaries so players can switch renditions at any segment.
+    The renditions are written to a temporary directory which then replaces the stream directory of the film,
+    so an interrupted run never leaves a partial ladder behind.
+    :param input_file: film file
+    :param ladder:
+    :param threads: threads ffmpeg may use; 0 lets ffmpeg decide.
+    :param on_progress: see util.transcode.run
+    :return: stream directory of the film
+    """
+    info = ffmpeg.probe(str(input_file))
+    streams = info["streams"]
+    video = next(i for i in streams if i["codec_type"] == "video")
+    has_audio = any(i["codec_type"] == "audio" for i in streams)
+    renditions = select_renditions(int(video["height"]), ladder)
+
+    destination = stream_directory(input_file)
+    temporary = destination.with_name(destination.name + ".artranscode")
+    shutil.rmtree(temporary, ignore_errors=True)
+    temporary.mkdir()
+
+    source = ffmpeg.input(str(input_file))
+    split = source.video.filter_multi_output("split", len(renditions))
+    outputs = [
+        split[i].filter("scale", -2, rendition.height)
+        for i, rendition in enumerate(renditions)
+    ]
+    options: dict[str, Any] = dict()
+    for i, rendition in enumerate(renditions):
+        options[f"b:v:{i}"] = f"{rendition.video_bitrate}k"
+        options[f"maxrate:v:{i}"] = f"{rendition.video_bitrate * 107 // 100}k"
+        options[f"bufsize:v:{i}"] = f"{rendition.video_bitrate * 3 // 2}k"
+    adaptation_sets = "id=0,streams=v"
+    if has_audio:
+        outputs.append(source.audio)
+        options.update({"c:a": "aac", "b:a": f"{AUDIO_BITRATE}k", "ac": 2})
+        adaptation_sets += " id=1,streams=a"
+    run(
+        ffmpeg.output(
+            *outputs,
+            str(temporary / DASH_MANIFEST),
+            format="dash",
+            vcodec="libx264",
+            preset="veryfast",
+            pix_fmt="yuv420p",
+            force_key_frames=f"expr:gte(t,n_forced*{SEGMENT_SECONDS})",
+            sc_threshold=0,
+            seg_duration=SEGMENT_SECONDS,
+            use_template=1,
+            use_timeline=1,
+            hls_playlist=1,
+            adaptation_sets=adaptation_sets,
+            threads=threads,
+            **options,
+        ).overwrite_output(),
+        float(info["format"]["duration"]) if "duration" in info["format"] else None,
+        on_progress,
+    )
+
+    shutil.rmtree(destination, ignore_errors=True)
+    temporary.rename(destination)
+    return destination
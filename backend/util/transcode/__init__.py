@@ -0,0 +1,295 @@
+import struct
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, Callable, Iterable, Iterator, Literal
+
+import ffmpeg
+
+from util.models.transcode import TranscodeProgress
+from util.transcode.images import candidate_outputs, select_candidates
+
+# skip: the file plays as it is. remux: the streams are copied into a new mp4. audio: the video is copied and the
+# audio re-encoded. encode: the video is re-encoded.
+TranscodeMethod = Literal["skip", "remux", "audio", "encode"]
+
+# what every browser plays from a progressive mp4.
+VIDEO_CODECS = {"h264"}
+PIXEL_FORMATS = {"yuv420p", "yuvj420p"}
+AUDIO_CODECS = {"aac"}
+
+VIDEO_CRF = 20
+AUDIO_BITRATE = 160  # kbit/s
+
+# ffmpeg output options of a re-encoded video stream.
+VIDEO_OPTIONS: dict[str, Any] = {
+    "vcodec": "libx264",
+    "preset": "medium",
+    "crf": VIDEO_CRF,
+    "pix_fmt": "yuv420p",
+}
+
+
+@dataclass(frozen=True)
+class TranscodeResult:
+    method: TranscodeMethod | None  # none for adaptive packaging
+    thumbnail: bytes | None = None  # extracted from the film, none if it has no video.
+    poster: bytes | None = None
+
+
+@dataclass(frozen=True)
+class Probe:
+    containers: tuple[str, ...]  # names ffprobe gives the format, e.g. mov, mp4, m4a.
+    video_codec: str | None
+    pixel_format: str | None
+    audio_codecs: tuple[str, ...]
+    faststart: bool  # the index of the mp4 comes before the media, so playback starts before the download ends.
+    duration: float | None = None  # seconds
+    frame_rate: float | None = None  # frames per second, on average
+
+    @property
+    def compatible_video(self) -> bool:
+        return self.video_codec in VIDEO_CODECS and self.pixel_format in PIXEL_FORMATS
+
+    @property
+    def compatible_audio(self) -> bool:
+        return all(i in AUDIO_CODECS for i in self.audio_codecs)
+
+
+def is_faststart(file: Path) -> bool:
+    """
+    Walks the top-level boxes of an mp4 file.
+    :param file:
+    :return: whether the moov box comes before the mdat box. False if the file isn't an mp4.
+    """
+    with file.open("rb") as f:
+        while header := f.read(8):
+            if len(header) < 8:
+                return False
+            size, kind = struct.unpack(">I4s", header)
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+            if size == 1:  # 64-bit size follows the type
+                (size,) = struct.unpack(">Q", f.read(8))
+                size -= 16
+            elif size == 0:  # the box runs to the end of the file
+                return False
+            else:
+                size -= 8
+            if size < 0:
+                return False
+            f.seek(size, 1)
+    return False
+
+
+def frame_rate(stream: dict[str, Any]) -> float | None:
+    """
+    :param stream: ffprobe output of a video stream
+    :return: average frame rate, none if unknown.
+    """
+    numerator, _, denominator = stream.get("avg_frame_rate", "0/0").partition("/")
+    if not float(denominator or 1) or not float(numerator):
+        return None
+    return float(numerator) / float(denominator or 1)
+
+
+def probe(file: Path) -> Probe:
+    """
+    Reads the container and codecs of a film file.
+    :param file:
+    :return:
+    """
+    info: dict[str, Any] = ffmpeg.probe(str(file))
+    # cover art is reported as a video stream; it's never what the film is.
+    videos = [
+        i
+        for i in info["streams"]
+        if i["codec_type"] == "video"
+        and not i.get("disposition", dict()).get("attached_pic")
+    ]
+    containers = tuple(info["format"]["format_name"].split(","))
+    return Probe(
+        containers=containers,
+        video_codec=videos[0]["codec_name"] if videos else None,
+        pixel_format=videos[0].get("pix_fmt") if videos else None,
+        audio_codecs=tuple(
+            i["codec_name"] for i in info["streams"] if i["codec_type"] == "audio"
+        ),
+        faststart="mp4" in containers and is_faststart(file),
+        frame_rate=frame_rate(videos[0]) if videos else None,
+        duration=float(info["format"]["duration"])
+        if "duration" in info["format"]
+        else None,
+    )
+
+
+def decide(source: Probe) -> TranscodeMethod:
+    """
+    Picks the cheapest way to make a film playable in the browser.
+    :param source: probe of the film file
+    :return:
+    """
+    if not source.compatible_video:
+        return "encode"
+    if not source.compatible_audio:
+        return "audio"
+    if "mp4" in source.containers and source.faststart:
+        return "skip"
+    return "remux"
+
+
+def parse_progress(
+    lines: Iterable[str], duration: float | None = None
+) -> Iterator[TranscodeProgress]:
+    """
+    Parses the output of ffmpeg -progress: blocks of key=value lines, each ended by a progress line.
+    :param lines:
+    :param duration: of the film in seconds, to estimate the time left.
+    :return: the progress of each block
+    """
+    block: dict[str, str] = dict()
+    for line in lines:
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        seconds = (
+            int(block["out_time_us"]) / 1_000_000
+            if block.get("out_time_us", "N/A").lstrip("-").isdigit()
+            else 0.0
+        )
+        try:
+            speed: float | None = float(block.get("speed", "").rstrip("x"))
+        except ValueError:
+            speed = None
+        eta = None
+        if duration is not None and speed:
+            eta = max(duration - seconds, 0.0) / speed
+        yield TranscodeProgress(
+            frame=int(block.get("frame", "0")),
+            seconds=max(seconds, 0.0),
+            duration=duration,
+            speed=speed,
+            eta=eta,
+        )
+        block = dict()
+
+
+def run(
+    stream: Any,
+    duration: float | None = None,
+    on_progress: Callable[[TranscodeProgress], None] | None = None,
+) -> None:
+    """
+    Runs ffmpeg, reporting its progress.
+    :param stream: ffmpeg-python output stream
+    :param duration: of the film in seconds
+    :param on_progress: called about twice a second; none to run quietly.
+    :raise ffmpeg.Error: if ffmpeg fails
+    """
+    if on_progress is None:
+        stream.run(quiet=True)
+        return
+    process = stream.global_args("-nostats", "-progress", "pipe:1").run_async(
+        pipe_stdout=True, pipe_stderr=True
+    )
+    # stderr is read aside, so a chatty ffmpeg never blocks on a full pipe.
+    stderr: list[bytes] = list()
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    reader.start()
+    stdout: IO[bytes] = process.stdout
+    for progress in parse_progress(
+        (line.decode(errors="replace") for line in stdout), duration
+    ):
+        on_progress(progress)
+    reader.join()
+    if process.wait():
+        raise ffmpeg.Error("ffmpeg", b"", b"".join(stderr))
+
+
+def remux(
+    input_file: Path,
+    output_file: Path,
+    source: Probe,
+    on_progress: Callable[[TranscodeProgress], None] | None = None,
+) -> None:
+    """
+    Copies the video stream of a film into a faststart mp4. The audio streams are copied if they are already AAC,
+    re-encoded otherwise. Other streams, like subtitles, are dropped.
+    :param input_file:
+    :param output_file:
+    :param source: probe of the input file
+    :param on_progress: see run
+    """
+    streams = ffmpeg.input(str(input_file))
+    run(
+        ffmpeg.output(
+            streams["V:0"],
+            *([streams["a"]] if source.audio_codecs else []),
+            str(output_file),
+            format="mp4",
+            movflags="+faststart",
+            **{"c:v": "copy"},
+            **audio_options(source),
+        ).overwrite_output(),
+        source.duration,
+        on_progress,
+    )
+
+
+def audio_options(source: Probe) -> dict[str, Any]:
+    """
+    :param source: probe of the input file
+    :return: ffmpeg output options of the audio streams; they are copied if they are already AAC.
+    """
+    if source.compatible_audio:
+        return {"c:a": "copy"}
+    return {"c:a": "aac", "b:a": f"{AUDIO_BITRATE}k", "ac": 2}
+
+
+def encode(
+    input_file: Path,
+    output_file: Path,
+    source: Probe,
+    threads: int = 0,
+    on_progress: Callable[[TranscodeProgress], None] | None = None,
+    candidates: Path | None = None,
+) -> None:
+    """
+    Re-encodes a film into a faststart H.264 mp4. Audio is copied if it is already AAC.
+    :param input_file:
+    :param output_file:
+    :param source: probe of the input file
+    :param threads: threads ffmpeg may use; 0 lets ffmpeg decide.
+    :param on_progress: see run
+    :param candidates: directory to extract the candidate frames of the thumbnail and poster to, from the frames
+    decoded for the encode. None to skip.
+    """
+    streams = ffmpeg.input(str(input_file))
+    video = streams["V:0"]
+    images: list[Any] = list()
+    if candidates is not None and source.duration is not None:
+        split = video.split()
+        video = split[0]
+        images = candidate_outputs(
+            select_candidates(split[1], source.duration), candidates
+        )
+    run(
+        ffmpeg.merge_outputs(
+            ffmpeg.output(
+                video,
+                *([streams["a"]] if source.audio_codecs else []),
+                str(output_file),
+                format="mp4",
+                movflags="+faststart",
+                threads=threads,
+                **VIDEO_OPTIONS,
+                **audio_options(source),
+            ),
+            *images,
+        ).overwrite_output(),
+        source.duration,
+        on_progress,
+    )
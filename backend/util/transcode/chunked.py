@@ -0,0 +1,206 @@
+import math
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+import ffmpeg
+
+from util.models.transcode import TranscodeProgress
+from util.transcode import VIDEO_OPTIONS, Probe, audio_options, run
+
+# films at least this long are split, unless configured otherwise.
+SPLIT_THRESHOLD = 1800.0  # seconds
+
+CHUNK_SECONDS = 60.0
+
+# largest drift between the streams, or between the video and its source, the output may have.
+SYNC_TOLERANCE = 0.1  # seconds
+
+
+class SyncError(Exception):
+    pass
+
+
+def stream_timing(info: dict[str, Any], codec_type: str) -> tuple[float, float] | None:
+    """
+    :param info: ffprobe output
+    :param codec_type: video or audio
+    :return: start time and duration in seconds of the first stream of the type, none if there is none.
+    """
+    streams = [
+        i
+        for i in info["streams"]
+        if i["codec_type"] == codec_type
+        and not i.get("disposition", dict()).get("attached_pic")
+    ]
+    if not streams:
+        return None
+    stream = streams[0]
+    duration = stream.get("duration")
+    if duration is None and "DURATION" in stream.get("tags", dict()):
+        # matroska only keeps the duration of a stream in its tags, as HH:MM:SS.nnnnnnnnn
+        hours, minutes, seconds = stream["tags"]["DURATION"].split(":")
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    if duration is None:
+        duration = info["format"]["duration"]
+    return float(stream.get("start_time", 0)), float(duration)
+
+
+def verify_sync(input_file: Path, output_file: Path) -> None:
+    """
+    Checks that no frames were lost or duplicated, and that audio and video are as aligned as in the source.
+    :param input_file:
+    :param output_file:
+    :raise SyncError: if the output drifted from the source by more than SYNC_TOLERANCE
+    """
+    source, output = ffmpeg.probe(str(input_file)), ffmpeg.probe(str(output_file))
+    source_video, output_video = (
+        stream_timing(source, "video"),
+        stream_timing(output, "video"),
+    )
+    if source_video is None or output_video is None:
+        raise SyncError("no video stream")
+    if abs(source_video[1] - output_video[1]) > SYNC_TOLERANCE:
+        raise SyncError(
+            f"video lasts {output_video[1]:.3f}s instead of {source_video[1]:.3f}s"
+        )
+    source_audio, output_audio = (
+        stream_timing(source, "audio"),
+        stream_timing(output, "audio"),
+    )
+    if (source_audio is None) != (output_audio is None):
+        raise SyncError("audio stream lost")
+    if source_audio is None or output_audio is None:
+        return
+    for name, i in (("start", 0), ("end", 1)):
+        source_offset = (source_audio[0] + source_audio[1] * i) - (
+            source_video[0] + source_video[1] * i
+        )
+        output_offset = (output_audio[0] + output_audio[1] * i) - (
+            output_video[0] + output_video[1] * i
+        )
+        if abs(source_offset - output_offset) > SYNC_TOLERANCE:
+            raise SyncError(
+                f"audio {name}s {output_offset:+.3f}s from the video instead of {source_offset:+.3f}s"
+            )
+
+
+def chunk_boundaries(
+    duration: float, chunk_seconds: float, frame_rate: float | None
+) -> list[tuple[float, float | None]]:
+    """
+    :param duration: of the film in seconds
+    :param chunk_seconds:
+    :param frame_rate: of the film, none if unknown
+    :return: start and length in seconds of each chunk; the last one runs to the end of the film.
+    """
+    count = max(math.ceil(duration / chunk_seconds), 1)
+    # cut halfway between frames, so rounding never puts a frame in two chunks, or in none.
+    offset = 0.5 / frame_rate if frame_rate else 0.0
+    starts = [0.0] + [i * chunk_seconds - offset for i in range(1, count)]
+    ends: list[float | None] = [*starts[1:], None]
+    return [
+        (start, None if end is None else end - start)
+        for start, end in zip(starts, ends)
+    ]
+
+
+def encode_chunked(
+    input_file: Path,
+    output_file: Path,
+    source: Probe,
+    work_directory: Path,
+    workers: int,
+    chunk_seconds: float = CHUNK_SECONDS,
+    on_progress: Callable[[TranscodeProgress], None] | None = None,
+) -> None:
+    """
+    Re-encodes a film like util.transcode.encode, but in chunks encoded side by side.
+    Each chunk is decoded straight from the film by its own single-threaded ffmpeg, workers at a time. The
+    seek starts decoding at the keyframe before the chunk and drops the frames before it, so every frame lands in
+    exactly one chunk whatever the GOP structure. The chunks are then concatenated without re-encoding and muxed
+    with the audio of the film, which is never split.
+    :param input_file:
+    :param output_file:
+    :param source: probe of the input file
+    :param work_directory: where the chunks are written; created, and deleted once done.
+    :param workers: chunks encoded at once
+    :param chunk_seconds: length of the chunks
+    :param on_progress: see util.transcode.run; reports the progress of all chunks together.
+    :raise SyncError: if the output failed verification
+    """
+    duration = source.duration
+    assert duration is not None
+    shutil.rmtree(work_directory, ignore_errors=True)
+    work_directory.mkdir()
+    try:
+        chunks = [
+            (work_directory / f"chunk-{i:05d}.mp4", start, length)
+            for i, (start, length) in enumerate(
+                chunk_boundaries(duration, chunk_seconds, source.frame_rate)
+            )
+        ]
+
+        lock = threading.Lock()
+        done: dict[Path, TranscodeProgress] = dict()
+        started = time.monotonic()
+
+        def report(chunk: Path, progress: TranscodeProgress) -> None:
+            assert on_progress is not None
+            with lock:
+                done[chunk] = progress
+                seconds = sum(i.seconds for i in done.values())
+                frame = sum(i.frame for i in done.values())
+            speed = seconds / (time.monotonic() - started)
+            on_progress(
+                TranscodeProgress(
+                    frame=frame,
+                    seconds=seconds,
+                    duration=duration,
+                    speed=speed,
+                    eta=max(duration - seconds, 0.0) / speed if speed else None,
+                )
+            )
+
+        def encode_chunk(chunk: Path, start: float, length: float | None) -> None:
+            streams = ffmpeg.input(str(input_file), **({"ss": start} if start else {}))
+            run(
+                ffmpeg.output(
+                    # every chunk starts at 0; the concatenation puts them back in place.
+                    streams["V:0"].filter("setpts", "PTS-STARTPTS"),
+                    str(chunk),
+                    format="mp4",
+                    fps_mode="passthrough",
+                    threads=1,
+                    **({"t": length} if length is not None else {}),
+                    **VIDEO_OPTIONS,
+                ),
+                length,
+                (lambda i: report(chunk, i)) if on_progress else None,
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # the threads only wait on their ffmpeg; the encoding happens in the ffmpeg processes.
+            for future in [pool.submit(encode_chunk, *i) for i in chunks]:
+                future.result()
+
+        playlist = work_directory / "chunks.txt"
+        playlist.write_text("".join(f"file '{i.name}'\n" for i, _, _ in chunks))
+        streams = ffmpeg.input(str(input_file))
+        run(
+            ffmpeg.output(
+                ffmpeg.input(str(playlist), format="concat", safe=0)["v:0"],
+                *([streams["a"]] if source.audio_codecs else []),
+                str(output_file),
+                format="mp4",
+                movflags="+faststart",
+                **{"c:v": "copy"},
+                **audio_options(source),
+            ).overwrite_output()
+        )
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    verify_sync(input_file, output_file)
@@ -0,0 +1,144 @@
+import statistics
+from pathlib import Path
+from typing import Any
+
+import ffmpeg
+
+# frames considered for the thumbnail and poster, spread over the film.
+CANDIDATES = 12
+
+# the first and last part of a film are skipped; they are often titles, credits or black.
+MARGIN = 0.05
+
+THUMBNAIL_WIDTH = 320
+POSTER_WIDTH = 1280
+
+# candidates are scored on a small grayscale copy.
+SCORE_SIZE = (160, 90)
+
+# mean luminance outside of this range is a black or white frame.
+LUMINANCE_RANGE = (24.0, 232.0)
+
+# below this standard deviation of luminance, a frame is a fade or a flat title card.
+MIN_CONTRAST = 12.0
+
+
+def candidate_times(duration: float) -> list[float]:
+    """
+    :param duration: of the film in seconds
+    :return: times of the candidate frames in seconds
+    """
+    span = duration * (1 - 2 * MARGIN)
+    return [
+        duration * MARGIN + span * (i + 0.5) / CANDIDATES for i in range(CANDIDATES)
+    ]
+
+
+def candidate_outputs(video: Any, directory: Path, **options: Any) -> list[Any]:
+    """
+    Writes each frame of a video stream as a candidate: a poster and a thumbnail, and a small grayscale copy to
+    score it on. The candidates are numbered from 1, in the order of the frames.
+    :param video: ffmpeg-python video stream of the candidate frames
+    :param directory:
+    :param options: more output options
+    :return: ffmpeg-python output streams
+    """
+    split = video.split()
+    return [
+        split[0]
+        .filter("scale", f"min(iw,{POSTER_WIDTH})", -2)
+        .output(str(directory / "poster-%03d.png"), fps_mode="passthrough", **options),
+        split[1]
+        .filter("scale", THUMBNAIL_WIDTH, -2)
+        .output(
+            str(directory / "thumbnail-%03d.png"), fps_mode="passthrough", **options
+        ),
+        split[2]
+        .filter("scale", *SCORE_SIZE)
+        .filter("format", "gray")
+        .output(str(directory / "score-%03d.pgm"), fps_mode="passthrough", **options),
+    ]
+
+
+def select_candidates(video: Any, duration: float) -> Any:
+    """
+    Picks the candidate frames out of a whole video stream, so they are extracted while the film is decoded
+    for something else anyway.
+    :param video: ffmpeg-python video stream of the film
+    :param duration: of the film in seconds
+    :return: ffmpeg-python video stream of the candidate frames
+    """
+    start, *_ = candidate_times(duration)
+    interval = duration * (1 - 2 * MARGIN) / CANDIDATES
+    return video.filter(
+        "select",
+        f"gte(t,{start})*(isnan(prev_selected_t)+gte(t-prev_selected_t,{interval}))",
+    )
+
+
+def sample_candidates(input_file: Path, duration: float, directory: Path) -> None:
+    """
+    Extracts the candidate frames by seeking to each one; only the frames from the keyframe before each
+    candidate are decoded.
+    :param input_file:
+    :param duration: of the film in seconds
+    :param directory:
+    """
+    for i, time in enumerate(candidate_times(duration), start=1):
+        streams = ffmpeg.input(str(input_file), ss=time)
+        ffmpeg.merge_outputs(
+            *candidate_outputs(streams["V:0"], directory, start_number=i, vframes=1)
+        ).overwrite_output().run(quiet=True)
+
+
+def read_pgm(file: Path) -> tuple[int, int, bytes]:
+    """
+    :param file: binary 8-bit PGM, as ffmpeg writes them
+    :return: width, height and luminance of each pixel, row by row
+    """
+    data = file.read_bytes()
+    magic, width, height, maximum, pixels = data.split(maxsplit=4)
+    assert magic == b"P5" and maximum == b"255"
+    return int(width), int(height), pixels[: int(width) * int(height)]
+
+
+def score(width: int, height: int, pixels: bytes) -> float:
+    """
+    Scores how well a frame represents a film: sharp, contrasted frames score high.
+    :param width:
+    :param height:
+    :param pixels: luminance of each pixel, row by row
+    :return: 0 for black, white and flat frames; otherwise the variance of the laplacian, which drops as a
+    frame gets blurry.
+    """
+    mean = statistics.fmean(pixels)
+    if not LUMINANCE_RANGE[0] <= mean <= LUMINANCE_RANGE[1]:
+        return 0.0
+    if statistics.pstdev(pixels, mean) < MIN_CONTRAST:
+        return 0.0
+    laplacian = [
+        pixels[i - width] + pixels[i + width] + pixels[i - 1] + pixels[i + 1]
+        - 4 * pixels[i]
+        for y in range(1, height - 1)
+        for i in range(y * width + 1, y * width + width - 1)
+    ]  # fmt: skip
+    return statistics.pvariance(laplacian)
+
+
+def choose_images(directory: Path) -> tuple[bytes, bytes] | None:
+    """
+    :param directory: written by candidate_outputs
+    :return: thumbnail and poster of the best candidate; the first one if they all scored 0. None if there are no
+    candidates.
+    """
+    scores = {
+        file.stem.removeprefix("score-"): score(*read_pgm(file))
+        for file in sorted(directory.glob("score-*.pgm"))
+    }
+    if not scores:
+        return None
+    best = max(scores, key=lambda i: scores[i])  # first of the best
+    return (
+        (directory / f"thumbnail-{best}.png").read_bytes(),
+        (directory / f"poster-{best}.png").read_bytes(),
+    )
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import os
+import secrets
+from dataclasses import dataclass
+from email.utils import formatdate
+from pathlib import Path
+
+from anyio import AsyncFile
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+MAX_RANGES = 16  # requests with more ranges than this are answered with the whole file
+
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+
+@dataclass(frozen=True)
+class VideoFile:
+    path: Path
+    size: int
+    mtime: float
+
+    @property
+    def etag(self) -> str:
+        return f'"{int(self.mtime * 1_000_000):x}-{self.size:x}"'
+
+    @property
+    def last_modified(self) -> str:
+        return formatdate(self.mtime, usegmt=True)
+
+    @classmethod
+    def from_stat(cls, path: Path, stat: os.stat_result) -> VideoFile:
+        return VideoFile(path=path, size=stat.st_size, mtime=stat.st_mtime)
+
+
+def parse_range(header: str | None, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses a Range header. Malformed headers are ignored, as RFC 9110 allows.
+    :param header: Range header of the request
+    :param size: size of the file in bytes
+    :return: first and last byte of each range, in the order requested. none if the whole file is to be sent.
+    :raises ValueError: if none of the ranges can be satisfied
+    """
+    if header is None:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = list()
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash or not (first or last).isdigit() or not (last or "0").isdigit():
+            return None
+        if not first:  # suffix range; the last n bytes
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        if int(first) < size:
+            ranges.append((int(first), min(int(last) if last else size - 1, size - 1)))
+    if not ranges:
+        raise ValueError("range not satisfiable")
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+class VideoResponse(Response):
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        file: AsyncFile[bytes],
+        video: VideoFile,
+        ranges: list[tuple[int, int]] | None,
+        media_type: str = "video/mp4",
+    ) -> None:
+        """
+        Sends a whole file, a single range of it, or several ranges as multipart/byteranges.
+        The body is sent with the ASGI zero-copy extension when the server supports it, and read in chunks otherwise.
+        :param file: open file of the video; closed once the response is sent.
+        :param video: size and modification time of the open file
+        :param ranges: as returned by parse_range
+        :param media_type:
+        """
+        self.file = file
+        self.background = None
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": video.etag,
+            "Last-Modified": video.last_modified,
+        }
+        # each segment is sent as the given prefix, then count bytes of the file from offset.
+        self.segments: list[tuple[bytes, int, int]]
+        self.epilogue = b""
+        if ranges is None:
+            self.status_code = 200
+            self.media_type = media_type
+            self.segments = [(b"", 0, video.size)]
+        elif len(ranges) == 1:
+            ((first, last),) = ranges
+            self.status_code = 206
+            self.media_type = media_type
+            self.segments = [(b"", first, last - first + 1)]
+            headers["Content-Range"] = f"bytes {first}-{last}/{video.size}"
+        else:
+            boundary = secrets.token_hex(16)
+            self.status_code = 206
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+            self.segments = list()
+            for first, last in ranges:
+                part = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {first}-{last}/{video.size}\r\n\r\n"
+                )
+                if self.segments:
+                    part = "\r\n" + part
+                self.segments.append((part.encode(), first, last - first + 1))
+            self.epilogue = f"\r\n--{boundary}--\r\n".encode()
+        length = sum(len(prefix) + count for prefix, _, count in self.segments)
+        headers["Content-Length"] = str(length + len(self.epilogue))
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            for prefix, offset, count in self.segments:
+                if prefix:
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": prefix,
+                            "more_body": True,
+                        }
+                    )
+                if zerocopy:
+                    await send(
+                        {
+                            "type": ZEROCOPY_EXTENSION,
+                            "file": self.file.wrapped,
+                            "offset": offset,
+                            "count": count,
+                            "more_body": True,
+                        }
+                    )
+                    continue
+                await self.file.seek(offset)
+                while count > 0:
+                    chunk = await self.file.read(min(self.chunk_size, count))
+                    if not chunk:
+                        raise RuntimeError(f"{self.file.name} was truncated")
+                    count -= len(chunk)
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": self.epilogue,
+                    "more_body": False,
+                }
+            )
+        finally:
+            await self.file.aclose()